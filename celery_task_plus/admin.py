@@ -0,0 +1,210 @@
+# Python
+import itertools
+import json
+
+# Django
+from django.conf import settings
+from django.contrib import admin, messages
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ORDER_VAR, ChangeList
+from django.core.exceptions import PermissionDenied
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.http import HttpResponseRedirect
+from django.template.response import TemplateResponse
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _
+
+# Celery
+from celery import current_app, states
+
+# Celery-Task-Plus
+from .clients import get_lock_client
+from .locks import force_release_lock, force_release_locks, iter_held_locks
+
+__all__ = [
+    'EstimatedCountPaginator', 'TaskNameListFilter', 'TaskResultChangeList', 'TaskStateListFilter',
+    'get_estimated_count', 'task_locks_view',
+]
+
+# Query string parameter for the position of the next page of task results.
+CURSOR_VAR = 'cursor'
+
+# Fields of task results not loaded by the changelist.
+_deferred_fields = ('result', 'traceback', 'meta', 'task_args', 'task_kwargs')
+
+
+def _get_count_limit():
+    return getattr(settings, 'CELERY_TASK_PLUS_ADMIN_COUNT_LIMIT', 10000)
+
+
+def get_estimated_count(queryset):
+    """
+    Return the number of rows in the table of the queryset's model from the
+    database statistics (PostgreSQL and MySQL), or None if not available.
+    """
+    connection = connections[queryset.db]
+    table = queryset.model._meta.db_table
+    if connection.vendor == 'postgresql':
+        sql = 'SELECT reltuples FROM pg_class WHERE oid = %s::regclass'
+    elif connection.vendor == 'mysql':
+        sql = 'SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s'
+    else:
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [table])
+        row = cursor.fetchone()
+    # PostgreSQL returns -1 for tables that were never analyzed.
+    if row is None or row[0] is None or row[0] < 0:
+        return None
+    return int(row[0])
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that never counts more than CELERY_TASK_PLUS_ADMIN_COUNT_LIMIT
+    rows, using the database's estimate of the table size when unfiltered.
+    """
+
+    @cached_property
+    def count(self):
+        count_limit = _get_count_limit()
+        if not self.object_list.query.where:
+            estimated_count = get_estimated_count(self.object_list)
+            if estimated_count is not None and estimated_count > count_limit:
+                return estimated_count
+        return self.object_list.order_by()[:count_limit].count()
+
+
+class TaskStateListFilter(admin.SimpleListFilter):
+    """
+    Filter by the known Celery states instead of the distinct states stored.
+    """
+
+    title = _('status')
+    parameter_name = 'status'
+
+    def lookups(self, request, model_admin):
+        return [(state, state) for state in sorted(states.ALL_STATES)]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(status=self.value())
+        return queryset
+
+
+class TaskNameListFilter(admin.SimpleListFilter):
+    """
+    Filter by the names of registered tasks instead of the distinct names
+    stored.
+    """
+
+    title = _('task name')
+    parameter_name = 'task_name'
+
+    def lookups(self, request, model_admin):
+        current_app.loader.import_default_modules()
+        task_names = sorted(name for name in current_app.tasks if not name.startswith('celery.'))
+        return [(name, name) for name in task_names]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(task_name=self.value())
+        return queryset
+
+
+class TaskResultChangeList(ChangeList):
+    """
+    Changelist that skips loading large fields and, with the default ordering,
+    pages through task results by (date_done, id) instead of by offset.
+    """
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(CURSOR_VAR, None)
+        return lookup_params
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).defer(*_deferred_fields)
+
+    def _get_cursor(self):
+        cursor = self.params.get(CURSOR_VAR)
+        if not cursor:
+            return None
+        date_done, _, pk = cursor.rpartition('_')
+        try:
+            date_done = parse_datetime(date_done)
+            pk = int(pk)
+        except ValueError:
+            date_done = None
+        if date_done is None:
+            raise IncorrectLookupParameters
+        return date_done, pk
+
+    def get_results(self, request):
+        self.keyset_pagination = ORDER_VAR not in self.params
+        if not self.keyset_pagination:
+            return super().get_results(request)
+        cursor = self._get_cursor()
+        queryset = self.queryset.order_by('-date_done', '-pk')
+        if cursor is not None:
+            date_done, pk = cursor
+            queryset = queryset.filter(Q(date_done__lt=date_done) | Q(date_done=date_done, pk__lt=pk))
+        result_list = list(queryset[:self.list_per_page + 1])
+        if len(result_list) > self.list_per_page:
+            result_list = result_list[:self.list_per_page]
+            last_result = result_list[-1]
+            next_cursor = '{}_{}'.format(last_result.date_done.isoformat(), last_result.pk)
+            self.next_page_url = self.get_query_string({CURSOR_VAR: next_cursor})
+        else:
+            self.next_page_url = None
+        self.first_page_url = self.get_query_string(remove=[CURSOR_VAR]) if cursor is not None else None
+        self.paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        self.result_count = self.paginator.count
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.full_result_count = None
+        self.result_list = result_list
+        self.can_show_all = False
+        self.multi_page = bool(self.next_page_url or self.first_page_url)
+
+
+def task_locks_view(model_admin, request):
+    """
+    List the held task locks matching the pattern query string parameter (up
+    to CELERY_TASK_PLUS_ADMIN_LOCKS_LIMIT), and let superusers force release
+    selected or all matching locks.
+    """
+    if not model_admin.has_view_permission(request):
+        raise PermissionDenied
+    pattern = request.GET.get('pattern') or '*'
+    can_release = request.user.is_superuser
+    redis_client = get_lock_client()
+    if request.method == 'POST':
+        if not can_release:
+            raise PermissionDenied
+        if 'release_matching' in request.POST:
+            released = force_release_locks(redis_client, pattern)
+        else:
+            released = 0
+            for value in request.POST.getlist('lock'):
+                key, member = json.loads(value)
+                released += force_release_lock(redis_client, key, member)
+        model_admin.message_user(request, _('Released %d locks.') % released, messages.SUCCESS)
+        return HttpResponseRedirect(request.get_full_path())
+    limit = getattr(settings, 'CELERY_TASK_PLUS_ADMIN_LOCKS_LIMIT', 500)
+    held_locks = list(itertools.islice(iter_held_locks(redis_client, pattern), limit + 1))
+    for held_lock in held_locks:
+        held_lock['value'] = json.dumps([held_lock['key'], held_lock['member']])
+    context = dict(
+        model_admin.admin_site.each_context(request),
+        title=_('Task locks'),
+        opts=model_admin.model._meta,
+        pattern=pattern,
+        held_locks=held_locks[:limit],
+        truncated=len(held_locks) > limit,
+        can_release=can_release,
+    )
+    return TemplateResponse(request, 'admin/celery_task_plus/task_locks.html', context)
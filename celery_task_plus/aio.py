@@ -0,0 +1,420 @@
+# Python
+import asyncio
+import contextlib
+import inspect
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+import weakref
+
+# Django
+from django.conf import settings
+
+# Celery
+from celery import states, Task
+from celery.exceptions import Ignore, Reject
+from celery.utils.time import rate
+
+# Redis
+from redis.asyncio import BlockingConnectionPool, ConnectionPool, StrictRedis
+
+# ASGIRef
+from asgiref.sync import sync_to_async
+
+# Celery-Task-Plus
+from .backends import RedisLockBackend
+from .clients import RedisScript, get_lock_client
+from .locks import (
+    Lock, NotAcquired, _acquire_lock_script, _clear_pending_task_script, _extend_lock_script, _get_pending_key,
+    _get_queue_key, _get_rate_limit_key, _get_waiter_key, _get_waiter_lease_key, _notify_lock_waiter_script,
+    _rate_limit_script, _release_lock_script, _waiter_lease_margin, _waiter_signal_expire, record_lock_hold,
+)
+from .tasks import DirectResultsTask, LockedTask, release_parked_task
+from . import metrics
+
+logger = logging.getLogger('celery_task_plus.aio')
+
+__all__ = [
+    'AsyncLock', 'AsyncTask', 'AsyncLockedTask', 'AsyncDirectResultsTask', 'AsyncLockedDirectResultsTask',
+    'get_async_lock_client',
+]
+
+# Lock clients by event loop, since redis.asyncio connections can only be used
+# from the loop that created them.
+_async_lock_clients = weakref.WeakKeyDictionary()
+
+# Event loop running tasks in each thread, stored as a (pid, loop) tuple so a
+# forked child never uses the loop (and lock client connections) of its parent.
+_task_event_loops = threading.local()
+
+
+class AsyncRedisScript(RedisScript):
+    """
+    Lua script that can be run against any redis.asyncio client.
+    """
+
+    async def __call__(self, redis_client, keys=(), args=()):
+        if self._script is None:
+            self._script = redis_client.register_script(self.source)
+        return await self._script(keys=keys, args=args, client=redis_client)
+
+
+_async_acquire_lock_script = AsyncRedisScript(_acquire_lock_script.source)
+_async_extend_lock_script = AsyncRedisScript(_extend_lock_script.source)
+_async_release_lock_script = AsyncRedisScript(_release_lock_script.source)
+_async_notify_lock_waiter_script = AsyncRedisScript(_notify_lock_waiter_script.source)
+_async_clear_pending_task_script = AsyncRedisScript(_clear_pending_task_script.source)
+_async_rate_limit_script = AsyncRedisScript(_rate_limit_script.source)
+
+
+def _create_async_lock_client():
+    redis_url = getattr(settings, 'CELERY_TASK_PLUS_LOCK_REDIS_URL', None) or settings.REDIS_URL
+    max_connections = getattr(settings, 'CELERY_TASK_PLUS_LOCK_REDIS_MAX_CONNECTIONS', None)
+    if max_connections:
+        pool_timeout = getattr(settings, 'CELERY_TASK_PLUS_LOCK_REDIS_POOL_TIMEOUT', 20)
+        pool = BlockingConnectionPool.from_url(redis_url, max_connections=max_connections, timeout=pool_timeout)
+    else:
+        pool = ConnectionPool.from_url(redis_url)
+    return StrictRedis(connection_pool=pool)
+
+
+def get_async_lock_client():
+    """
+    Return the redis.asyncio client used for task locks in the running event
+    loop, connected to ``CELERY_TASK_PLUS_LOCK_REDIS_URL`` or ``REDIS_URL``.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_lock_clients.get(loop)
+    if client is None:
+        client = _create_async_lock_client()
+        _async_lock_clients[loop] = client
+    return client
+
+
+class AsyncLock(Lock):
+    """
+    Lock using a redis.asyncio client, where acquire, extend and release are
+    coroutines. Locks acquired with auto_renewal are renewed from a task in the
+    event loop until released.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._renewal_task = None
+
+    async def get_owner_id(self):
+        return await self._client.get(self._lock_key)
+
+    async def locked(self):
+        return bool(await self._client.exists(self._lock_key))
+
+    async def _try_acquire(self):
+        result = await _async_acquire_lock_script(self._client, keys=[self._lock_key, self._shared_key], args=[self.id, self.expire])
+        if result[0]:
+            self.last_owner_id = None
+            return True
+        self.last_owner_id = result[1]
+        return False
+
+    async def acquire(self, blocking=True, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not await self._try_acquire():
+            if not blocking:
+                return False
+            if deadline is None:
+                wait = self.expire
+            else:
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    return False
+            await self._client.blpop(self._signal_keys, timeout=max(1, int(math.ceil(min(wait, self.expire)))))
+        if self.auto_renewal:
+            self._renewal_task = asyncio.ensure_future(self._renew())
+        return True
+
+    async def extend(self, expire=None):
+        if expire is not None:
+            self.expire = int(math.ceil(expire))
+        if not await _async_extend_lock_script(self._client, keys=[self._lock_key], args=[self.id, self.expire]):
+            raise NotAcquired('Lock {} is not acquired or it already expired.'.format(self.name))
+        metrics.incr('lock_renewed', **self.metric_labels)
+
+    async def release(self, notify_waiter=False):
+        if self._renewal_task is not None:
+            self._renewal_task.cancel()
+            self._renewal_task = None
+        keys = [self._lock_key, self._signal_key]
+        args = [self.id, self.signal_expire]
+        if notify_waiter:
+            keys.append(_get_queue_key(self.name))
+            args.extend([_get_waiter_key(''), _waiter_signal_expire, _get_waiter_lease_key('')])
+        if not await _async_release_lock_script(self._client, keys=keys, args=args):
+            raise NotAcquired('Lock {} is not acquired or it already expired.'.format(self.name))
+
+    async def _renew(self):
+        while True:
+            await asyncio.sleep(self.expire * 2 / 3)
+            try:
+                await self.extend()
+            except Exception:
+                logger.warning('Unable to renew lock: %s', self.name, exc_info=True)
+                return
+
+
+async def acquire_lock_in_order(lock, redis_client, name, timeout=None, expire=60):
+    """
+    Coroutine version of locks.acquire_lock_in_order for an AsyncLock.
+    """
+    queue_key = _get_queue_key(name)
+    if not await redis_client.llen(queue_key) and await lock.acquire(blocking=False):
+        return True
+    token = uuid.uuid4().hex
+    waiter_key = _get_waiter_key(token)
+    lease_key = _get_waiter_lease_key(token)
+    lease_expire = expire + _waiter_lease_margin
+    deadline = None if timeout is None else time.monotonic() + timeout
+    acquired = False
+    async with redis_client.pipeline() as pipe:
+        pipe.set(lease_key, 1, ex=lease_expire)
+        pipe.rpush(queue_key, token)
+        pipe.expire(queue_key, expire + int(timeout or expire))
+        await pipe.execute()
+    try:
+        acquired = await lock.acquire(blocking=False)
+        if acquired:
+            return True
+        while True:
+            if deadline is None:
+                wait = expire
+            else:
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    return False
+            signalled = await redis_client.blpop(waiter_key, timeout=max(1, int(math.ceil(min(wait, expire)))))
+            acquired = await lock.acquire(blocking=False)
+            if acquired:
+                return True
+            async with redis_client.pipeline() as pipe:
+                pipe.set(lease_key, 1, ex=lease_expire)
+                if signalled:
+                    pipe.lpush(queue_key, token)
+                await pipe.execute()
+    finally:
+        async with redis_client.pipeline() as pipe:
+            pipe.lrem(queue_key, 0, token)
+            pipe.delete(lease_key)
+            await pipe.execute()
+        if not acquired and await redis_client.lpop(waiter_key):
+            await notify_lock_waiter(redis_client, name)
+
+
+async def notify_lock_waiter(redis_client, name):
+    """
+    Coroutine version of locks.notify_lock_waiter.
+    """
+    args = [_get_waiter_key(''), _waiter_signal_expire, _get_waiter_lease_key('')]
+    await _async_notify_lock_waiter_script(redis_client, keys=[_get_queue_key(name)], args=args)
+
+
+def _get_task_event_loop():
+    # Return the event loop kept for running tasks in the current thread, so
+    # its lock client (and connection pool) is reused by every task.
+    pid = os.getpid()
+    loop_pid, loop = getattr(_task_event_loops, 'loop', (None, None))
+    if loop_pid != pid or loop.is_closed():
+        loop = asyncio.new_event_loop()
+        _task_event_loops.loop = (pid, loop)
+    return loop
+
+
+class AsyncTask(Task):
+    """
+    Base class for tasks with an ``async def`` function. Calling the task
+    directly returns a coroutine to await (e.g. from an async view); in a worker
+    or when applied eagerly, the coroutine is run in an event loop kept for the
+    current thread.
+    """
+
+    abstract = True
+
+    def __call__(self, *args, **kwargs):
+        coro = self._acall(*args, **kwargs)
+        if self.request.called_directly:
+            return coro
+        return _get_task_event_loop().run_until_complete(coro)
+
+    async def _acall(self, *args, **kwargs):
+        result = self.run(*args, **kwargs)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+
+class AsyncLockedTask(AsyncTask, LockedTask):
+    """
+    LockedTask that acquires and waits for its lock without blocking the event
+    loop. Task keys and lock options are the same as for LockedTask.
+    """
+
+    abstract = True
+
+    @classmethod
+    async def _aget_task_key(cls, *args, **kwargs):
+        task_key_plan = cls._get_task_key_plan()
+        task_key = task_key_plan.build(args, kwargs)
+        if task_key_plan.key_hash and cls.task_key_debug:
+            redis_client = get_async_lock_client()
+            await redis_client.set('task-key:{}'.format(task_key), task_key_plan.describe(args, kwargs), ex=cls.task_key_debug)
+        return task_key
+
+    @classmethod
+    def _get_async_redis_lock(cls, task_key, expire=60, auto_renewal=True):
+        if cls.task_key_specs or cls.task_lock_mode != 'exclusive' or cls.task_concurrency_limit:
+            raise NotImplementedError('Async tasks only support exclusive locks of the task key.')
+        if not isinstance(cls._get_lock_backend(), RedisLockBackend):
+            raise NotImplementedError('Async tasks only support the Redis lock backend.')
+        redis_client = get_async_lock_client()
+        owner_id = cls._get_owner_id()
+        return AsyncLock(redis_client, task_key, id=owner_id, expire=expire, auto_renewal=auto_renewal)
+
+    @classmethod
+    @contextlib.asynccontextmanager
+    async def _alock_task(cls, task_key, exc_class=Reject):
+        expire, blocking, timeout = cls._get_lock_options()
+        owner_id = cls._get_owner_id()
+        lock = cls._get_async_redis_lock(task_key, expire)
+        metric_labels = dict(task=cls.name, lock=cls._get_task_key_plan().key_prefix)
+        lock.metric_labels = metric_labels
+        acquired = False
+        acquire_start = time.monotonic()
+        try:
+            if blocking and cls.task_lock_wait == 'queue':
+                acquired = await acquire_lock_in_order(lock, get_async_lock_client(), task_key, timeout, expire)
+            else:
+                acquired = await lock.acquire(blocking=blocking, timeout=timeout)
+            acquire_end = time.monotonic()
+            metrics.observe('lock_acquire', acquire_end - acquire_start, **metric_labels)
+            if acquired:
+                metrics.incr('lock_acquired', **metric_labels)
+                logger.debug('Acquired the lock: %s @ %s', task_key, owner_id)
+                yield
+            else:
+                metrics.incr('lock_contended', **metric_labels)
+                msg = cls._get_lock_contended_message(task_key, owner_id, lock.last_owner_id)
+                logger.debug(msg)
+                raise exc_class(msg)
+        finally:
+            if acquired:
+                await lock.release(notify_waiter=cls.task_lock_wait == 'queue')
+                hold_time = time.monotonic() - acquire_end
+                record_lock_hold(cls.name, hold_time)
+                metrics.observe('lock_hold', hold_time, **metric_labels)
+                logger.debug('Released the lock: %s @ %s', task_key, owner_id)
+                if cls.task_lock_park:
+                    await sync_to_async(release_parked_task)(get_lock_client(), task_key, released=True)
+
+    async def _acall(self, *args, **kwargs):
+        task_key = await self._aget_task_key(*args, **kwargs)
+        if self.task_enqueue_dedup and self.request.id:
+            await _async_clear_pending_task_script(get_async_lock_client(), keys=[_get_pending_key(task_key)], args=[self.request.id])
+        task_rate = rate(self.task_key_rate_limit)
+        if task_rate:
+            args = [1000.0 / task_rate, max(int(self.task_key_rate_limit_burst), 1)]
+            wait = await _async_rate_limit_script(get_async_lock_client(), keys=[_get_rate_limit_key(task_key)], args=args)
+            if wait:
+                self._defer_rate_limited_task(task_key, int(wait) / 1000.0)
+        async with contextlib.AsyncExitStack() as stack:
+            try:
+                await stack.enter_async_context(self._alock_task(task_key))
+            except Reject as e:
+                if not self.task_lock_defer:
+                    raise
+                self._defer_locked_task(e)
+            return await super()._acall(*args, **kwargs)
+
+
+class AsyncDeferredResult(object):
+    """
+    Coroutine version of results.DeferredResult, storing the result from a task
+    in the event loop after a delay unless cancelled first.
+    """
+
+    def __init__(self, delay, store, *args, **kwargs):
+        self._delay = delay
+        self._store = store
+        self._args = args
+        self._kwargs = kwargs
+        self._storing = False
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def cancel(self):
+        if self._storing:
+            await self._task
+        else:
+            self._task.cancel()
+
+    async def _run(self):
+        await asyncio.sleep(self._delay)
+        self._storing = True
+        try:
+            await self._store(*self._args, **self._kwargs)
+        except Exception:
+            logger.exception('Error storing deferred task result')
+
+
+class AsyncDirectResultsTask(AsyncTask, DirectResultsTask):
+    """
+    DirectResultsTask that stores results for direct calls from a thread (see
+    asgiref's sync_to_async), so the event loop is not blocked by the database.
+    """
+
+    abstract = True
+
+    async def _astore_direct_result(self, *args, **kwargs):
+        return await sync_to_async(self._store_direct_result)(*args, **kwargs)
+
+    async def _acall(self, *args, **kwargs):
+        call = self._get_direct_results_call(args, kwargs)
+        task_id = call['task_id']
+        task_request = call['task_request']
+        task_result = None
+        task_exc = None
+
+        deferred_started = None
+        if call['store_started']:
+            meta, started_delay = self._get_direct_results_started()
+            if started_delay:
+                deferred_started = AsyncDeferredResult(started_delay, self._astore_direct_result, task_id, meta, states.STARTED, request=task_request)
+                deferred_started.start()
+            else:
+                await self._astore_direct_result(task_id, meta, states.STARTED, request=task_request)
+                logger.debug('Marked task_id = %s as started', task_id)
+
+        try:
+            task_result = await super()._acall(*args, **kwargs)
+            return task_result
+        except (Ignore, Reject) as e:
+            task_exc = e
+            raise
+        except Exception as e:
+            task_exc = e
+            raise
+        finally:
+            if deferred_started is not None:
+                await deferred_started.cancel()
+            final = self._get_direct_results_final(call, task_result, task_exc)
+            if final is not None:
+                result, state, mark_as = final
+                await self._astore_direct_result(task_id, result, state, request=task_request, mark_as=mark_as)
+                logger.debug('Marked task_id = %s as %s: %r', task_id, state, result)
+
+
+class AsyncLockedDirectResultsTask(AsyncDirectResultsTask, AsyncLockedTask):
+
+    abstract = True
@@ -11,3 +11,5 @@ class CeleryTaskPlusConfig(AppConfig):
     def ready(self):
         from .patches import patch_django_celery_results
         patch_django_celery_results()
+        # Register the periodic task to purge task results and the lock reaper.
+        from . import reaper, retention  # noqa: F401
@@ -0,0 +1,204 @@
+# Python
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+# Django
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+# Celery-Task-Plus
+from .clients import get_lock_client
+from .locks import Lock, MultiLock, NotAcquired, Semaphore
+
+__all__ = [
+    'BaseLockBackend', 'RedisLockBackend', 'ThreadingLockBackend', 'FileLockBackend', 'get_lock_backend',
+]
+
+_default_lock_backend = 'celery_task_plus.backends.RedisLockBackend'
+
+# Lock backend instances, shared by dotted path.
+_lock_backends = {}
+_lock_backends_lock = threading.Lock()
+
+# Seconds between attempts to acquire a file lock with a timeout.
+_file_lock_poll_interval = 0.05
+
+
+class BaseLockBackend(object):
+    """
+    Creates the locks used by LockedTask. Locks provide acquire(blocking=True,
+    timeout=None), release(notify_waiter=False) and, after a failed acquire,
+    last_owner_id.
+    """
+
+    def get_lock(self, name, owner_id, expire=60, auto_renewal=True, shared=False, limit=None):
+        """
+        Return a lock for the name (a task key, or a list of task keys), held
+        by owner_id. Shared locks and limits > 1 (semaphores) are optional.
+        """
+        raise NotImplementedError
+
+    def _check_exclusive(self, name, shared, limit):
+        if isinstance(name, (list, tuple)) or shared or limit:
+            raise ValueError('{} only supports exclusive locks of a single key.'.format(type(self).__name__))
+
+
+class RedisLockBackend(BaseLockBackend):
+    """
+    Locks shared by all workers using the Redis lock client (the default).
+    """
+
+    def get_lock(self, name, owner_id, expire=60, auto_renewal=True, shared=False, limit=None):
+        redis_client = get_lock_client()
+        if limit:
+            if isinstance(name, (list, tuple)) or shared:
+                raise ValueError('task_concurrency_limit cannot be combined with task_key_specs or shared locks.')
+            return Semaphore(redis_client, name, limit, id=owner_id, expire=expire, auto_renewal=auto_renewal)
+        if isinstance(name, (list, tuple)) or shared:
+            names = name if isinstance(name, (list, tuple)) else [name]
+            return MultiLock(redis_client, names, id=owner_id, expire=expire, auto_renewal=auto_renewal, shared=shared)
+        return Lock(redis_client, name, id=owner_id, expire=expire, auto_renewal=auto_renewal)
+
+
+class ThreadingLock(object):
+
+    def __init__(self, backend, name, owner_id):
+        self._backend = backend
+        self.name = name
+        self.id = owner_id
+        self.last_owner_id = None
+
+    def acquire(self, blocking=True, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._backend._condition:
+            while self.name in self._backend._owners:
+                self.last_owner_id = self._backend._owners[self.name][0]
+                if not blocking:
+                    return False
+                if deadline is None:
+                    self._backend._condition.wait()
+                else:
+                    wait = deadline - time.monotonic()
+                    if wait <= 0:
+                        return False
+                    self._backend._condition.wait(wait)
+            self._backend._owners[self.name] = (self.id, self)
+            self.last_owner_id = None
+            return True
+
+    def release(self, notify_waiter=False):
+        with self._backend._condition:
+            if self._backend._owners.get(self.name, (None, None))[1] is not self:
+                raise NotAcquired('Lock {} is not acquired.'.format(self.name))
+            del self._backend._owners[self.name]
+            self._backend._condition.notify_all()
+
+
+class ThreadingLockBackend(BaseLockBackend):
+    """
+    Locks held in memory, only shared by threads in the current process (e.g.
+    for tests or eager tasks in a single process). Locks never expire.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._owners = {}
+
+    def get_lock(self, name, owner_id, expire=60, auto_renewal=True, shared=False, limit=None):
+        self._check_exclusive(name, shared, limit)
+        return ThreadingLock(self, name, owner_id)
+
+
+class FileLock(object):
+
+    def __init__(self, path, name, owner_id):
+        import fcntl
+        self._fcntl = fcntl
+        self._path = path
+        self._file = None
+        self.name = name
+        self.id = owner_id if isinstance(owner_id, bytes) else str(owner_id).encode('utf-8')
+        self.last_owner_id = None
+
+    def _try_acquire(self, blocking=False):
+        flags = self._fcntl.LOCK_EX if blocking else self._fcntl.LOCK_EX | self._fcntl.LOCK_NB
+        try:
+            self._fcntl.flock(self._file.fileno(), flags)
+        except BlockingIOError:
+            self._file.seek(0)
+            self.last_owner_id = self._file.read() or None
+            return False
+        return True
+
+    def acquire(self, blocking=True, timeout=None):
+        self._file = open(self._path, 'a+b')
+        try:
+            if blocking and timeout is None:
+                acquired = self._try_acquire(blocking=True)
+            else:
+                deadline = time.monotonic() + (timeout or 0)
+                acquired = self._try_acquire()
+                while not acquired and blocking and time.monotonic() < deadline:
+                    time.sleep(_file_lock_poll_interval)
+                    acquired = self._try_acquire()
+            if acquired:
+                self._file.truncate(0)
+                self._file.write(self.id)
+                self._file.flush()
+                self.last_owner_id = None
+                return True
+        except BaseException:
+            self._file.close()
+            self._file = None
+            raise
+        self._file.close()
+        self._file = None
+        return False
+
+    def release(self, notify_waiter=False):
+        if self._file is None:
+            raise NotAcquired('Lock {} is not acquired.'.format(self.name))
+        try:
+            self._file.truncate(0)
+            self._fcntl.flock(self._file.fileno(), self._fcntl.LOCK_UN)
+        finally:
+            self._file.close()
+            self._file = None
+
+
+class FileLockBackend(BaseLockBackend):
+    """
+    Locks using fcntl.flock() on files in CELERY_TASK_PLUS_LOCK_FILE_DIR (by
+    default a directory in the system temporary directory), shared by all
+    processes on the same host. Locks are released when their process exits.
+    """
+
+    def __init__(self):
+        default_lock_dir = os.path.join(tempfile.gettempdir(), 'celery-task-plus-locks')
+        self.lock_dir = getattr(settings, 'CELERY_TASK_PLUS_LOCK_FILE_DIR', default_lock_dir)
+        os.makedirs(self.lock_dir, exist_ok=True)
+
+    def get_lock(self, name, owner_id, expire=60, auto_renewal=True, shared=False, limit=None):
+        self._check_exclusive(name, shared, limit)
+        file_name = '{}.lock'.format(hashlib.blake2b(name.encode('utf-8'), digest_size=16).hexdigest())
+        return FileLock(os.path.join(self.lock_dir, file_name), name, owner_id)
+
+
+def get_lock_backend(backend_path=None):
+    """
+    Return the lock backend for the given dotted path, or for the
+    CELERY_TASK_PLUS_LOCK_BACKEND setting (default RedisLockBackend).
+    """
+    if not backend_path:
+        backend_path = getattr(settings, 'CELERY_TASK_PLUS_LOCK_BACKEND', None) or _default_lock_backend
+    backend = _lock_backends.get(backend_path)
+    if backend is None:
+        with _lock_backends_lock:
+            backend = _lock_backends.get(backend_path)
+            if backend is None:
+                backend = import_string(backend_path)()
+                _lock_backends[backend_path] = backend
+    return backend
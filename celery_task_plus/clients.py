@@ -0,0 +1,122 @@
+# Python
+import logging
+import os
+import socket
+import threading
+import urllib.parse
+import uuid
+
+# Django
+from django.conf import settings
+from django.core.cache import cache
+
+# Celery
+from celery.signals import worker_process_init
+
+# Redis
+from redis import BlockingConnectionPool, ConnectionPool, StrictRedis
+
+logger = logging.getLogger('celery_task_plus.clients')
+
+__all__ = ['RedisScript', 'get_lock_client', 'get_owner_id', 'reset_lock_client']
+
+# Process-wide lock client and owner id, stored as (pid, value) tuples so a
+# forked child never reuses a value created by its parent.
+_lock_client = (None, None)
+_lock_client_lock = threading.Lock()
+_owner_id = (None, None)
+
+
+def _create_lock_client():
+    redis_url = getattr(settings, 'CELERY_TASK_PLUS_LOCK_REDIS_URL', None)
+    max_connections = getattr(settings, 'CELERY_TASK_PLUS_LOCK_REDIS_MAX_CONNECTIONS', None)
+    if not redis_url:
+        try:
+            client = cache.client.get_client()
+        except AttributeError:
+            redis_url = settings.REDIS_URL
+        else:
+            # The django-redis connection pool is configured by its own
+            # CONNECTION_POOL_KWARGS cache option.
+            ignored_settings = [
+                name for name in ('CELERY_TASK_PLUS_LOCK_REDIS_MAX_CONNECTIONS', 'CELERY_TASK_PLUS_LOCK_REDIS_POOL_TIMEOUT')
+                if getattr(settings, name, None) is not None
+            ]
+            if ignored_settings:
+                logger.warning(
+                    '%s %s ignored when locks use the django-redis cache client; set CELERY_TASK_PLUS_LOCK_REDIS_URL.',
+                    ' and '.join(ignored_settings), 'are' if len(ignored_settings) > 1 else 'is',
+                )
+            return client
+    if max_connections:
+        pool_timeout = getattr(settings, 'CELERY_TASK_PLUS_LOCK_REDIS_POOL_TIMEOUT', 20)
+        pool = BlockingConnectionPool.from_url(redis_url, max_connections=max_connections, timeout=pool_timeout)
+    else:
+        pool = ConnectionPool.from_url(redis_url)
+    return StrictRedis(connection_pool=pool)
+
+
+def get_lock_client():
+    """
+    Return the Redis client used for task locks, shared by all threads in the
+    current process.
+
+    Locks use a dedicated Redis server when ``CELERY_TASK_PLUS_LOCK_REDIS_URL``
+    is set, otherwise the Django cache client (when using django-redis) or
+    ``REDIS_URL``.
+    """
+    global _lock_client
+    pid = os.getpid()
+    client_pid, client = _lock_client
+    if client_pid == pid:
+        return client
+    with _lock_client_lock:
+        client_pid, client = _lock_client
+        if client_pid != pid:
+            client = _create_lock_client()
+            _lock_client = (pid, client)
+        return client
+
+
+def get_owner_id():
+    """
+    Return the lock owner id for the current process, including a random nonce
+    so processes that reuse a pid (e.g. in containers) get different ids.
+    """
+    global _owner_id
+    pid = os.getpid()
+    owner_pid, owner_id = _owner_id
+    if owner_pid != pid:
+        owner_id = urllib.parse.urlencode([
+            ('hostname', socket.gethostname()),
+            ('pid', pid),
+            ('nonce', uuid.uuid4().hex[:16]),
+        ]).encode('utf-8')
+        _owner_id = (pid, owner_id)
+    return owner_id
+
+
+class RedisScript(object):
+    """
+    Lua script that can be run against any Redis client, registered the first
+    time it is used.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self._script = None
+
+    def __call__(self, redis_client, keys=(), args=()):
+        if self._script is None:
+            self._script = redis_client.register_script(self.source)
+        return self._script(keys=keys, args=args, client=redis_client)
+
+
+@worker_process_init.connect
+def reset_lock_client(**kwargs):
+    """
+    Discard the lock client and owner id inherited from a parent process.
+    """
+    global _lock_client, _owner_id
+    _lock_client = (None, None)
+    _owner_id = (None, None)
@@ -0,0 +1,87 @@
+# Python
+import base64
+import lzma
+import zlib
+
+# Django
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage, get_storage_class
+from django.db.models import Q
+
+__all__ = ['encode_stored_content', 'decode_stored_content', 'delete_stored_content']
+
+# Stored content starting with this prefix has been compressed or spilled to a
+# file. Neither JSON nor base64 encoded content can start with it.
+_prefix = 'ctp:'
+_spill_prefix = _prefix + 'file:'
+
+_compressors = {
+    'zlib': (zlib.compress, zlib.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
+}
+
+
+def _get_spill_storage():
+    storage_class = getattr(settings, 'CELERY_TASK_PLUS_RESULT_SPILL_STORAGE', None)
+    if storage_class:
+        return get_storage_class(storage_class)()
+    return default_storage
+
+
+def _is_spill_enabled():
+    return getattr(settings, 'CELERY_TASK_PLUS_RESULT_SPILL_THRESHOLD', None) is not None
+
+
+def _get_spilled_filter():
+    # Return the filter for task results with a result or traceback spilled to
+    # a file.
+    return Q(result__startswith=_spill_prefix) | Q(traceback__startswith=_spill_prefix)
+
+
+def encode_stored_content(content, task_id, field_name):
+    """
+    Compress a serialized result or traceback larger than
+    CELERY_TASK_PLUS_RESULT_COMPRESSION_THRESHOLD using the method from
+    CELERY_TASK_PLUS_RESULT_COMPRESSION, and spill it to a file when it's still
+    larger than CELERY_TASK_PLUS_RESULT_SPILL_THRESHOLD.
+    """
+    if not isinstance(content, str):
+        return content
+    compression = getattr(settings, 'CELERY_TASK_PLUS_RESULT_COMPRESSION', None)
+    compression_threshold = getattr(settings, 'CELERY_TASK_PLUS_RESULT_COMPRESSION_THRESHOLD', 16384)
+    if compression and len(content) > compression_threshold:
+        compress = _compressors[compression][0]
+        compressed_content = base64.b64encode(compress(content.encode('utf-8'))).decode('ascii')
+        content = '{}{}:{}'.format(_prefix, compression, compressed_content)
+    spill_threshold = getattr(settings, 'CELERY_TASK_PLUS_RESULT_SPILL_THRESHOLD', None)
+    if spill_threshold is not None and len(content) > spill_threshold:
+        storage = _get_spill_storage()
+        name = 'celery_task_plus/results/{}/{}'.format(task_id, field_name)
+        storage.delete(name)
+        name = storage.save(name, ContentFile(content.encode('utf-8')))
+        content = '{}file:{}'.format(_prefix, name)
+    return content
+
+
+def decode_stored_content(content):
+    """
+    Return the original content for content encoded by encode_stored_content.
+    """
+    if not isinstance(content, str) or not content.startswith(_prefix):
+        return content
+    method, _, value = content[len(_prefix):].partition(':')
+    if method == 'file':
+        with _get_spill_storage().open(value, 'rb') as f:
+            return decode_stored_content(f.read().decode('utf-8'))
+    decompress = _compressors[method][1]
+    return decompress(base64.b64decode(value)).decode('utf-8')
+
+
+def delete_stored_content(content):
+    """
+    Delete the file that content encoded by encode_stored_content was spilled
+    to, if any.
+    """
+    if isinstance(content, str) and content.startswith(_spill_prefix):
+        _get_spill_storage().delete(content[len(_spill_prefix):])
@@ -0,0 +1,175 @@
+# Python
+import hashlib
+import json
+import re
+
+# Django
+from django.utils.text import slugify
+
+__all__ = ['TaskKeyPlan']
+
+# Keys matching this pattern are returned unchanged by slugify() (other than
+# being lowercased), so the slow path can be skipped for them.
+_safe_task_key_re = re.compile(r'[A-Za-z0-9]+(?:-[A-Za-z0-9]+)*\Z')
+
+_max_task_key_length = 250
+
+_task_key_digest_size = 16
+
+
+def _encode_fast(value):
+    # Return the slugified form of json.dumps(value) for simple values, or None
+    # if the value must go through the slow path.
+    value_type = type(value)
+    if value_type is str:
+        return value.replace('.', '-').replace('_', '-')
+    elif value_type is int:
+        return str(value)
+    elif value is None:
+        return 'null'
+    elif value is True:
+        return 'true'
+    elif value is False:
+        return 'false'
+    return None
+
+
+def _sort_dict_keys(value):
+    # Return value with the items of all dicts ordered by the type name and
+    # string form of their keys, which works for keys of mixed types.
+    value_type = type(value)
+    if value_type is dict:
+        items = sorted(value.items(), key=lambda item: (type(item[0]).__name__, str(item[0])))
+        return {k: _sort_dict_keys(v) for k, v in items}
+    elif value_type is list or value_type is tuple:
+        return [_sort_dict_keys(v) for v in value]
+    return value
+
+
+class TaskKeyPlan(object):
+    """
+    Precompiled task key configuration for a task class, used to build task
+    keys without reinterpreting the task key options on every call.
+    """
+
+    def __init__(self, name, key_name=True, key_args=True, key_kwargs=True, key_hash=False):
+        self.config = (name, key_name, key_args, key_kwargs, key_hash)
+        self.key_hash = bool(key_hash)
+        if key_name is True:
+            self.name = '{}'.format(name)
+        else:
+            self.name = '{}'.format(key_name or '')
+        self.name_prefix = self.name.replace('.', '-').replace('_', '-')
+        if key_args is True:
+            self.args_slice = slice(None)
+        elif isinstance(key_args, int) and key_args is not False:
+            self.args_slice = slice(None, key_args)
+        else:
+            self.args_slice = None
+        if not key_kwargs:
+            self.all_kwargs = False
+            self.kwargs_keys = ()
+        elif key_kwargs is True:
+            self.all_kwargs = True
+            self.kwargs_keys = ()
+        elif isinstance(key_kwargs, str):
+            self.all_kwargs = False
+            self.kwargs_keys = (key_kwargs,)
+        else:
+            self.all_kwargs = False
+            self.kwargs_keys = tuple(sorted(key_kwargs))
+        self.kwargs_prefixes = {k: k.replace('.', '-').replace('_', '-') for k in self.kwargs_keys}
+        self.key_prefix = slugify(self.name_prefix)
+
+    @classmethod
+    def for_task(cls, task):
+        return cls(task.name, task.task_key_name, task.task_key_args, task.task_key_kwargs, task.task_key_hash)
+
+    @classmethod
+    def for_spec(cls, task, spec):
+        """
+        Return the plan for a dict of task_key_* options, using the task's own
+        options for any that aren't given.
+        """
+        return cls(
+            task.name,
+            spec.get('task_key_name', task.task_key_name),
+            spec.get('task_key_args', task.task_key_args),
+            spec.get('task_key_kwargs', task.task_key_kwargs),
+            spec.get('task_key_hash', task.task_key_hash),
+        )
+
+    def matches(self, task):
+        return self.config == (task.name, task.task_key_name, task.task_key_args, task.task_key_kwargs, task.task_key_hash)
+
+    def select(self, args, kwargs):
+        """
+        Return the positional arguments and sorted (key, value) pairs of keyword
+        arguments included in the task key.
+        """
+        key_args = args[self.args_slice] if self.args_slice is not None else ()
+        if self.all_kwargs:
+            key_kwargs = [(k, kwargs[k]) for k in sorted(kwargs)]
+        elif self.kwargs_keys and kwargs:
+            key_kwargs = [(k, kwargs[k]) for k in self.kwargs_keys if k in kwargs]
+        else:
+            key_kwargs = []
+        return key_args, key_kwargs
+
+    def build(self, args, kwargs):
+        key_args, key_kwargs = self.select(args, kwargs)
+        if self.key_hash:
+            return self._build_hashed(key_args, key_kwargs)
+        return self._build_fast(key_args, key_kwargs) or self._build_slow(key_args, key_kwargs)
+
+    def describe(self, args, kwargs):
+        """
+        Return the canonical serialization of the arguments included in the
+        task key (the input to the digest for hashed task keys).
+        """
+        key_args, key_kwargs = self.select(args, kwargs)
+        return self._canonicalize(key_args, key_kwargs)
+
+    def _canonicalize(self, key_args, key_kwargs):
+        value = [list(key_args), dict(key_kwargs)]
+        try:
+            return json.dumps(value, sort_keys=True, separators=(',', ':'))
+        except TypeError:
+            # Dicts with keys of mixed types (e.g. {1: 'a', 'b': 2}) can't be
+            # sorted by json.dumps().
+            return json.dumps(_sort_dict_keys(value), separators=(',', ':'))
+
+    def _build_hashed(self, key_args, key_kwargs):
+        canonical = self._canonicalize(key_args, key_kwargs).encode('utf-8')
+        digest = hashlib.blake2b(canonical, digest_size=_task_key_digest_size).hexdigest()
+        return '{}:{}'.format(self.key_prefix, digest)
+
+    def _build_fast(self, key_args, key_kwargs):
+        parts = [self.name_prefix]
+        for value in key_args:
+            encoded_value = _encode_fast(value)
+            if encoded_value is None:
+                return None
+            parts.append(encoded_value)
+        for k, value in key_kwargs:
+            encoded_value = _encode_fast(value)
+            if encoded_value is None:
+                return None
+            prefix = self.kwargs_prefixes.get(k)
+            if prefix is None:
+                prefix = k.replace('.', '-').replace('_', '-')
+            parts.append(prefix + encoded_value)
+        task_key = '-'.join(parts)
+        if _safe_task_key_re.match(task_key):
+            return task_key.lower()[:_max_task_key_length]
+        return None
+
+    def _build_slow(self, key_args, key_kwargs):
+        task_key_args = [json.dumps(a) for a in key_args]
+        task_key_args.extend(['{}={}'.format(k, json.dumps(v)) for k, v in key_kwargs])
+        if task_key_args:
+            task_key = '{}-{}'.format(self.name, '-'.join(task_key_args))
+        else:
+            task_key = self.name
+        task_key = task_key.replace('.', '-').replace('_', '-')
+        return slugify(task_key)[:_max_task_key_length]
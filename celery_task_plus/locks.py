@@ -0,0 +1,1098 @@
+# Python
+import collections
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+import weakref
+
+# Django
+from django.conf import settings
+
+# Celery-Task-Plus
+from .clients import RedisScript
+from . import metrics
+
+logger = logging.getLogger('celery_task_plus.locks')
+
+__all__ = [
+    'Lock', 'LockRenewer', 'MultiLock', 'Semaphore', 'NotAcquired', 'get_lock_heartbeat_interval', 'get_lock_renewer',
+    'get_tuned_lock_expire', 'record_lock_hold', 'acquire_lock_in_order', 'notify_lock_waiter', 'set_pending_task',
+    'clear_pending_task', 'check_rate_limit', 'park_task', 'pop_parked_task', 'iter_parked_task_names', 'reap_stale_locks',
+    'iter_held_locks', 'force_release_lock', 'force_release_locks',
+]
+
+# Seconds to keep the signal for a waiter that was handed the lock.
+_waiter_signal_expire = 60
+
+# Seconds a waiter's lease outlives its longest wait, after which releases skip
+# its token (e.g. when the waiter process died).
+_waiter_lease_margin = 5
+
+# Process-wide lock renewer, stored as a (pid, renewer) tuple so a forked child
+# never uses the thread started by its parent.
+_lock_renewer = (None, None)
+_lock_renewer_lock = threading.Lock()
+
+# Sorted set of lock owners scored by their last heartbeat, and how long to
+# keep the keys held by each owner (see LockRenewer.heartbeat).
+_lock_owners_key = 'lock-owners'
+_lock_owner_keys_expire = 3600
+
+# Moving average of lock hold times (in seconds) by name, see record_lock_hold.
+_lock_hold_times = {}
+_lock_hold_weight = 0.2
+
+# Acquire the lock, returning {1} or {0, <current owner id>}. The lock is not
+# acquired while shared locks (see MultiLock) of the same name are held.
+_acquire_lock_script = RedisScript("""
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    local time = redis.call('TIME')
+    redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', time[1] * 1000 + math.floor(time[2] / 1000))
+    local shared_owner_ids = redis.call('ZRANGE', KEYS[2], 0, 0)
+    if shared_owner_ids[1] then
+        return {0, shared_owner_ids[1]}
+    end
+end
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2]) then
+    return {1}
+end
+return {0, redis.call('GET', KEYS[1])}
+""")
+
+# Acquire all or none of the locks, given as (lock, shared lock) key pairs, in
+# exclusive (ARGV[3] == '0') or shared mode. Shared locks are stored as sorted
+# set members scored by their expiry time, so the locks of lost owners are
+# ignored once they expire.
+_acquire_multi_lock_script = RedisScript("""
+local time = redis.call('TIME')
+local now = time[1] * 1000 + math.floor(time[2] / 1000)
+local shared = ARGV[3] == '1'
+for i = 1, #KEYS, 2 do
+    local owner_id = redis.call('GET', KEYS[i])
+    if owner_id then
+        return {0, owner_id}
+    end
+    if not shared then
+        redis.call('ZREMRANGEBYSCORE', KEYS[i + 1], '-inf', now)
+        local shared_owner_ids = redis.call('ZRANGE', KEYS[i + 1], 0, 0)
+        if shared_owner_ids[1] then
+            return {0, shared_owner_ids[1]}
+        end
+    end
+end
+local expire_ms = ARGV[2] * 1000
+for i = 1, #KEYS, 2 do
+    if shared then
+        redis.call('ZADD', KEYS[i + 1], now + expire_ms, ARGV[4])
+        if redis.call('PTTL', KEYS[i + 1]) < expire_ms then
+            redis.call('PEXPIRE', KEYS[i + 1], expire_ms)
+        end
+    else
+        redis.call('SET', KEYS[i], ARGV[1], 'EX', ARGV[2])
+    end
+end
+return {1}
+""")
+
+_extend_multi_lock_script = RedisScript("""
+local time = redis.call('TIME')
+local now = time[1] * 1000 + math.floor(time[2] / 1000)
+local shared = ARGV[3] == '1'
+local expire_ms = ARGV[2] * 1000
+for i = 1, #KEYS, 2 do
+    if shared then
+        if not redis.call('ZSCORE', KEYS[i + 1], ARGV[4]) then
+            return 0
+        end
+    elseif redis.call('GET', KEYS[i]) ~= ARGV[1] then
+        return 0
+    end
+end
+for i = 1, #KEYS, 2 do
+    if shared then
+        redis.call('ZADD', KEYS[i + 1], now + expire_ms, ARGV[4])
+        if redis.call('PTTL', KEYS[i + 1]) < expire_ms then
+            redis.call('PEXPIRE', KEYS[i + 1], expire_ms)
+        end
+    else
+        redis.call('EXPIRE', KEYS[i], ARGV[2])
+    end
+end
+return 1
+""")
+
+# Release the locks, given as (lock, shared lock, signal) key triples, and
+# signal waiters. Returns the number of locks that were still held.
+_release_multi_lock_script = RedisScript("""
+local shared = ARGV[3] == '1'
+local released = 0
+for i = 1, #KEYS, 3 do
+    if shared then
+        released = released + redis.call('ZREM', KEYS[i + 1], ARGV[4])
+    elseif redis.call('GET', KEYS[i]) == ARGV[1] then
+        released = released + redis.call('DEL', KEYS[i])
+    end
+    redis.call('DEL', KEYS[i + 2])
+    redis.call('RPUSH', KEYS[i + 2], 1)
+    redis.call('PEXPIRE', KEYS[i + 2], ARGV[2])
+end
+return released
+""")
+
+_extend_lock_script = RedisScript("""
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+return redis.call('EXPIRE', KEYS[1], ARGV[2])
+""")
+
+# Release the lock and signal waiters. When a queue key is given, also hand the
+# lock to the waiter at the head of the queue (see notify_lock_waiter).
+_release_lock_script = RedisScript("""
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1], KEYS[2])
+redis.call('RPUSH', KEYS[2], 1)
+redis.call('PEXPIRE', KEYS[2], ARGV[2])
+if KEYS[3] then
+    while true do
+        local token = redis.call('LPOP', KEYS[3])
+        if not token then
+            break
+        end
+        if redis.call('EXISTS', ARGV[5] .. token) == 1 then
+            local waiter_key = ARGV[3] .. token
+            redis.call('RPUSH', waiter_key, 1)
+            redis.call('EXPIRE', waiter_key, ARGV[4])
+            break
+        end
+    end
+end
+return 1
+""")
+
+# Signal the first waiter queued in KEYS[1] whose lease (ARGV[3] .. token)
+# still exists, dropping the tokens of waiters that are gone. Returns the token
+# signalled, or false if there is none.
+_notify_lock_waiter_script = RedisScript("""
+while true do
+    local token = redis.call('LPOP', KEYS[1])
+    if not token then
+        return false
+    end
+    if redis.call('EXISTS', ARGV[3] .. token) == 1 then
+        local waiter_key = ARGV[1] .. token
+        redis.call('RPUSH', waiter_key, 1)
+        redis.call('EXPIRE', waiter_key, ARGV[2])
+        return token
+    end
+end
+""")
+
+_set_pending_task_script = RedisScript("""
+local pending_task_id = redis.call('GET', KEYS[1])
+if pending_task_id then
+    return pending_task_id
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return false
+""")
+
+# Acquire a lease of one of ARGV[3] slots, after removing expired leases.
+# Returns {acquired, slots used, expired leases removed}.
+_acquire_semaphore_script = RedisScript("""
+local time = redis.call('TIME')
+local now = time[1] * 1000 + math.floor(time[2] / 1000)
+local removed = redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+local used = redis.call('ZCARD', KEYS[1])
+if used >= tonumber(ARGV[3]) then
+    return {0, used, removed}
+end
+local expire_ms = ARGV[2] * 1000
+redis.call('ZADD', KEYS[1], now + expire_ms, ARGV[1])
+if redis.call('PTTL', KEYS[1]) < expire_ms then
+    redis.call('PEXPIRE', KEYS[1], expire_ms)
+end
+return {1, used + 1, removed}
+""")
+
+_extend_semaphore_script = RedisScript("""
+if not redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    return 0
+end
+local time = redis.call('TIME')
+local expire_ms = ARGV[2] * 1000
+redis.call('ZADD', KEYS[1], time[1] * 1000 + math.floor(time[2] / 1000) + expire_ms, ARGV[1])
+if redis.call('PTTL', KEYS[1]) < expire_ms then
+    redis.call('PEXPIRE', KEYS[1], expire_ms)
+end
+return 1
+""")
+
+_release_semaphore_script = RedisScript("""
+local released = redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('DEL', KEYS[2])
+redis.call('RPUSH', KEYS[2], 1)
+redis.call('PEXPIRE', KEYS[2], ARGV[2])
+return released
+""")
+
+# Generic cell rate algorithm: KEYS[1] stores the theoretical arrival time (in
+# milliseconds) of the next call. Returns 0 if the call is allowed, otherwise
+# the milliseconds to wait before it would be.
+_rate_limit_script = RedisScript("""
+local time = redis.call('TIME')
+local now = time[1] * 1000 + time[2] / 1000
+local interval = tonumber(ARGV[1])
+local tat = math.max(tonumber(redis.call('GET', KEYS[1])) or now, now)
+local allow_at = tat + interval - interval * tonumber(ARGV[2])
+if now < allow_at then
+    return math.ceil(allow_at - now)
+end
+redis.call('SET', KEYS[1], tostring(tat + interval), 'PX', math.ceil(tat + interval - now))
+return 0
+""")
+
+_clear_pending_task_script = RedisScript("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+# Park a task message (ARGV[2], for the task id ARGV[1]) in KEYS[2] while the
+# lock (KEYS[1]) is held, while a parked task that was sent (its task id is in
+# KEYS[3]) hasn't released the lock yet, or behind tasks already parked. A task
+# parked again (ARGV[4] is 1) goes back to the head of the list. Returns
+# {parked, locked}; a task parked while the lock is free means the next parked
+# task should be sent.
+_park_task_script = RedisScript("""
+local locked = redis.call('EXISTS', KEYS[1]) == 1
+local sent_task_id = redis.call('GET', KEYS[3])
+if sent_task_id == ARGV[1] then
+    if not locked then
+        return {0, 0}
+    end
+    redis.call('DEL', KEYS[3])
+elseif sent_task_id then
+    locked = true
+end
+if not locked and redis.call('EXISTS', KEYS[2]) == 0 then
+    return {0, 0}
+end
+if ARGV[4] == '1' then
+    redis.call('LPUSH', KEYS[2], ARGV[1] .. ' ' .. ARGV[2])
+else
+    redis.call('RPUSH', KEYS[2], ARGV[1] .. ' ' .. ARGV[2])
+end
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return {1, locked and 1 or 0}
+""")
+
+# Remove and return the next parked task message (KEYS[2]), recording its task
+# id as sent (KEYS[3], for ARGV[1] seconds). Unless the lock was just released
+# (ARGV[2] is 1), nothing is removed while the lock (KEYS[1]) is held or a task
+# sent before hasn't released it yet.
+_pop_parked_task_script = RedisScript("""
+if ARGV[2] ~= '1' and (redis.call('EXISTS', KEYS[1]) == 1 or redis.call('EXISTS', KEYS[3]) == 1) then
+    return false
+end
+local message = redis.call('LPOP', KEYS[2])
+if not message then
+    redis.call('DEL', KEYS[3])
+    return false
+end
+redis.call('SET', KEYS[3], string.match(message, '^%S+'), 'EX', ARGV[1])
+return message
+""")
+
+# Record a heartbeat for the owner ARGV[1] in the owners sorted set (KEYS[1],
+# scored by Redis time in milliseconds), and replace the hash of lock keys it
+# holds (KEYS[2], mapping each key to "<acquired time in ms>|<the owner's
+# value or member>", kept for ARGV[2] seconds) with ARGV[3:]. Owners without a
+# heartbeat for ARGV[2] seconds are removed from the sorted set.
+_lock_heartbeat_script = RedisScript("""
+local time = redis.call('TIME')
+local now = time[1] * 1000 + math.floor(time[2] / 1000)
+redis.call('ZADD', KEYS[1], now, ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - tonumber(ARGV[2]) * 1000)
+redis.call('DEL', KEYS[2])
+if #ARGV > 2 then
+    redis.call('HSET', KEYS[2], unpack(ARGV, 3))
+    redis.call('EXPIRE', KEYS[2], ARGV[2])
+end
+return 1
+""")
+
+# Return the owners (KEYS[1]) without a heartbeat in the last ARGV[1] ms.
+_get_stale_lock_owners_script = RedisScript("""
+local time = redis.call('TIME')
+local now = time[1] * 1000 + math.floor(time[2] / 1000)
+return redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now - tonumber(ARGV[1]))
+""")
+
+# Unless the owner ARGV[1] recorded a heartbeat in the last ARGV[2] ms, forget
+# it and its lock keys (KEYS[2]), then release each lock key or remove each
+# sorted set member it held (KEYS[3:] as (key, signal key) pairs, ARGV[4:] as
+# (member, is sorted set) pairs) and signal waiters. Returns the number of
+# locks released, or -1 if the owner is not stale.
+_reap_lock_owner_script = RedisScript("""
+local time = redis.call('TIME')
+local now = time[1] * 1000 + math.floor(time[2] / 1000)
+local score = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if not score or tonumber(score) > now - tonumber(ARGV[2]) then
+    return -1
+end
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('DEL', KEYS[2])
+local released = 0
+for i = 3, #KEYS, 2 do
+    local member = ARGV[i + 1]
+    local removed = 0
+    if ARGV[i + 2] == '1' then
+        removed = redis.call('ZREM', KEYS[i], member)
+    elseif redis.call('GET', KEYS[i]) == member then
+        redis.call('DEL', KEYS[i])
+        removed = 1
+    end
+    if removed == 1 then
+        redis.call('DEL', KEYS[i + 1])
+        redis.call('RPUSH', KEYS[i + 1], 1)
+        redis.call('PEXPIRE', KEYS[i + 1], ARGV[3])
+        released = released + 1
+    end
+end
+return released
+""")
+
+# Release a lock key (KEYS[1]) if still held by ARGV[1], or remove the sorted
+# set member ARGV[1] (when ARGV[3] is '1'), and signal waiters (KEYS[2]).
+_force_release_lock_script = RedisScript("""
+local released = 0
+if ARGV[3] == '1' then
+    released = redis.call('ZREM', KEYS[1], ARGV[1])
+elseif redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+    released = 1
+end
+if released == 1 then
+    redis.call('DEL', KEYS[2])
+    redis.call('RPUSH', KEYS[2], 1)
+    redis.call('PEXPIRE', KEYS[2], ARGV[2])
+end
+return released
+""")
+
+
+class NotAcquired(RuntimeError):
+    pass
+
+
+class Lock(object):
+    """
+    Redis lock where acquire, extend and release are each a single scripted
+    call. Uses the same keys as python-redis-lock ("lock:<name>" and
+    "lock-signal:<name>"), so both can lock the same names.
+
+    After a failed acquire, last_owner_id is the id of the owner holding the
+    lock at that time. Renewals are recorded with the metric_labels.
+    """
+
+    def __init__(self, redis_client, name, id=None, expire=60, auto_renewal=False, signal_expire=1000):
+        self._client = redis_client
+        self.name = name
+        self.id = id or uuid.uuid4().hex.encode('utf-8')
+        if isinstance(self.id, str):
+            self.id = self.id.encode('utf-8')
+        self.expire = int(math.ceil(expire))
+        self.auto_renewal = auto_renewal
+        self.signal_expire = signal_expire
+        self.last_owner_id = None
+        self.acquired_at = None
+        self.metric_labels = {}
+        self._lock_key = 'lock:{}'.format(name)
+        self._shared_key = 'lock-shared:{}'.format(name)
+        self._signal_key = 'lock-signal:{}'.format(name)
+        self._signal_keys = [self._signal_key]
+
+    def get_owner_id(self):
+        return self._client.get(self._lock_key)
+
+    def _get_owned_keys(self):
+        # Return the keys held by this lock, mapped to the value or sorted set
+        # member identifying this owner (see LockRenewer.heartbeat).
+        return {self._lock_key: self.id}
+
+    def locked(self):
+        return bool(self._client.exists(self._lock_key))
+
+    def _try_acquire(self):
+        result = _acquire_lock_script(self._client, keys=[self._lock_key, self._shared_key], args=[self.id, self.expire])
+        if result[0]:
+            self.last_owner_id = None
+            return True
+        self.last_owner_id = result[1]
+        return False
+
+    def acquire(self, blocking=True, timeout=None):
+        """
+        Acquire the lock, waiting (when blocking) up to timeout seconds, or
+        indefinitely if timeout is None.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._try_acquire():
+            if not blocking:
+                return False
+            if deadline is None:
+                wait = self.expire
+            else:
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    return False
+            self._client.blpop(self._signal_keys, timeout=max(1, int(math.ceil(min(wait, self.expire)))))
+        self.acquired_at = time.time()
+        if self.auto_renewal:
+            get_lock_renewer().add(self)
+        return True
+
+    def _extend(self, redis_client):
+        # Run the extend script with the given client (or queue it when given a
+        # pipeline).
+        return _extend_lock_script(redis_client, keys=[self._lock_key], args=[self.id, self.expire])
+
+    def extend(self, expire=None):
+        if expire is not None:
+            self.expire = int(math.ceil(expire))
+        if not self._extend(self._client):
+            raise NotAcquired('Lock {} is not acquired or it already expired.'.format(self.name))
+        metrics.incr('lock_renewed', **self.metric_labels)
+
+    def release(self, notify_waiter=False):
+        """
+        Release the lock. With notify_waiter, also wake the next waiter queued
+        by acquire_lock_in_order in the same call.
+        """
+        if self.auto_renewal:
+            get_lock_renewer().remove(self)
+        keys = [self._lock_key, self._signal_key]
+        args = [self.id, self.signal_expire]
+        if notify_waiter:
+            keys.append(_get_queue_key(self.name))
+            args.extend([_get_waiter_key(''), _waiter_signal_expire, _get_waiter_lease_key('')])
+        if not _release_lock_script(self._client, keys=keys, args=args):
+            raise NotAcquired('Lock {} is not acquired or it already expired.'.format(self.name))
+
+
+class MultiLock(Lock):
+    """
+    Lock for several names at once, acquired atomically (all or none) in sorted
+    name order. Shared locks of the same names can be held at the same time,
+    but exclude exclusive locks (including single name Locks) and vice versa.
+    """
+
+    def __init__(self, redis_client, names, id=None, expire=60, auto_renewal=False, signal_expire=1000, shared=False):
+        self.names = sorted(set(names))
+        super().__init__(redis_client, ','.join(self.names), id=id, expire=expire, auto_renewal=auto_renewal, signal_expire=signal_expire)
+        self.shared = bool(shared)
+        # Shared locks are held per acquisition, since the owner id is shared by
+        # all threads in a process.
+        self._shared_owner_id = b'#'.join([self.id, uuid.uuid4().hex.encode('utf-8')])
+        self._lock_keys = []
+        self._release_keys = []
+        for name in self.names:
+            lock_key = 'lock:{}'.format(name)
+            shared_key = 'lock-shared:{}'.format(name)
+            signal_key = 'lock-signal:{}'.format(name)
+            self._lock_keys.extend([lock_key, shared_key])
+            self._release_keys.extend([lock_key, shared_key, signal_key])
+        self._signal_keys = self._release_keys[2::3]
+
+    def _get_args(self):
+        return [self.id, self.expire, int(self.shared), self._shared_owner_id]
+
+    def get_owner_id(self):
+        return self._client.get(self._lock_keys[0])
+
+    def _get_owned_keys(self):
+        if self.shared:
+            return {key: self._shared_owner_id for key in self._lock_keys[1::2]}
+        return {key: self.id for key in self._lock_keys[0::2]}
+
+    def locked(self):
+        return bool(self._client.exists(*self._lock_keys[0::2]))
+
+    def _try_acquire(self):
+        result = _acquire_multi_lock_script(self._client, keys=self._lock_keys, args=self._get_args())
+        if result[0]:
+            self.last_owner_id = None
+            return True
+        self.last_owner_id = result[1]
+        return False
+
+    def _extend(self, redis_client):
+        return _extend_multi_lock_script(redis_client, keys=self._lock_keys, args=self._get_args())
+
+    def release(self, notify_waiter=False):
+        """
+        Release the locks. Waiters queued with acquire_lock_in_order are not
+        supported.
+        """
+        if self.auto_renewal:
+            get_lock_renewer().remove(self)
+        args = [self.id, self.signal_expire, int(self.shared), self._shared_owner_id]
+        if not _release_multi_lock_script(self._client, keys=self._release_keys, args=args):
+            raise NotAcquired('Lock {} is not acquired or it already expired.'.format(self.name))
+
+
+class Semaphore(Lock):
+    """
+    Counting semaphore allowing up to limit holders of the name at once. Each
+    holder has a lease that expires unless renewed, so slots held by lost
+    workers are freed once their leases expire.
+
+    After an acquire, slots_used is the number of slots in use and
+    stale_released the number of expired leases that were removed.
+    """
+
+    def __init__(self, redis_client, name, limit, id=None, expire=60, auto_renewal=False, signal_expire=1000):
+        super().__init__(redis_client, name, id=id, expire=expire, auto_renewal=auto_renewal, signal_expire=signal_expire)
+        self.limit = int(limit)
+        self.slots_used = 0
+        self.stale_released = 0
+        self._lease_id = b'#'.join([self.id, uuid.uuid4().hex.encode('utf-8')])
+        self._semaphore_key = 'semaphore:{}'.format(name)
+        self._signal_key = 'semaphore-signal:{}'.format(name)
+        self._signal_keys = [self._signal_key]
+
+    def get_owner_id(self):
+        return None
+
+    def _get_owned_keys(self):
+        return {self._semaphore_key: self._lease_id}
+
+    def locked(self):
+        return self._client.zcard(self._semaphore_key) >= self.limit
+
+    def _try_acquire(self):
+        args = [self._lease_id, self.expire, self.limit]
+        acquired, self.slots_used, self.stale_released = _acquire_semaphore_script(self._client, keys=[self._semaphore_key], args=args)
+        return bool(acquired)
+
+    def _extend(self, redis_client):
+        return _extend_semaphore_script(redis_client, keys=[self._semaphore_key], args=[self._lease_id, self.expire])
+
+    def release(self, notify_waiter=False):
+        if self.auto_renewal:
+            get_lock_renewer().remove(self)
+        args = [self._lease_id, self.signal_expire]
+        if not _release_semaphore_script(self._client, keys=[self._semaphore_key, self._signal_key], args=args):
+            raise NotAcquired('Semaphore {} is not acquired or its lease already expired.'.format(self.name))
+
+
+class LockRenewer(object):
+    """
+    Renews the locks acquired with auto_renewal in the current process from a
+    single thread. Each lock is renewed after two thirds of its expiry, and
+    all the locks due within batch_window seconds are renewed together with one
+    pipelined call per Redis client.
+
+    With a heartbeat_interval, the same thread also records a heartbeat and the
+    held lock keys of the lock owners in this process at most every
+    heartbeat_interval seconds while they hold locks (and once more after the
+    last one is removed), so the locks of dead owners can be released by
+    reap_stale_locks.
+    """
+
+    def __init__(self, batch_window=1.0, heartbeat_interval=None):
+        self.batch_window = batch_window
+        self.heartbeat_interval = heartbeat_interval
+        # Locks mapped to their next renewal time. Only weak references are
+        # kept, so a lock that is never released is not renewed forever.
+        self._locks = weakref.WeakKeyDictionary()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._next_heartbeat = 0
+        # Redis clients by owner id for the owners that held locks at the last
+        # heartbeat.
+        self._heartbeat_clients = {}
+
+    def add(self, lock):
+        with self._condition:
+            self._locks[lock] = time.monotonic() + lock.expire * 2 / 3
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='celery-task-plus-lock-renewer', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def remove(self, lock):
+        with self._condition:
+            self._locks.pop(lock, None)
+            if not self._locks and self._heartbeat_clients:
+                self._condition.notify()
+
+    def _is_heartbeat_due(self, now):
+        if self.heartbeat_interval is None or self._next_heartbeat > now:
+            return False
+        return bool(self._locks or self._heartbeat_clients)
+
+    def _get_due_locks(self):
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                next_renewal = min(self._locks.values(), default=None)
+                if next_renewal is not None and next_renewal <= now + self.batch_window:
+                    break
+                if self._is_heartbeat_due(now):
+                    break
+                wait = None if next_renewal is None else next_renewal - now
+                if self.heartbeat_interval is not None and (self._locks or self._heartbeat_clients):
+                    wait = self._next_heartbeat - now if wait is None else min(wait, self._next_heartbeat - now)
+                self._condition.wait(wait)
+            due_locks = [lock for lock, t in self._locks.items() if t <= now + self.batch_window]
+            for lock in due_locks:
+                self._locks[lock] = now + lock.expire * 2 / 3
+            return due_locks
+
+    def _run(self):
+        while True:
+            due_locks = self._get_due_locks()
+            try:
+                if due_locks:
+                    self.renew(due_locks)
+            except Exception:
+                logger.exception('Error renewing locks')
+            finally:
+                del due_locks
+            if self._is_heartbeat_due(time.monotonic()):
+                try:
+                    self.heartbeat()
+                except Exception:
+                    logger.exception('Error recording lock owner heartbeat')
+
+    def heartbeat(self):
+        """
+        Record a heartbeat and the held lock keys for each lock owner with
+        locks in this process, with one pipelined call per Redis client. Owners
+        that no longer hold locks are recorded once more without keys.
+        """
+        with self._condition:
+            self._next_heartbeat = time.monotonic() + (self.heartbeat_interval or 0)
+            locks = list(self._locks.keys())
+            owners = collections.OrderedDict()
+            for lock in locks:
+                acquired_at = lock.acquired_at or time.time()
+                owned_keys = {key: (acquired_at, member) for key, member in lock._get_owned_keys().items()}
+                owners.setdefault(lock.id, (lock._client, {}))[1].update(owned_keys)
+            for owner_id, redis_client in self._heartbeat_clients.items():
+                owners.setdefault(owner_id, (redis_client, {}))
+            self._heartbeat_clients = {owner_id: owner[0] for owner_id, owner in owners.items() if owner[1]}
+        owners_by_client = collections.OrderedDict()
+        for owner_id, (redis_client, keys) in owners.items():
+            owners_by_client.setdefault(id(redis_client), (redis_client, []))[1].append((owner_id, keys))
+        for redis_client, client_owners in owners_by_client.values():
+            with redis_client.pipeline(transaction=False) as pipe:
+                for owner_id, keys in client_owners:
+                    args = [owner_id, _lock_owner_keys_expire]
+                    for key, (acquired_at, member) in keys.items():
+                        args.extend([key, b'%d|%s' % (int(acquired_at * 1000), member)])
+                    _lock_heartbeat_script(pipe, keys=[_lock_owners_key, _get_lock_owner_key(owner_id)], args=args)
+                pipe.execute()
+
+    def renew(self, locks):
+        """
+        Extend the given locks, with one pipelined call per Redis client.
+        Locks that have been lost are no longer renewed.
+        """
+        locks_by_client = collections.OrderedDict()
+        for lock in locks:
+            locks_by_client.setdefault(id(lock._client), []).append(lock)
+        renewed = collections.Counter()
+        for client_locks in locks_by_client.values():
+            with client_locks[0]._client.pipeline(transaction=False) as pipe:
+                for lock in client_locks:
+                    lock._extend(pipe)
+                results = pipe.execute()
+            for lock, result in zip(client_locks, results):
+                if result:
+                    renewed[tuple(sorted(lock.metric_labels.items()))] += 1
+                    continue
+                with self._condition:
+                    # Ignore locks released while being renewed.
+                    if self._locks.pop(lock, None) is None:
+                        continue
+                logger.warning('Unable to renew lock: %s', lock.name)
+        for metric_labels, count in renewed.items():
+            metrics.incr('lock_renewed', count, **dict(metric_labels))
+
+
+def get_lock_heartbeat_interval():
+    """
+    Return the seconds between lock owner heartbeats, or None when they are
+    disabled. Heartbeats are only recorded when
+    CELERY_TASK_PLUS_LOCK_HEARTBEAT_INTERVAL is set or the lock reaper is
+    enabled (CELERY_TASK_PLUS_LOCK_REAPER, every 2 seconds by default).
+    """
+    heartbeat_interval = getattr(settings, 'CELERY_TASK_PLUS_LOCK_HEARTBEAT_INTERVAL', None)
+    if heartbeat_interval is None and getattr(settings, 'CELERY_TASK_PLUS_LOCK_REAPER', False):
+        heartbeat_interval = 2
+    return heartbeat_interval
+
+
+def get_lock_renewer():
+    """
+    Return the lock renewer for the current process.
+    """
+    global _lock_renewer
+    pid = os.getpid()
+    renewer_pid, renewer = _lock_renewer
+    if renewer_pid != pid:
+        with _lock_renewer_lock:
+            renewer_pid, renewer = _lock_renewer
+            if renewer_pid != pid:
+                renewer = LockRenewer(heartbeat_interval=get_lock_heartbeat_interval())
+                _lock_renewer = (pid, renewer)
+    return renewer
+
+
+def record_lock_hold(name, hold_time):
+    """
+    Record how long a lock was held, for get_tuned_lock_expire.
+    """
+    average = _lock_hold_times.get(name)
+    if average is None:
+        _lock_hold_times[name] = hold_time
+    else:
+        _lock_hold_times[name] = average + _lock_hold_weight * (hold_time - average)
+
+
+def get_tuned_lock_expire(name, minimum, maximum):
+    """
+    Return a lock expiry (in seconds) of twice the average time the lock name
+    has been held in this process, between minimum and maximum. Returns maximum
+    until a hold time has been recorded.
+    """
+    average = _lock_hold_times.get(name)
+    if average is None:
+        return maximum
+    return int(min(max(math.ceil(average * 2), minimum), maximum))
+
+
+def _get_pending_key(name):
+    return 'task-pending:{}'.format(name)
+
+
+def _get_rate_limit_key(name):
+    return 'rate-limit:{}'.format(name)
+
+
+def _get_parked_key(name):
+    return 'lock-parked:{}'.format(name)
+
+
+def _get_parked_sent_key(name):
+    return 'lock-parked-sent:{}'.format(name)
+
+
+def _get_lock_owner_key(owner_id):
+    if isinstance(owner_id, bytes):
+        owner_id = owner_id.decode('utf-8')
+    return 'lock-owner:{}'.format(owner_id)
+
+
+def _get_queue_key(name):
+    return 'lock-queue:{}'.format(name)
+
+
+def _get_waiter_key(token):
+    return 'lock-waiter:{}'.format(token)
+
+
+def _get_waiter_lease_key(token):
+    return 'lock-waiter-lease:{}'.format(token)
+
+
+def acquire_lock_in_order(lock, redis_client, name, timeout=None, expire=60):
+    """
+    Acquire the given lock, waiting in a FIFO queue of waiters for the lock
+    name when it is already held. Each release wakes only the waiter at the
+    head of the queue (see notify_lock_waiter). Waiters also recheck the lock
+    every ``expire`` seconds in case a holder exits without notifying, and
+    hold a lease on their place in the queue so releases skip waiters that
+    are gone.
+    """
+    queue_key = _get_queue_key(name)
+    if not redis_client.llen(queue_key) and lock.acquire(blocking=False):
+        return True
+    token = uuid.uuid4().hex
+    waiter_key = _get_waiter_key(token)
+    lease_key = _get_waiter_lease_key(token)
+    lease_expire = expire + _waiter_lease_margin
+    deadline = None if timeout is None else time.monotonic() + timeout
+    acquired = False
+    with redis_client.pipeline() as pipe:
+        pipe.set(lease_key, 1, ex=lease_expire)
+        pipe.rpush(queue_key, token)
+        pipe.expire(queue_key, expire + int(timeout or expire))
+        pipe.execute()
+    try:
+        # The lock may have been released before this waiter was queued, with
+        # no waiter to notify.
+        acquired = lock.acquire(blocking=False)
+        if acquired:
+            return True
+        while True:
+            if deadline is None:
+                wait = expire
+            else:
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    return False
+            signalled = redis_client.blpop(waiter_key, timeout=max(1, int(math.ceil(min(wait, expire)))))
+            acquired = lock.acquire(blocking=False)
+            if acquired:
+                return True
+            with redis_client.pipeline() as pipe:
+                pipe.set(lease_key, 1, ex=lease_expire)
+                if signalled:
+                    # Another client took the lock first; go back to the head
+                    # of the queue.
+                    pipe.lpush(queue_key, token)
+                pipe.execute()
+    finally:
+        with redis_client.pipeline() as pipe:
+            pipe.lrem(queue_key, 0, token)
+            pipe.delete(lease_key)
+            pipe.execute()
+        # Pass along the signal if the lock was handed to this waiter after it
+        # gave up.
+        if not acquired and redis_client.lpop(waiter_key):
+            notify_lock_waiter(redis_client, name)
+
+
+def notify_lock_waiter(redis_client, name):
+    """
+    Wake the next waiter queued for the lock name, if any.
+    """
+    args = [_get_waiter_key(''), _waiter_signal_expire, _get_waiter_lease_key('')]
+    _notify_lock_waiter_script(redis_client, keys=[_get_queue_key(name)], args=args)
+
+
+def set_pending_task(redis_client, name, task_id, expire=60):
+    """
+    Mark a task as pending (queued but not yet started) for the task key name,
+    unless another task is already pending. Return the id of the task already
+    pending, or None if the given task was marked as pending.
+    """
+    pending_task_id = _set_pending_task_script(redis_client, keys=[_get_pending_key(name)], args=[task_id, int(expire)])
+    if isinstance(pending_task_id, bytes):
+        pending_task_id = pending_task_id.decode('utf-8')
+    return pending_task_id
+
+
+def clear_pending_task(redis_client, name, task_id):
+    """
+    Clear the pending marker for the task key name if it belongs to the given
+    task.
+    """
+    return bool(_clear_pending_task_script(redis_client, keys=[_get_pending_key(name)], args=[task_id]))
+
+
+def check_rate_limit(redis_client, name, rate, burst=1):
+    """
+    Count a call for the name against a rate limit of rate calls per second
+    (allowing bursts of up to burst calls), shared by all clients. Return 0 if
+    the call is allowed, otherwise the number of seconds until it would be
+    (the call is not counted).
+    """
+    wait = _rate_limit_script(redis_client, keys=[_get_rate_limit_key(name)], args=[1000.0 / rate, max(int(burst), 1)])
+    return int(wait) / 1000.0
+
+
+def park_task(redis_client, name, task_id, message, expire=86400, head=False):
+    """
+    Store the task message for the lock name while the lock is held (or other
+    tasks are parked), keeping parked messages for up to expire seconds. A task
+    parked again (head=True) goes before the other parked tasks. Return
+    (parked, locked); a task parked while the lock was free (e.g. it expired)
+    means the next parked task should be sent (see pop_parked_task).
+    """
+    keys = ['lock:{}'.format(name), _get_parked_key(name), _get_parked_sent_key(name)]
+    parked, locked = _park_task_script(redis_client, keys=keys, args=[task_id, message, int(expire), '1' if head else '0'])
+    return bool(parked), bool(locked)
+
+
+def pop_parked_task(redis_client, name, sent_expire=600, released=False):
+    """
+    Remove and return the next task message parked for the lock name, or None.
+    The task is then treated as holding the lock until it does (or for
+    sent_expire seconds), so other tasks keep being parked behind it. Unless
+    released is True (the lock was just released), nothing is returned while
+    the lock is held or a task returned before hasn't released it yet.
+    """
+    keys = ['lock:{}'.format(name), _get_parked_key(name), _get_parked_sent_key(name)]
+    message = _pop_parked_task_script(redis_client, keys=keys, args=[int(sent_expire), '1' if released else '0'])
+    if message is None:
+        return None
+    return _decode(message).partition(' ')[2]
+
+
+def iter_parked_task_names(redis_client, count=500):
+    """
+    Iterate over the lock names with parked tasks, found with incremental SCAN
+    calls of count keys.
+    """
+    prefix = _get_parked_key('')
+    for key in redis_client.scan_iter(match=prefix + '*', count=count):
+        yield _decode(key)[len(prefix):]
+
+
+def _release_parked_task(redis_client, key):
+    # Send the next task parked for a lock key that was released forcibly.
+    prefix, _, name = key.partition(':')
+    if prefix == 'lock':
+        from .tasks import release_parked_task
+        release_parked_task(redis_client, name, released=True)
+
+
+def _get_reaped_signal_key(key):
+    # Return the signal key for a key held by a lock owner.
+    prefix, _, name = key.partition(':')
+    if prefix == 'semaphore':
+        return 'semaphore-signal:{}'.format(name)
+    return 'lock-signal:{}'.format(name)
+
+
+def reap_stale_locks(redis_client, timeout=10, signal_expire=1000):
+    """
+    Release the locks (and remove the shared locks and semaphore leases) held
+    by owners without a heartbeat (see LockRenewer.heartbeat) in the last
+    timeout seconds, sending the next task parked for each released lock.
+    Return the number of released locks by owner id.
+    """
+    timeout_ms = int(timeout * 1000)
+    released = collections.OrderedDict()
+    for owner_id in _get_stale_lock_owners_script(redis_client, keys=[_lock_owners_key], args=[timeout_ms]):
+        owner_key = _get_lock_owner_key(owner_id)
+        keys = [_lock_owners_key, owner_key]
+        args = [owner_id, timeout_ms, signal_expire]
+        held_keys = []
+        for key, value in redis_client.hgetall(owner_key).items():
+            key = key.decode('utf-8') if isinstance(key, bytes) else key
+            member = value.partition(b'|' if isinstance(value, bytes) else '|')[2]
+            held_keys.append(key)
+            keys.extend([key, _get_reaped_signal_key(key)])
+            args.extend([member, '0' if key.startswith('lock:') else '1'])
+        count = _reap_lock_owner_script(redis_client, keys=keys, args=args)
+        if count < 0:
+            continue
+        owner_id = owner_id.decode('utf-8') if isinstance(owner_id, bytes) else owner_id
+        released[owner_id] = count
+        if count:
+            metrics.incr('locks_reaped', count)
+            logger.warning('Released %d locks held by stale owner: %s', count, owner_id)
+            for key in held_keys:
+                _release_parked_task(redis_client, key)
+    return released
+
+
+# Kinds of held locks by key prefix (see iter_held_locks).
+_held_lock_prefixes = (('lock:', 'exclusive'), ('lock-shared:', 'shared'), ('semaphore:', 'semaphore'))
+
+
+def _decode(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def _describe_held_locks(redis_client, prefix, kind, keys):
+    # Return a dict describing each holder of the given lock keys.
+    with redis_client.pipeline(transaction=False) as pipe:
+        pipe.time()
+        for key in keys:
+            name = key[len(prefix):]
+            if kind == 'exclusive':
+                pipe.get(key)
+                pipe.pttl(key)
+            else:
+                pipe.zrange(key, 0, -1, withscores=True)
+            pipe.llen(_get_queue_key(name))
+            pipe.llen(_get_parked_key(name))
+        results = pipe.execute()
+    seconds, microseconds = results[0]
+    now = seconds * 1000 + microseconds // 1000
+    held_locks = []
+    for n, key in enumerate(keys):
+        name = key[len(prefix):]
+        if kind == 'exclusive':
+            owner_id, ttl, waiters, parked = results[1 + n * 4:5 + n * 4]
+            members = [(owner_id, now + ttl if ttl >= 0 else None)] if owner_id is not None else []
+        else:
+            members, waiters, parked = results[1 + n * 3:4 + n * 3]
+            members = [(member, score) for member, score in members if score > now]
+        for member, expires in members:
+            held_locks.append(dict(
+                name=name, kind=kind, key=key, member=_decode(member), owner_id=_decode(member).partition('#')[0],
+                ttl=None if expires is None else (expires - now) / 1000.0, age=None, waiters=waiters, parked=parked,
+            ))
+    # The acquired time is recorded with the owners' heartbeats.
+    with redis_client.pipeline(transaction=False) as pipe:
+        for held_lock in held_locks:
+            pipe.hget(_get_lock_owner_key(held_lock['owner_id']), held_lock['key'])
+        for held_lock, value in zip(held_locks, pipe.execute()):
+            if value:
+                acquired_at, _, member = _decode(value).partition('|')
+                if member == held_lock['member']:
+                    held_lock['age'] = max(now - int(acquired_at), 0) / 1000.0
+    return held_locks
+
+
+def iter_held_locks(redis_client, pattern='*', count=500):
+    """
+    Iterate over dicts describing each holder of an exclusive lock, shared lock
+    or semaphore lease whose name matches pattern (a Redis glob pattern), with
+    its name, kind, key, member, owner_id, ttl and age (in seconds, age only
+    for owners recording heartbeats), and the number of queued waiters and
+    parked tasks. Keys are found with incremental SCAN calls of count keys, so
+    Redis is never blocked.
+    """
+    for prefix, kind in _held_lock_prefixes:
+        keys = []
+        for key in redis_client.scan_iter(match=prefix + pattern, count=count):
+            keys.append(_decode(key))
+            if len(keys) >= count:
+                yield from _describe_held_locks(redis_client, prefix, kind, keys)
+                keys = []
+        if keys:
+            yield from _describe_held_locks(redis_client, prefix, kind, keys)
+
+
+def force_release_lock(redis_client, key, member, signal_expire=1000):
+    """
+    Release the lock key (or remove the shared lock or semaphore lease member)
+    if still held by member, as returned by iter_held_locks, signal waiters and
+    send the next parked task. Return True if released.
+    """
+    is_member = '0' if key.startswith('lock:') else '1'
+    args = [member, signal_expire, is_member]
+    released = bool(_force_release_lock_script(redis_client, keys=[key, _get_reaped_signal_key(key)], args=args))
+    if released:
+        _release_parked_task(redis_client, key)
+    return released
+
+
+def force_release_locks(redis_client, pattern, count=500, signal_expire=1000):
+    """
+    Release all the locks whose name matches pattern (see iter_held_locks).
+    Return the number of locks released.
+    """
+    released = 0
+    for held_lock in iter_held_locks(redis_client, pattern, count):
+        if force_release_lock(redis_client, held_lock['key'], held_lock['member'], signal_expire):
+            released += 1
+    if released:
+        metrics.incr('locks_force_released', released)
+        logger.warning('Force released %d locks matching: %s', released, pattern)
+    return released
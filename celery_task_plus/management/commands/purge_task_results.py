@@ -0,0 +1,32 @@
+# Django
+from django.core.management.base import BaseCommand
+
+# Celery-Task-Plus
+from celery_task_plus.retention import purge_task_results
+
+
+class Command(BaseCommand):
+
+    help = 'Purge expired task results in batches, according to CELERY_TASK_PLUS_RESULT_RETENTION.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help='Rows to delete per batch.')
+        parser.add_argument('--sleep', type=float, default=None, help='Seconds to sleep between batches.')
+        parser.add_argument('--max-batches', type=int, default=None, help='Stop after this many batches.')
+        parser.add_argument('--dry-run', action='store_true', help='Count the expired task results without deleting them.')
+
+    def handle(self, *args, **options):
+        def progress(policy, count):
+            if options['verbosity'] >= 2:
+                self.stdout.write('{}: {}'.format(policy.label, count))
+
+        purged = purge_task_results(
+            batch_size=options['batch_size'],
+            sleep=options['sleep'],
+            max_batches=options['max_batches'],
+            dry_run=options['dry_run'],
+            progress=progress,
+        )
+        verb = 'Would purge' if options['dry_run'] else 'Purged'
+        for label, count in purged.items():
+            self.stdout.write('{} {} task results: {}'.format(verb, count, label))
@@ -0,0 +1,33 @@
+# Python
+import time
+
+# Django
+from django.core.management.base import BaseCommand
+
+# Celery-Task-Plus
+from celery_task_plus.clients import get_lock_client
+from celery_task_plus.locks import reap_stale_locks
+from celery_task_plus.reaper import get_lock_reaper_timeout
+from celery_task_plus.tasks import release_orphaned_parked_tasks
+
+
+class Command(BaseCommand):
+
+    help = 'Release the task locks held by lock owners (worker processes) without a recent heartbeat, and send parked tasks of expired locks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--timeout', type=float, default=None, help='Seconds without a heartbeat after which an owner is dead.')
+        parser.add_argument('--interval', type=float, default=None, help='Keep running, releasing stale locks every this many seconds.')
+
+    def handle(self, *args, **options):
+        timeout = options['timeout'] or get_lock_reaper_timeout()
+        while True:
+            released = reap_stale_locks(get_lock_client(), timeout)
+            for owner_id, count in released.items():
+                self.stdout.write('Released {} locks held by {}'.format(count, owner_id))
+            sent = release_orphaned_parked_tasks(get_lock_client())
+            if sent:
+                self.stdout.write('Sent {} parked tasks of expired locks'.format(sent))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,39 @@
+# Django
+from django.core.management.base import BaseCommand, CommandError
+
+# Celery-Task-Plus
+from celery_task_plus.clients import get_lock_client
+from celery_task_plus.locks import force_release_lock, iter_held_locks
+
+
+def _format_seconds(value):
+    return '-' if value is None else '{:.1f}s'.format(value)
+
+
+class Command(BaseCommand):
+
+    help = 'List the held task locks (using SCAN, so Redis is never blocked), and optionally force release them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('pattern', nargs='?', default='*', help='Redis glob pattern of lock names (default "*").')
+        parser.add_argument('--count', type=int, default=500, help='Keys to check per SCAN call.')
+        parser.add_argument('--release', action='store_true', help='Force release the matching locks.')
+        parser.add_argument('--noinput', '--no-input', action='store_false', dest='interactive', help='Do not prompt before releasing locks.')
+
+    def handle(self, *args, **options):
+        redis_client = get_lock_client()
+        held_locks = list(iter_held_locks(redis_client, options['pattern'], options['count']))
+        for held_lock in held_locks:
+            self.stdout.write('{kind}\t{name}\t{owner_id}\tttl={ttl}\tage={age}\twaiters={waiters}\tparked={parked}'.format(
+                ttl=_format_seconds(held_lock['ttl']), age=_format_seconds(held_lock['age']),
+                **{k: v for k, v in held_lock.items() if k not in ('ttl', 'age')}
+            ))
+        self.stdout.write('{} held locks matching: {}'.format(len(held_locks), options['pattern']))
+        if not options['release'] or not held_locks:
+            return
+        if options['interactive']:
+            answer = input('Force release {} locks? [y/N] '.format(len(held_locks)))
+            if answer.lower() not in ('y', 'yes'):
+                raise CommandError('Cancelled.')
+        released = sum(force_release_lock(redis_client, held_lock['key'], held_lock['member']) for held_lock in held_locks)
+        self.stdout.write('Released {} locks.'.format(released))
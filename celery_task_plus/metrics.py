@@ -0,0 +1,360 @@
+# Python
+import collections
+import logging
+import os
+import re
+import socket
+import threading
+
+# Django
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+# Celery
+from celery.signals import worker_init, worker_process_init, worker_process_shutdown
+
+logger = logging.getLogger('celery_task_plus.metrics')
+
+__all__ = [
+    'BaseMetricsBackend', 'LocalMetricsBackend', 'PrometheusMetricsBackend', 'StatsdMetricsBackend',
+    'incr', 'observe', 'gauge', 'get_metrics', 'reset_metrics', 'start_prometheus_server',
+]
+
+_default_metrics_backends = ('celery_task_plus.metrics.LocalMetricsBackend',)
+
+# Configured backends, stored as (setting value, backends) so changes to the
+# setting are picked up; instances are shared by dotted path.
+_metrics_backends = (None, ())
+_metrics_backend_instances = {}
+_metrics_backends_lock = threading.Lock()
+
+# Histogram buckets (in seconds) from sub-millisecond Redis and database calls
+# up to locks held by long running tasks.
+_default_prometheus_buckets = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1, 2.5, 5, 10, 30, 60, 300, 900, 3600, float('inf'),
+)
+
+# Process serving Prometheus metrics, stored as (pid, port) so forked processes
+# can start their own server.
+_prometheus_server = (None, None)
+_prometheus_server_lock = threading.Lock()
+
+# Set in Celery workers, where Prometheus metrics are served by the worker
+# signal handlers instead of by PrometheusMetricsBackend.
+_prometheus_worker = False
+
+
+class BaseMetricsBackend(object):
+    """
+    Receives counters, timings and gauges recorded by celery_task_plus. Labels are
+    passed as a dict (e.g. ``task`` for the task name and ``lock`` for the
+    task key prefix).
+    """
+
+    def incr(self, name, value, labels):
+        pass
+
+    def observe(self, name, value, labels):
+        pass
+
+    def gauge(self, name, value, labels):
+        pass
+
+
+class LocalMetricsBackend(BaseMetricsBackend):
+    """
+    Aggregates counters, timings and gauges in memory for the current process
+    (see get_metrics).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()
+        self._timings = {}
+        self._gauges = {}
+
+    def incr(self, name, value, labels):
+        metric_key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[metric_key] += value
+
+    def observe(self, name, value, labels):
+        metric_key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            timing = self._timings.get(metric_key)
+            if timing is None:
+                self._timings[metric_key] = dict(count=1, sum=value, min=value, max=value)
+            else:
+                timing['count'] += 1
+                timing['sum'] += value
+                timing['min'] = min(timing['min'], value)
+                timing['max'] = max(timing['max'], value)
+
+    def gauge(self, name, value, labels):
+        metric_key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[metric_key] = value
+
+    def get_metrics(self):
+        with self._lock:
+            return dict(
+                counters={k: v for k, v in self._counters.items()},
+                timings={k: dict(v) for k, v in self._timings.items()},
+                gauges=dict(self._gauges),
+            )
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._timings.clear()
+            self._gauges.clear()
+
+
+class PrometheusMetricsBackend(BaseMetricsBackend):
+    """
+    Exports counters (as ``celery_task_plus_<name>_total``) and timings (as
+    ``celery_task_plus_<name>_seconds`` histograms, with
+    CELERY_TASK_PLUS_PROMETHEUS_BUCKETS) using prometheus_client. When CELERY_TASK_PLUS_PROMETHEUS_PORT is set, also serves them over HTTP
+    (see start_prometheus_server).
+    """
+
+    def __init__(self):
+        import prometheus_client
+        self._prometheus_client = prometheus_client
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self.buckets = getattr(settings, 'CELERY_TASK_PLUS_PROMETHEUS_BUCKETS', _default_prometheus_buckets)
+        port = getattr(settings, 'CELERY_TASK_PLUS_PROMETHEUS_PORT', None)
+        if port and not _prometheus_worker:
+            start_prometheus_server(port)
+
+    def _get_metric(self, metric_class, name, labels, **kwargs):
+        # Metrics are created with the label names of their first use, which
+        # every later use must match.
+        label_names = tuple(sorted(labels))
+        metric = self._metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(name)
+                if metric is None:
+                    metric = (metric_class(
+                        'celery_task_plus_{}'.format(name), name.replace('_', ' '), label_names, **kwargs), label_names)
+                    self._metrics[name] = metric
+        metric, metric_label_names = metric
+        if label_names != metric_label_names:
+            raise ValueError('Metric {} has labels {}, not {}'.format(name, metric_label_names, label_names))
+        return metric.labels(**labels) if labels else metric
+
+    def incr(self, name, value, labels):
+        self._get_metric(self._prometheus_client.Counter, name, labels).inc(value)
+
+    def observe(self, name, value, labels):
+        metric = self._get_metric(
+            self._prometheus_client.Histogram, '{}_seconds'.format(name), labels, buckets=self.buckets)
+        metric.observe(value)
+
+    def gauge(self, name, value, labels):
+        # In multiprocess mode, report the highest value of the live processes.
+        metric = self._get_metric(self._prometheus_client.Gauge, name, labels, multiprocess_mode='livemax')
+        metric.set(value)
+
+
+def _is_prometheus_multiprocess():
+    return bool(os.environ.get('PROMETHEUS_MULTIPROC_DIR'))
+
+
+def start_prometheus_server(port=None):
+    """
+    Serve Prometheus metrics over HTTP from the current process on the given
+    port (default CELERY_TASK_PLUS_PROMETHEUS_PORT), if not already serving. In
+    prometheus_client multiprocess mode (PROMETHEUS_MULTIPROC_DIR set), the
+    metrics of all processes using that directory are served. Returns whether
+    the server is running.
+    """
+    global _prometheus_server
+    if port is None:
+        port = getattr(settings, 'CELERY_TASK_PLUS_PROMETHEUS_PORT', None)
+    pid = os.getpid()
+    with _prometheus_server_lock:
+        if _prometheus_server[0] == pid:
+            return True
+        import prometheus_client
+        registry = prometheus_client.REGISTRY
+        if _is_prometheus_multiprocess():
+            from prometheus_client import multiprocess
+            registry = prometheus_client.CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        try:
+            prometheus_client.start_http_server(port, registry=registry)
+        except OSError:
+            logger.warning('Unable to serve Prometheus metrics on port %s', port, exc_info=True)
+            return False
+        _prometheus_server = (pid, port)
+        logger.debug('Serving Prometheus metrics on port %s', port)
+    return True
+
+
+def _get_prometheus_port():
+    # Return the port to serve Prometheus metrics from, when exported.
+    backend_paths = getattr(settings, 'CELERY_TASK_PLUS_METRICS_BACKENDS', _default_metrics_backends)
+    if 'celery_task_plus.metrics.PrometheusMetricsBackend' not in backend_paths:
+        return None
+    return getattr(settings, 'CELERY_TASK_PLUS_PROMETHEUS_PORT', None)
+
+
+@worker_init.connect
+def start_worker_prometheus_server(**kwargs):
+    """
+    Serve Prometheus metrics from the main worker process, before any pool
+    processes are started. In multiprocess mode this includes the metrics of
+    all pool processes.
+    """
+    global _prometheus_worker
+    port = _get_prometheus_port()
+    if port:
+        _prometheus_worker = True
+        start_prometheus_server(port)
+
+
+@worker_process_init.connect
+def start_worker_process_prometheus_server(**kwargs):
+    """
+    Without multiprocess mode, serve the Prometheus metrics of each prefork pool
+    process on its own port, after the main process' port (e.g. 9100 for the
+    main process, 9101 for the first pool process, and so on).
+    """
+    port = _get_prometheus_port()
+    if port and not _is_prometheus_multiprocess():
+        from billiard.process import current_process
+        start_prometheus_server(port + 1 + (getattr(current_process(), 'index', None) or 0))
+
+
+@worker_process_shutdown.connect
+def mark_prometheus_process_dead(pid=None, **kwargs):
+    """
+    Remove the live gauges of exited pool processes in multiprocess mode.
+    """
+    if _get_prometheus_port() and _is_prometheus_multiprocess():
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(pid or os.getpid())
+
+
+class StatsdMetricsBackend(BaseMetricsBackend):
+    """
+    Sends counters, timings (in milliseconds) and gauges to StatsD over UDP.
+    Labels are sent as DogStatsD tags when CELERY_TASK_PLUS_STATSD_TAGS is True,
+    otherwise they are appended to the metric name.
+    """
+
+    def __init__(self):
+        host = getattr(settings, 'CELERY_TASK_PLUS_STATSD_HOST', 'localhost')
+        port = getattr(settings, 'CELERY_TASK_PLUS_STATSD_PORT', 8125)
+        self.prefix = getattr(settings, 'CELERY_TASK_PLUS_STATSD_PREFIX', 'celery_task_plus.')
+        self.tags = getattr(settings, 'CELERY_TASK_PLUS_STATSD_TAGS', False)
+        self._address = (host, port)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def _send(self, name, value, metric_type, labels):
+        if self.tags:
+            tags = ','.join('{}:{}'.format(k, v) for k, v in sorted(labels.items()))
+            data = '{}{}:{}|{}{}'.format(self.prefix, name, value, metric_type, '|#' + tags if tags else '')
+        else:
+            parts = [name] + [re.sub(r'[^A-Za-z0-9_-]', '_', str(v)) for k, v in sorted(labels.items())]
+            data = '{}{}:{}|{}'.format(self.prefix, '.'.join(parts), value, metric_type)
+        try:
+            self._socket.sendto(data.encode('utf-8'), self._address)
+        except OSError:
+            pass
+
+    def incr(self, name, value, labels):
+        self._send(name, value, 'c', labels)
+
+    def observe(self, name, value, labels):
+        self._send(name, round(value * 1000, 3), 'ms', labels)
+
+    def gauge(self, name, value, labels):
+        self._send(name, value, 'g', labels)
+
+
+def get_metrics_backends():
+    """
+    Return the metrics backends from CELERY_TASK_PLUS_METRICS_BACKENDS (a list
+    of dotted paths to BaseMetricsBackend subclasses).
+    """
+    global _metrics_backends
+    backend_paths = getattr(settings, 'CELERY_TASK_PLUS_METRICS_BACKENDS', _default_metrics_backends)
+    configured_paths, backends = _metrics_backends
+    if configured_paths is backend_paths:
+        return backends
+    with _metrics_backends_lock:
+        backends = []
+        for backend_path in backend_paths:
+            backend = _metrics_backend_instances.get(backend_path)
+            if backend is None:
+                try:
+                    backend = import_string(backend_path)()
+                except Exception:
+                    logger.exception('Unable to load metrics backend: %s', backend_path)
+                    continue
+                _metrics_backend_instances[backend_path] = backend
+            backends.append(backend)
+        _metrics_backends = (backend_paths, tuple(backends))
+    return _metrics_backends[1]
+
+
+def incr(name, value=1, **labels):
+    """
+    Increment the counter for the given name and labels.
+    """
+    for backend in get_metrics_backends():
+        try:
+            backend.incr(name, value, labels)
+        except Exception:
+            logger.exception('Error recording metric %s with %r', name, backend)
+
+
+def observe(name, value, **labels):
+    """
+    Record a timing (in seconds) for the given name and labels.
+    """
+    for backend in get_metrics_backends():
+        try:
+            backend.observe(name, value, labels)
+        except Exception:
+            logger.exception('Error recording metric %s with %r', name, backend)
+
+
+def gauge(name, value, **labels):
+    """
+    Set the current value for the given name and labels.
+    """
+    for backend in get_metrics_backends():
+        try:
+            backend.gauge(name, value, labels)
+        except Exception:
+            logger.exception('Error recording metric %s with %r', name, backend)
+
+
+def _get_local_metrics_backend():
+    for backend in get_metrics_backends():
+        if isinstance(backend, LocalMetricsBackend):
+            return backend
+
+
+def get_metrics():
+    """
+    Return a snapshot of all counters, timings and gauges recorded in this
+    process by LocalMetricsBackend.
+    """
+    backend = _get_local_metrics_backend()
+    if backend is None:
+        return dict(counters={}, timings={}, gauges={})
+    return backend.get_metrics()
+
+
+def reset_metrics():
+    backend = _get_local_metrics_backend()
+    if backend is not None:
+        backend.reset()
@@ -0,0 +1,47 @@
+# Django
+from django.db import migrations, models
+
+# Composite indexes on django_celery_results task results used by the admin
+# filters and keyset pagination, and by result retention.
+TASK_RESULT_INDEXES = [
+    models.Index(fields=['date_done', 'id'], name='ctp_taskresult_done_id'),
+    models.Index(fields=['status', 'date_done'], name='ctp_taskresult_status_done'),
+    models.Index(fields=['task_name', 'date_done'], name='ctp_taskresult_name_done'),
+]
+
+
+def add_task_result_indexes(apps, schema_editor):
+    # On PostgreSQL, build the indexes without locking the (usually large)
+    # task results table against writes.
+    TaskResult = apps.get_model('django_celery_results', 'TaskResult')
+    for index in TASK_RESULT_INDEXES:
+        if schema_editor.connection.vendor == 'postgresql':
+            columns = ', '.join(schema_editor.quote_name(TaskResult._meta.get_field(field).column) for field in index.fields)
+            schema_editor.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} ({})'.format(
+                schema_editor.quote_name(index.name), schema_editor.quote_name(TaskResult._meta.db_table), columns,
+            ))
+        else:
+            schema_editor.add_index(TaskResult, index)
+
+
+def remove_task_result_indexes(apps, schema_editor):
+    TaskResult = apps.get_model('django_celery_results', 'TaskResult')
+    for index in TASK_RESULT_INDEXES:
+        if schema_editor.connection.vendor == 'postgresql':
+            schema_editor.execute('DROP INDEX CONCURRENTLY IF EXISTS {}'.format(schema_editor.quote_name(index.name)))
+        else:
+            schema_editor.remove_index(TaskResult, index)
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ('django_celery_results', '0008_chordcounter'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_task_result_indexes, remove_task_result_indexes),
+    ]
@@ -1,8 +1,128 @@
 # Python
 import threading
+from json.encoder import encode_basestring_ascii
+
+# Django
+from django.conf import settings
 
 _django_celery_results_patched = threading.Event()
 
+# Maximum depth of nested lists/dicts checked by _get_json_size().
+_max_json_depth = 32
+
+_str_types = {str}
+_int_types = {int}
+
+
+def _get_json_str_size(value, limit=None):
+    # Return the size of the string value encoded as JSON (with ensure_ascii,
+    # like kombu), where escaped characters take up to 12 characters. Without
+    # a limit, or once the size exceeds it, only the unescaped size is returned.
+    size = len(value) + 2
+    if limit is None or size > limit:
+        return size
+    return len(encode_basestring_ascii(value))
+
+
+def _get_json_size(value, limit=None, depth=0):
+    # Return an upper bound of the size of value encoded as JSON, or None if
+    # value is not made up only of simple JSON types. Stops checking (returning
+    # a size > limit) once the size exceeds limit.
+    value_type = type(value)
+    if value_type is str:
+        return _get_json_str_size(value, limit)
+    elif value_type is int:
+        return value.bit_length() * 31 // 100 + 3
+    elif value_type is float:
+        # At least the size of -Infinity.
+        return max(len(repr(value)), 9)
+    elif value is None or value is True:
+        return 4
+    elif value is False:
+        return 5
+    elif depth >= _max_json_depth:
+        return None
+    elif value_type is list or value_type is tuple:
+        items = value
+        size = 2
+    elif value_type is dict:
+        items = value.values()
+        size = 2
+        for k in value:
+            if type(k) is not str:
+                return None
+            size += _get_json_str_size(k, limit) + 2
+    else:
+        return None
+    # Size lists of only strings or only ints without a Python-level loop.
+    item_types = set(map(type, items))
+    if item_types == _str_types:
+        if limit is None or size + sum(map(len, items)) + len(items) * 4 > limit:
+            return size + sum(map(len, items)) + len(items) * 4
+        return size + sum(map(len, map(encode_basestring_ascii, items))) + len(items) * 2
+    elif item_types == _int_types:
+        return size + sum(map(int.bit_length, items)) * 31 // 100 + len(items) * 5
+    for item in items:
+        item_size = _get_json_size(item, limit, depth + 1)
+        if item_size is None:
+            return None
+        size += item_size + 2
+        if limit is not None and size > limit:
+            break
+    return size
+
+
+def _truncate(value, max_length, keep_end=False):
+    # Truncate value to at most max_length characters, including the marker
+    # (left out if there is no room for it).
+    if max_length is None or len(value) <= max_length:
+        return value
+    marker = '...(truncated)\n' if keep_end else '...(truncated)'
+    if max_length <= len(marker):
+        return value[-max_length:] if keep_end and max_length else value[:max_length]
+    if keep_end:
+        return marker + value[-(max_length - len(marker)):]
+    return value[:max_length - len(marker)] + marker
+
+
+def _truncate_json_str(value, max_size):
+    # Truncate value so that, with the truncation suffix, it is at most
+    # max_size long encoded as JSON (or empty if there is no room).
+    max_length = max_size - len('...(truncated)') - 2
+    if max_length <= 0:
+        return ''
+    value = value[:max_length]
+    # Escaped characters take up to 12 characters, so drop a twelfth of the
+    # excess (without dropping too much) until it fits.
+    excess = len(encode_basestring_ascii(value)) - 2 - max_length
+    while excess > 0:
+        value = value[:-max(excess // 12, 1)]
+        excess = len(encode_basestring_ascii(value)) - 2 - max_length
+    return value + '...(truncated)'
+
+
+def _truncate_json_list(values, max_size):
+    # Truncate the strings in values so that the list is at most max_size long
+    # encoded as JSON: strings smaller than an even share of the remaining
+    # size are kept as is and the larger ones share what is left.
+    values = values[:max((max_size - 2) // 4, 0)]
+    sizes = [_get_json_str_size(x, max_size) + 2 for x in values]
+    remaining_size = max_size - 2
+    max_sizes = [None] * len(values)
+    order = sorted(range(len(values)), key=sizes.__getitem__)
+    for n, index in enumerate(order):
+        share = remaining_size // (len(values) - n)
+        if sizes[index] > share:
+            for index in order[n:]:
+                max_sizes[index] = share - 2
+            break
+        remaining_size -= sizes[index]
+    return [x if m is None else _truncate_json_str(x, m) for x, m in zip(values, max_sizes)]
+
+
+def _get_max_length(name):
+    return getattr(settings, name, 65536)
+
 
 def patch_django_celery_results():
     if _django_celery_results_patched.is_set():
@@ -22,6 +142,37 @@ def patch_django_celery_results():
 
     TaskResultAdmin.has_change_permission = has_change_permission
 
+    # Patch TaskResultAdmin to scale to large tables: no full counts, no large
+    # fields in the list, keyset pagination and filters backed by indexes.
+    from .admin import EstimatedCountPaginator, TaskNameListFilter, TaskResultChangeList, TaskStateListFilter, task_locks_view
+
+    def get_changelist(self, request, **kwargs):
+        return TaskResultChangeList
+
+    TaskResultAdmin.get_changelist = get_changelist
+    TaskResultAdmin.paginator = EstimatedCountPaginator
+    TaskResultAdmin.show_full_result_count = False
+    TaskResultAdmin.date_hierarchy = None
+    TaskResultAdmin.list_filter = (TaskStateListFilter, 'date_done', TaskNameListFilter)
+    TaskResultAdmin.search_fields = ('=task_id',)
+    TaskResultAdmin.change_list_template = 'admin/celery_task_plus/taskresult/change_list.html'
+
+    # Patch TaskResultAdmin to add a view of the held task locks.
+    from django.urls import path
+
+    _original_get_urls = TaskResultAdmin.get_urls
+
+    def get_urls(self):
+        url_name = '{}_{}_locks'.format(self.model._meta.app_label, self.model._meta.model_name)
+        urls = [path('locks/', self.admin_site.admin_view(self.task_locks_view), name=url_name)]
+        return urls + _original_get_urls(self)
+
+    def task_locks_view_method(self, request):
+        return task_locks_view(self, request)
+
+    TaskResultAdmin.get_urls = get_urls
+    TaskResultAdmin.task_locks_view = task_locks_view_method
+
     # Patch backend to handle results from revoked tasks.
     from django_celery_results.backends.database import DatabaseBackend
 
@@ -34,24 +185,103 @@ def patch_django_celery_results():
             request.task = request._task_obj.name
             request.args = request._payload[0]
             request.kwargs = request._payload[1]
+        # Keep the end of long tracebacks (where the exception was raised).
+        if traceback:
+            traceback = _truncate(traceback, _get_max_length('CELERY_TASK_PLUS_RESULT_TRACEBACK_MAX_LENGTH'), keep_end=True)
         return _original_store_result(self, task_id, result, status, traceback, request)
 
     DatabaseBackend._store_result = _store_result
 
     # Patch backend to handle exception results.
+    def encode_exc_message(self, exc_message):
+        max_length = _get_max_length('CELERY_TASK_PLUS_RESULT_EXCEPTION_MAX_LENGTH')
+        # Check whether the message can be serialized as JSON by looking at its
+        # types, falling back to trying to serialize it for other serializers
+        # or types.
+        size = _get_json_size(exc_message, max_length) if self.serializer == 'json' else None
+        if size is None:
+            try:
+                self._encode(exc_message)
+            except Exception:
+                if isinstance(exc_message, (list, tuple)):
+                    exc_message = list(map(str, exc_message))
+                else:
+                    exc_message = str(exc_message)
+                size = _get_json_size(exc_message, max_length)
+            else:
+                return exc_message
+        if max_length is None or size <= max_length:
+            return exc_message
+        # Truncate oversized messages, converting any values that aren't
+        # strings to strings.
+        if isinstance(exc_message, (list, tuple)):
+            return _truncate_json_list([x if isinstance(x, str) else str(x) for x in exc_message], max_length)
+        return _truncate_json_str(exc_message if isinstance(exc_message, str) else str(exc_message), max_length)
+
+    DatabaseBackend.encode_exc_message = encode_exc_message
+
     def encode_result(self, result, state):
         if state in self.EXCEPTION_STATES and isinstance(result, Exception):
             result = self.prepare_exception(result)
             if isinstance(result, dict) and 'exc_message' in result:
-                try:
-                    self._encode(result['exc_message'])
-                except Exception:
-                    if isinstance(result['exc_message'], (list, tuple)):
-                        result['exc_message'] = list(map(str, result['exc_message']))
-                    else:
-                        result['exc_message'] = str(result['exc_message'])
+                result['exc_message'] = self.encode_exc_message(result['exc_message'])
             return result
         else:
             return self.prepare_value(result)
 
     DatabaseBackend.encode_result = encode_result
+
+    # Patch manager and backend to compress large results and tracebacks.
+    from django_celery_results.managers import TaskResultManager
+
+    from .compression import (
+        _get_spilled_filter, _is_spill_enabled, decode_stored_content, delete_stored_content, encode_stored_content,
+    )
+
+    _original_manager_store_result = TaskResultManager.store_result
+
+    def store_result(self, content_type, content_encoding, task_id, result, status, traceback=None, **kwargs):
+        # Delete the files of a spilled result or traceback once overwritten by
+        # content stored elsewhere (e.g. a smaller result after a retry).
+        spilled = ()
+        if _is_spill_enabled():
+            spilled = self.filter(_get_spilled_filter(), task_id=task_id).values_list('result', 'traceback').first() or ()
+        result = encode_stored_content(result, task_id, 'result')
+        traceback = encode_stored_content(traceback, task_id, 'traceback')
+        task_result = _original_manager_store_result(self, content_type, content_encoding, task_id, result, status, traceback=traceback, **kwargs)
+        for spilled_content, content in zip(spilled, (result, traceback)):
+            if spilled_content != content:
+                delete_stored_content(spilled_content)
+        return task_result
+
+    TaskResultManager.store_result = store_result
+
+    _original_delete_expired = TaskResultManager.delete_expired
+
+    def delete_expired(self, expires):
+        # Delete the files of spilled results and tracebacks along with their
+        # expired task results (e.g. from the celery.backend_cleanup task).
+        spilled = list(self.get_all_expired(expires).filter(_get_spilled_filter()).values_list('result', 'traceback'))
+        _original_delete_expired(self, expires)
+        for result, traceback in spilled:
+            delete_stored_content(result)
+            delete_stored_content(traceback)
+
+    TaskResultManager.delete_expired = delete_expired
+
+    _original_decode_content = DatabaseBackend.decode_content
+
+    def decode_content(self, obj, content):
+        return _original_decode_content(self, obj, decode_stored_content(content))
+
+    DatabaseBackend.decode_content = decode_content
+
+    _original_get_task_meta_for = DatabaseBackend._get_task_meta_for
+
+    def _get_task_meta_for(self, task_id):
+        meta = _original_get_task_meta_for(self, task_id)
+        if meta.get('traceback'):
+            meta['traceback'] = decode_stored_content(meta['traceback'])
+        return meta
+
+    DatabaseBackend._get_task_meta_for = _get_task_meta_for
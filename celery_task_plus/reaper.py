@@ -0,0 +1,86 @@
+# Python
+import logging
+import os
+import threading
+
+# Django
+from django.conf import settings
+
+# Celery
+from celery.signals import worker_ready
+
+# Celery-Task-Plus
+from .clients import get_lock_client
+from .locks import reap_stale_locks
+from .tasks import release_orphaned_parked_tasks
+
+logger = logging.getLogger('celery_task_plus.reaper')
+
+__all__ = ['LockReaper', 'get_lock_reaper_timeout', 'start_lock_reaper']
+
+# Process-wide lock reaper, stored as a (pid, reaper) tuple so a forked child
+# never uses the thread started by its parent.
+_lock_reaper = (None, None)
+_lock_reaper_lock = threading.Lock()
+
+
+def get_lock_reaper_timeout():
+    """
+    Return the seconds without a heartbeat after which a lock owner is dead.
+    """
+    return getattr(settings, 'CELERY_TASK_PLUS_LOCK_HEARTBEAT_TIMEOUT', 10)
+
+
+class LockReaper(object):
+    """
+    Releases the locks of dead lock owners (see reap_stale_locks), and sends
+    the next parked task for locks that expired, every interval seconds from a
+    background thread.
+    """
+
+    def __init__(self, interval=5, timeout=10):
+        self.interval = interval
+        self.timeout = timeout
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='celery-task-plus-lock-reaper', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                reap_stale_locks(get_lock_client(), self.timeout)
+                release_orphaned_parked_tasks(get_lock_client())
+            except Exception:
+                logger.exception('Error releasing stale locks')
+
+
+def start_lock_reaper():
+    """
+    Start the lock reaper for the current process, if not already started.
+    """
+    global _lock_reaper
+    pid = os.getpid()
+    with _lock_reaper_lock:
+        reaper_pid, reaper = _lock_reaper
+        if reaper_pid != pid:
+            interval = getattr(settings, 'CELERY_TASK_PLUS_LOCK_REAPER_INTERVAL', 5)
+            reaper = LockReaper(interval, get_lock_reaper_timeout())
+            reaper.start()
+            _lock_reaper = (pid, reaper)
+    return reaper
+
+
+@worker_ready.connect
+def start_worker_lock_reaper(**kwargs):
+    """
+    Start the lock reaper in the main worker process when
+    CELERY_TASK_PLUS_LOCK_REAPER is True.
+    """
+    if getattr(settings, 'CELERY_TASK_PLUS_LOCK_REAPER', False):
+        start_lock_reaper()
@@ -0,0 +1,359 @@
+# Python
+import atexit
+import heapq
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+
+# Django
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.utils import timezone
+
+# Celery
+from celery.signals import worker_process_shutdown
+
+# Celery-Task-Plus
+from .compression import encode_stored_content
+from . import metrics
+
+logger = logging.getLogger('celery_task_plus.results')
+
+__all__ = [
+    'DeferredResult', 'DeferredResultScheduler', 'TaskResultWriter', 'get_deferred_result_scheduler',
+    'get_task_result_writer', 'get_task_result_fields', 'write_task_results',
+]
+
+# Process-wide result writer, stored as a (pid, writer) tuple so a forked child
+# never uses the queue or thread started by its parent.
+_task_result_writer = (None, None)
+_task_result_writer_lock = threading.Lock()
+
+# Process-wide deferred result scheduler, stored as a (pid, scheduler) tuple.
+_deferred_result_scheduler = (None, None)
+_deferred_result_scheduler_lock = threading.Lock()
+
+
+def get_task_result_fields(backend, result, status, traceback=None, request=None):
+    """
+    Return the TaskResult field values that DatabaseBackend would store for an
+    already encoded result (see Backend.encode_result).
+    """
+    content_type, content_encoding, result = backend.encode_content(result)
+    _, _, meta = backend.encode_content({
+        'children': backend.current_task_children(request),
+    })
+    if getattr(request, 'argsrepr', None) is not None:
+        task_args = request.argsrepr
+    else:
+        task_args = getattr(request, 'args', None)
+    if getattr(request, 'kwargsrepr', None) is not None:
+        task_kwargs = request.kwargsrepr
+    else:
+        task_kwargs = getattr(request, 'kwargs', None)
+    if task_args is not None:
+        _, _, task_args = backend.encode_content(task_args)
+    if task_kwargs is not None:
+        _, _, task_kwargs = backend.encode_content(task_kwargs)
+    return dict(
+        status=status,
+        result=result,
+        traceback=traceback,
+        meta=meta,
+        content_encoding=content_encoding,
+        content_type=content_type,
+        task_name=getattr(request, 'task', None),
+        task_args=task_args,
+        task_kwargs=task_kwargs,
+        worker=getattr(request, 'hostname', None),
+    )
+
+
+def write_task_results(model, task_results):
+    """
+    Write a batch of (task_id, fields) pairs to the given TaskResult model with
+    one bulk insert and one bulk update. Only the last fields for each task_id
+    are written, so a STARTED followed by a SUCCESS results in a single write.
+    """
+    latest_fields = {}
+    for task_id, fields in task_results:
+        latest_fields.pop(task_id, None)
+        latest_fields[task_id] = fields
+    if not latest_fields:
+        return
+    now = timezone.now()
+    using = router.db_for_write(model)
+    update_fields = ['date_done']
+    for fields in latest_fields.values():
+        update_fields.extend([k for k in fields if k not in update_fields])
+    with transaction.atomic(using=using):
+        existing_objs = model._default_manager.using(using).select_for_update().in_bulk(list(latest_fields), field_name='task_id')
+        create_objs = []
+        update_objs = []
+        for task_id, fields in latest_fields.items():
+            fields = dict(
+                fields,
+                result=encode_stored_content(fields['result'], task_id, 'result'),
+                traceback=encode_stored_content(fields['traceback'], task_id, 'traceback'),
+            )
+            obj = existing_objs.get(task_id)
+            if obj is None:
+                create_objs.append(model(task_id=task_id, date_done=now, **fields))
+            else:
+                for k, v in fields.items():
+                    setattr(obj, k, v)
+                obj.date_done = now
+                update_objs.append(obj)
+        if create_objs:
+            model._default_manager.using(using).bulk_create(create_objs)
+        if update_objs:
+            model._default_manager.using(using).bulk_update(update_objs, update_fields)
+
+
+def _write_task_results_one_by_one(model, task_results):
+    for task_id, fields in task_results:
+        model._default_manager.store_result(task_id=task_id, **fields)
+
+
+class TaskResultWriter(object):
+    """
+    Buffers task result writes in memory and writes them in batches from a
+    background thread. Writes fall back to being stored synchronously when the
+    buffer is full or a batch fails.
+    """
+
+    def __init__(self, max_queue_size=10000, batch_size=500, flush_interval=1.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._write_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def put(self, backend, task_id, result, status, traceback=None, request=None):
+        """
+        Queue a result to be stored, as Backend.store_result would store it.
+        """
+        model = getattr(backend, 'TaskModel', None)
+        if model is None or self._stopped.is_set():
+            return backend.store_result(task_id, result, status, traceback=traceback, request=request)
+        result = backend.encode_result(result, status)
+        fields = get_task_result_fields(backend, result, status, traceback, request)
+        self._start()
+        try:
+            self._queue.put_nowait((model, str(task_id), fields))
+        except queue.Full:
+            # Write everything queued so far, followed by this result, from the
+            # calling thread.
+            metrics.incr('result_writer_overflow')
+            with self._write_lock:
+                task_results = self._get_queued()
+                task_results.append((model, str(task_id), fields))
+                self._write(task_results)
+        return result
+
+    def flush(self):
+        """
+        Write all queued results from the calling thread.
+        """
+        while self._write_batch():
+            pass
+
+    def stop(self):
+        self._stopped.set()
+        self.flush()
+
+    def _start(self):
+        if self._thread is None:
+            with _task_result_writer_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='celery-task-plus-result-writer', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._stopped.wait(self.flush_interval)
+            if self._queue.empty():
+                continue
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Error writing task results')
+            finally:
+                connections.close_all()
+
+    def _get_queued(self, limit=None):
+        task_results = []
+        try:
+            while limit is None or len(task_results) < limit:
+                task_results.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return task_results
+
+    def _write(self, task_results):
+        task_results_by_model = {}
+        for model, task_id, fields in task_results:
+            task_results_by_model.setdefault(model, []).append((task_id, fields))
+        for model, model_task_results in task_results_by_model.items():
+            try:
+                write_task_results(model, model_task_results)
+            except Exception:
+                logger.warning('Error writing batch of task results, retrying one by one', exc_info=True)
+                metrics.incr('result_writer_batch_error')
+                _write_task_results_one_by_one(model, model_task_results)
+        metrics.incr('result_writer_written', len(task_results))
+
+    def _write_batch(self):
+        # Results are only removed from the queue while holding the write lock,
+        # so results for the same task are always written in order.
+        with self._write_lock:
+            task_results = self._get_queued(self.batch_size)
+            if task_results:
+                self._write(task_results)
+            return len(task_results)
+
+
+class DeferredResult(object):
+    """
+    Stores a result from the deferred result scheduler's thread after a delay,
+    unless cancelled first. Cancelling waits for a store already in progress,
+    so a result stored after cancel() returns is never overwritten by the
+    deferred one.
+    """
+
+    def __init__(self, delay, store, *args, **kwargs):
+        self.delay = delay
+        self._store = store
+        self._args = args
+        self._kwargs = kwargs
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._done = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    def start(self):
+        get_deferred_result_scheduler().add(self)
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+        self._done.set()
+
+    def join(self, timeout=None):
+        """
+        Wait until the result is stored or cancelled, returning False if the
+        timeout expires first.
+        """
+        return self._done.wait(timeout)
+
+    def _run(self):
+        with self._lock:
+            if self._cancelled:
+                return
+            try:
+                self._store(*self._args, **self._kwargs)
+            except Exception:
+                logger.exception('Error storing deferred task result')
+            finally:
+                self._done.set()
+                connections.close_all()
+
+
+class DeferredResultScheduler(object):
+    """
+    Stores deferred results from a single thread (started when the first one
+    is added), in the order they are due. Results cancelled before they are
+    due are dropped without waking the thread.
+    """
+
+    def __init__(self):
+        # Heap of (due time, sequence, deferred result).
+        self._deferred_results = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def add(self, deferred_result):
+        with self._condition:
+            due = time.monotonic() + deferred_result.delay
+            heapq.heappush(self._deferred_results, (due, next(self._sequence), deferred_result))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='celery-task-plus-deferred-results', daemon=True)
+                self._thread.start()
+            # Only wake the thread when the new result is due first.
+            if self._deferred_results[0][2] is deferred_result:
+                self._condition.notify()
+
+    def _get_due_result(self):
+        with self._condition:
+            while True:
+                while self._deferred_results and self._deferred_results[0][2].cancelled:
+                    heapq.heappop(self._deferred_results)
+                if self._deferred_results:
+                    wait = self._deferred_results[0][0] - time.monotonic()
+                    if wait <= 0:
+                        return heapq.heappop(self._deferred_results)[2]
+                else:
+                    wait = None
+                self._condition.wait(wait)
+
+    def _run(self):
+        while True:
+            self._get_due_result()._run()
+
+
+def get_deferred_result_scheduler():
+    """
+    Return the deferred result scheduler for the current process.
+    """
+    global _deferred_result_scheduler
+    pid = os.getpid()
+    scheduler_pid, scheduler = _deferred_result_scheduler
+    if scheduler_pid != pid:
+        with _deferred_result_scheduler_lock:
+            scheduler_pid, scheduler = _deferred_result_scheduler
+            if scheduler_pid != pid:
+                scheduler = DeferredResultScheduler()
+                _deferred_result_scheduler = (pid, scheduler)
+    return scheduler
+
+
+def get_task_result_writer():
+    """
+    Return the result writer for the current process, or None if buffered
+    result writes are disabled (CELERY_TASK_PLUS_DIRECT_RESULTS_BUFFERED).
+    """
+    global _task_result_writer
+    if not getattr(settings, 'CELERY_TASK_PLUS_DIRECT_RESULTS_BUFFERED', False):
+        return None
+    pid = os.getpid()
+    writer_pid, writer = _task_result_writer
+    if writer_pid != pid:
+        with _task_result_writer_lock:
+            writer_pid, writer = _task_result_writer
+            if writer_pid != pid:
+                writer = TaskResultWriter(
+                    max_queue_size=getattr(settings, 'CELERY_TASK_PLUS_DIRECT_RESULTS_QUEUE_SIZE', 10000),
+                    batch_size=getattr(settings, 'CELERY_TASK_PLUS_DIRECT_RESULTS_BATCH_SIZE', 500),
+                    flush_interval=getattr(settings, 'CELERY_TASK_PLUS_DIRECT_RESULTS_FLUSH_INTERVAL', 1.0),
+                )
+                _task_result_writer = (pid, writer)
+    return writer
+
+
+@atexit.register
+@worker_process_shutdown.connect
+def flush_task_result_writer(**kwargs):
+    """
+    Write any buffered results before the process exits.
+    """
+    writer_pid, writer = _task_result_writer
+    if writer is not None and writer_pid == os.getpid():
+        writer.stop()
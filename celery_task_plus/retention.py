@@ -0,0 +1,149 @@
+# Python
+import datetime
+import logging
+import time
+
+# Django
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+# Celery
+from celery import shared_task
+
+# Celery-Task-Plus
+from .compression import _get_spilled_filter, delete_stored_content
+from .tasks import LockedTask
+from . import metrics
+
+logger = logging.getLogger('celery_task_plus.retention')
+
+__all__ = ['RetentionPolicy', 'get_retention_policies', 'purge_task_results', 'purge_task_results_task']
+
+_default_retention = [dict(max_age=datetime.timedelta(days=1))]
+
+
+class RetentionPolicy(object):
+    """
+    Task results of the given task name (or of all tasks without their own
+    policy when None) and states (or all states when None) are purged once
+    they are older than max_age (a timedelta or seconds).
+    """
+
+    def __init__(self, max_age, task_name=None, states=None):
+        if not isinstance(max_age, datetime.timedelta):
+            max_age = datetime.timedelta(seconds=max_age)
+        self.max_age = max_age
+        self.task_name = task_name
+        self.states = list(states) if states is not None else None
+
+    def __repr__(self):
+        return '<RetentionPolicy {} {} {}>'.format(self.task_name or '*', ','.join(self.states or ['*']), self.max_age)
+
+    @property
+    def label(self):
+        return self.task_name or '*'
+
+    def get_queryset(self, now, exclude_task_names=()):
+        from django_celery_results.models import TaskResult
+        queryset = TaskResult.objects.filter(date_done__lt=now - self.max_age)
+        if self.task_name is not None:
+            queryset = queryset.filter(task_name=self.task_name)
+        elif exclude_task_names:
+            queryset = queryset.filter(Q(task_name__isnull=True) | ~Q(task_name__in=exclude_task_names))
+        if self.states is not None:
+            queryset = queryset.filter(status__in=self.states)
+        return queryset
+
+
+def get_retention_policies():
+    """
+    Return the retention policies from CELERY_TASK_PLUS_RESULT_RETENTION, a
+    list of dicts of RetentionPolicy arguments (by default all task results
+    are kept for one day).
+    """
+    retention = getattr(settings, 'CELERY_TASK_PLUS_RESULT_RETENTION', None) or _default_retention
+    return [RetentionPolicy(**options) for options in retention]
+
+
+def _purge_batch(queryset, ids, dry_run=False):
+    # Delete the rows with the given ids that still match the queryset, then
+    # the files their results or tracebacks were spilled to.
+    from django_celery_results.models import TaskResult
+    if dry_run:
+        return len(ids)
+    spilled = list(TaskResult.objects.filter(_get_spilled_filter(), id__in=ids).values_list('id', 'result', 'traceback'))
+    deleted, _ = queryset.filter(id__in=ids).delete()
+    if spilled:
+        kept_ids = set(TaskResult.objects.filter(id__in=[row[0] for row in spilled]).values_list('id', flat=True))
+        for row_id, result, traceback in spilled:
+            if row_id not in kept_ids:
+                delete_stored_content(result)
+                delete_stored_content(traceback)
+    return deleted
+
+
+def purge_task_results(policies=None, batch_size=None, sleep=None, max_batches=None, dry_run=False, progress=None):
+    """
+    Delete expired task results according to the retention policies, in
+    batches of batch_size rows (paginated by completion time and primary key)
+    with sleep seconds between batches so cleanup never holds long locks on
+    the table. Stops after max_batches batches if given. Calls progress(policy, count) after
+    each batch and returns the number of rows purged by policy label.
+    """
+    if policies is None:
+        policies = get_retention_policies()
+    if batch_size is None:
+        batch_size = getattr(settings, 'CELERY_TASK_PLUS_RESULT_PURGE_BATCH_SIZE', 1000)
+    if sleep is None:
+        sleep = getattr(settings, 'CELERY_TASK_PLUS_RESULT_PURGE_SLEEP', 0.1)
+    now = timezone.now()
+    task_names = [policy.task_name for policy in policies if policy.task_name is not None]
+    purged = {}
+    batches = 0
+    for policy in policies:
+        queryset = policy.get_queryset(now, task_names)
+        purged[policy.label] = purged.get(policy.label, 0)
+        # Keyset pagination on (date_done, id), so each batch is a range scan
+        # of the ctp_taskresult_done_id index.
+        last_key = None
+        while max_batches is None or batches < max_batches:
+            batch_start = time.monotonic()
+            batch_queryset = queryset
+            if last_key is not None:
+                last_date_done, last_id = last_key
+                batch_queryset = queryset.filter(Q(date_done__gt=last_date_done) | Q(date_done=last_date_done, id__gt=last_id))
+            rows = list(batch_queryset.order_by('date_done', 'id').values_list('date_done', 'id')[:batch_size])
+            if not rows:
+                break
+            last_key = rows[-1]
+            ids = [row_id for date_done, row_id in rows]
+            count = _purge_batch(queryset, ids, dry_run)
+            batches += 1
+            purged[policy.label] += count
+            if not dry_run:
+                metrics.incr('results_purged', count, task=policy.label)
+                metrics.observe('results_purge_batch', time.monotonic() - batch_start, task=policy.label)
+            logger.debug('Purged %d task results for %r (%d total)', count, policy, purged[policy.label])
+            if progress is not None:
+                progress(policy, purged[policy.label])
+            if len(ids) < batch_size:
+                break
+            if sleep:
+                time.sleep(sleep)
+    return purged
+
+
+@shared_task(
+    base=LockedTask,
+    name='celery_task_plus.purge_task_results',
+    ignore_result=True,
+    task_key_args=False,
+    task_key_kwargs=False,
+)
+def purge_task_results_task(max_batches=None):
+    """
+    Periodic task to purge expired task results, running one at a time.
+    """
+    purged = purge_task_results(max_batches=max_batches)
+    logger.info('Purged task results: %r', purged)
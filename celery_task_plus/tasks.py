@@ -4,31 +4,78 @@ import json
 import logging
 import os
 import socket
-import urllib.parse
+import time
 import uuid
 
 # Django
 from django.conf import settings
-from django.core.cache import cache
-from django.utils.text import slugify
 
 # Celery
-from celery import states, Task
+from celery import current_app, states, Task
 from celery.app.task import Context
-from celery.exceptions import Ignore, Reject
+from celery.exceptions import Ignore, Reject, TaskRevokedError
+from celery.utils import uuid as celery_uuid
+from celery.utils.time import get_exponential_backoff_interval, rate
 
-# Redis
-from redis import StrictRedis
-
-# Python-Redis-Lock
-import redis_lock
+# Celery-Task-Plus
+from .backends import RedisLockBackend, get_lock_backend
+from .clients import get_lock_client, get_owner_id
+from .caching import LocalResultCache
+from .keys import TaskKeyPlan
+from .locks import (
+    Lock, Semaphore, acquire_lock_in_order, check_rate_limit, clear_pending_task, get_tuned_lock_expire,
+    iter_parked_task_names, park_task, pop_parked_task, record_lock_hold, set_pending_task,
+)
+from .results import DeferredResult, get_task_result_writer
+from . import metrics
 
 logger = logging.getLogger('celery_task_plus.tasks')
 
-__all__ = ['LockedTask', 'DirectResultsTask', 'LockedDirectResultsTask']
+__all__ = [
+    'KeyedTask', 'LockedTask', 'CachedTask', 'DirectResultsTask', 'LockedDirectResultsTask', 'release_parked_task',
+    'release_orphaned_parked_tasks',
+]
+
+
+def release_parked_task(redis_client, task_key, released=False):
+    """
+    Send the next task parked for the task key (see LockedTask.task_lock_park).
+    Unless released is True (the lock was just released), nothing is sent while
+    the lock is held or a parked task sent before hasn't released it yet.
+    Return True if a task was sent.
+    """
+    sent_expire = getattr(settings, 'CELERY_TASK_PLUS_LOCK_PARK_SENT_EXPIRE', 600)
+    message = pop_parked_task(redis_client, task_key, sent_expire, released)
+    if message is None:
+        return False
+    try:
+        message = json.loads(message)
+        task = current_app.tasks[message['task']]
+        metrics.incr('task_unparked', task=task.name, lock=task._get_task_key_plan().key_prefix)
+        # Parked again at the head of the list if the lock was taken meanwhile.
+        task.apply_async(
+            message['args'], message['kwargs'], message['task_id'], link=message['link'],
+            link_error=message['link_error'], shadow=message['shadow'], _park_at_head=True, **message['options']
+        )
+    except Exception:
+        logger.exception('Unable to send parked task: %s', message)
+        return False
+    return True
 
 
-class LockedTask(Task):
+def release_orphaned_parked_tasks(redis_client, count=500):
+    """
+    Send the next parked task for each task key whose lock was freed without
+    releasing one (e.g. it expired). Return the number of tasks sent.
+    """
+    return sum(release_parked_task(redis_client, task_key) for task_key in iter_parked_task_names(redis_client, count))
+
+
+class KeyedTask(Task):
+    """
+    Base class for tasks that derive a key from their name and arguments (see
+    LockedTask and CachedTask).
+    """
 
     abstract = True
 
@@ -36,132 +83,500 @@ class LockedTask(Task):
     task_key_name = True
     # Include args in task_key? True or <int> (for number of positional args).
     task_key_args = True
-    # Include kwargs in task_key? True or iterable of keys to include.
+    # Include kwargs in task_key? True, <str> or iterable of keys to include.
     task_key_kwargs = True
+    # Use a fixed-length digest of the task key arguments instead of the full
+    # slugified arguments? (<name>:<blake2b hexdigest>)
+    task_key_hash = False
+    # If > 0, store the arguments used for a hashed task key in Redis (as
+    # "task-key:<task_key>") for this many seconds, to help with debugging.
+    task_key_debug = 0
+
+    @classmethod
+    def _get_task_key_plan(cls):
+        task_key_plan = cls.__dict__.get('_task_key_plan')
+        if task_key_plan is None or not task_key_plan.matches(cls):
+            task_key_plan = TaskKeyPlan.for_task(cls)
+            cls._task_key_plan = task_key_plan
+        return task_key_plan
+
+    @classmethod
+    def _get_task_key(cls, *args, **kwargs):
+        task_key_plan = cls._get_task_key_plan()
+        task_key = task_key_plan.build(args, kwargs)
+        if task_key_plan.key_hash and cls.task_key_debug:
+            redis_client = get_lock_client()
+            redis_client.set('task-key:{}'.format(task_key), task_key_plan.describe(args, kwargs), ex=cls.task_key_debug)
+        return task_key
+
+
+class LockedTask(KeyedTask):
+
+    abstract = True
+
+    # Lock several keys instead of the task key? Iterable of dicts of task_key_*
+    # options (overriding the task's own options, so {} is the task key), e.g.
+    # [dict(task_key_name='account', task_key_args=1),
+    #  dict(task_key_name='tenant', task_key_args=False, task_key_kwargs=['tenant'])].
+    # All the keys are acquired at once, in sorted order.
+    task_key_specs = None
+    # 'exclusive' or 'shared'. Any number of tasks can hold shared locks of the
+    # same keys at the same time, but not together with an exclusive lock.
+    task_lock_mode = 'exclusive'
+    # If > 0, allow up to this many tasks with the same task key to run at once
+    # (cluster-wide) instead of one. Each running task holds a lease that is
+    # renewed like a lock and expires if its worker is lost.
+    task_concurrency_limit = None
+    # Dotted path of the lock backend (see celery_task_plus.backends). If None,
+    # CELERY_TASK_PLUS_LOCK_BACKEND is used (default RedisLockBackend). The
+    # threading and file backends only support exclusive locks of one key.
+    task_lock_backend = None
+    # Lock expiry in seconds. Held locks are renewed by a single thread per
+    # worker process (see LockRenewer). If None, the expiry is tuned to twice
+    # the average time the task has held its lock in this process, between
+    # task_lock_expire_min and task_lock_expire_max.
+    task_lock_expire = 60
+    task_lock_expire_min = 10
+    task_lock_expire_max = 300
     # If None, task will block until lock is released. If 0, task will fail immediately if lock cannot be acuired.
     # If > 0, task will wait up to this many seconds to acquire the lock.
     task_lock_timeout = 0
+    # How to wait for the lock when blocking: 'signal' lets all waiters race to
+    # reacquire a released lock, 'queue' hands it to waiters in FIFO order.
+    task_lock_wait = 'signal'
+    # If True, a task that cannot acquire its lock is retried later (with
+    # exponential backoff) instead of being rejected, freeing the worker. The
+    # task is rejected once it has been retried task_lock_defer_max_retries
+    # times. Tasks called directly or eagerly are always rejected.
+    task_lock_defer = False
+    task_lock_defer_max_retries = 10
+    # Backoff factor and maximum (in seconds) for the retry countdown.
+    task_lock_defer_countdown = 1
+    task_lock_defer_countdown_max = 60
+    # Randomize the countdown between 0 and the backoff interval?
+    task_lock_defer_jitter = True
+    # Limit the rate of tasks with the same task key across all workers, e.g.
+    # '10/m' (see Task.rate_limit), allowing bursts of up to
+    # task_key_rate_limit_burst tasks. Tasks over the limit are retried once
+    # they would be allowed (directly called or eager tasks are rejected).
+    task_key_rate_limit = None
+    task_key_rate_limit_burst = 1
+    task_key_rate_limit_max_retries = None
+    # If > 0, duplicate submissions (with the same task key) of a task that is
+    # still waiting in the queue are not sent to the broker for up to this many
+    # seconds; apply_async/delay return the result of the pending task instead.
+    task_enqueue_dedup = 0
+    # If True, tasks published while their task key is locked are parked in
+    # Redis instead of being sent to the broker, and are sent again one at a
+    # time (oldest first) as the lock is released, so workers only prefetch
+    # runnable tasks. Only applies to exclusive locks of the task key with the
+    # Redis lock backend, and not to tasks with a countdown or eta.
+    task_lock_park = False
+    # Seconds to keep parked tasks while the lock stays held.
+    task_lock_park_expire = 86400
 
     @classmethod
-    def _get_task_key(cls, *args, **kwargs):
-        if cls.task_key_name is True:
-            task_key_name = cls.name
-        else:
-            task_key_name = '{}'.format(cls.task_key_name or '')
-        task_key_args = []
-        if cls.task_key_args is True:
-            task_key_args.extend([json.dumps(a) for a in args[:]])
-        elif isinstance(cls.task_key_args, int):
-            task_key_args.extend([json.dumps(a) for a in args[:cls.task_key_args]])
-        if cls.task_key_kwargs:
-            for k in sorted(kwargs.keys()):
-                if cls.task_key_kwargs is True or k in cls.task_key_kwargs:
-                    task_key_args.append('{}={}'.format(k, json.dumps(kwargs[k])))
-        if task_key_args:
-            task_key = '{}-{}'.format(task_key_name, '-'.join(task_key_args))
-        else:
-            task_key = task_key_name
-        task_key = task_key.replace('.', '-').replace('_', '-')
-        return slugify(task_key)[:250]
+    def _get_task_key_plans(cls):
+        config = (cls.task_key_specs, cls.name, cls.task_key_name, cls.task_key_args, cls.task_key_kwargs, cls.task_key_hash)
+        task_key_plans = cls.__dict__.get('_task_key_plans')
+        if task_key_plans is None or task_key_plans[0] != config:
+            task_key_plans = (config, [TaskKeyPlan.for_spec(cls, spec) for spec in cls.task_key_specs or ()])
+            cls._task_key_plans = task_key_plans
+        return task_key_plans[1]
+
+    @classmethod
+    def _get_task_lock_keys(cls, task_key, args, kwargs):
+        # Return the task key, or the sorted list of keys from task_key_specs.
+        if not cls.task_key_specs:
+            return task_key
+        return sorted({plan.build(args, kwargs) for plan in cls._get_task_key_plans()})
 
     @classmethod
     def _get_owner_id(cls):
-        return urllib.parse.urlencode([
-            ('hostname', socket.gethostname()),
-            ('pid', os.getpid()),
-        ]).encode('utf-8')
+        return get_owner_id()
 
     @classmethod
-    def _get_redis_lock(cls, task_key, expire=60, auto_renewal=True):
-        try:
-            redis_client = cache.client.get_client()
-        except AttributeError:
-            redis_client = StrictRedis.from_url(settings.REDIS_URL)
-        owner_id = cls._get_owner_id()
-        return redis_lock.Lock(redis_client, task_key, id=owner_id, expire=expire, auto_renewal=auto_renewal)
+    def _get_lock_backend(cls):
+        return get_lock_backend(cls.task_lock_backend)
 
     @classmethod
-    @contextlib.contextmanager
-    def _lock_task(cls, task_key, exc_class=Reject):
+    def _get_lock(cls, task_key, expire=60, auto_renewal=True):
+        return cls._get_lock_backend().get_lock(
+            task_key, cls._get_owner_id(), expire=expire, auto_renewal=auto_renewal,
+            shared=cls.task_lock_mode == 'shared', limit=cls.task_concurrency_limit,
+        )
+
+    @classmethod
+    def _get_lock_expire(cls):
+        if cls.task_lock_expire is None:
+            return get_tuned_lock_expire(cls.name, cls.task_lock_expire_min, cls.task_lock_expire_max)
+        return cls.task_lock_expire
+
+    @classmethod
+    def _get_lock_options(cls):
+        # Return the (expire, blocking, timeout) to acquire the lock with.
+        expire = cls._get_lock_expire()
         if cls.task_lock_timeout is None:
-            expire = 60
-            blocking = True
-            timeout = None
+            return expire, True, None
         elif cls.task_lock_timeout == 0:
-            expire = 60
-            blocking = False
-            timeout = None
-        else:
-            expire = max(60, cls.task_lock_timeout)
-            blocking = True
-            timeout = cls.task_lock_timeout
+            return expire, False, None
+        return max(expire, cls.task_lock_timeout), True, cls.task_lock_timeout
+
+    @classmethod
+    def _get_lock_contended_message(cls, task_key, owner_id, lock_owner_id):
+        if lock_owner_id == owner_id:
+            return 'Already acquired this lock: {0} @ {1}'.format(task_key, owner_id)
+        return 'Lock held by another process: {0} @ {1}'.format(task_key, lock_owner_id)
+
+    @classmethod
+    @contextlib.contextmanager
+    def _lock_task(cls, task_key, exc_class=Reject):
+        expire, blocking, timeout = cls._get_lock_options()
         owner_id = cls._get_owner_id()
-        lock = cls._get_redis_lock(task_key, expire)
+        lock = cls._get_lock(task_key, expire)
+        metric_labels = dict(task=cls.name, lock=cls._get_task_key_plan().key_prefix)
+        lock.metric_labels = metric_labels
         acquired = False
+        acquire_start = time.monotonic()
         try:
             if blocking:
-                timeout_display = '{}s'.format(timeout) if timeout else 'indefinitely'
-                logger.debug('Waiting {0} for lock: {1}'.format(timeout_display, task_key))
-            acquired = lock.acquire(blocking=blocking, timeout=timeout)
+                if timeout:
+                    logger.debug('Waiting %ss for lock: %s', timeout, task_key)
+                else:
+                    logger.debug('Waiting indefinitely for lock: %s', task_key)
+                if cls.task_lock_wait == 'queue' and type(lock) is Lock:
+                    acquired = acquire_lock_in_order(lock, get_lock_client(), task_key, timeout, expire)
+                else:
+                    acquired = lock.acquire(blocking=True, timeout=timeout)
+            else:
+                acquired = lock.acquire(blocking=False)
+            acquire_end = time.monotonic()
+            metrics.observe('lock_acquire', acquire_end - acquire_start, **metric_labels)
+            if isinstance(lock, Semaphore):
+                metrics.gauge('semaphore_slots_used', lock.slots_used, **metric_labels)
+                if lock.stale_released:
+                    metrics.incr('semaphore_stale_released', lock.stale_released, **metric_labels)
             if acquired:
-                logger.debug('Acquired the lock: {0} @ {1}'.format(task_key, owner_id))
+                metrics.incr('lock_acquired', **metric_labels)
+                logger.debug('Acquired the lock: %s @ %s', task_key, owner_id)
                 yield
             else:
-                if lock.get_owner_id() == owner_id:
-                    msg = 'Already acquired this lock: {0} @ {1}'.format(task_key, owner_id)
+                metrics.incr('lock_contended', **metric_labels)
+                if isinstance(lock, Semaphore):
+                    msg = 'Concurrency limit reached: {0} ({1} of {2} slots used)'.format(task_key, lock.slots_used, lock.limit)
                 else:
-                    msg = 'Lock held by another process: {0} @ {1}'.format(task_key, lock.get_owner_id())
+                    msg = cls._get_lock_contended_message(task_key, owner_id, lock.last_owner_id)
                 logger.debug(msg)
                 raise exc_class(msg)
         finally:
             if acquired:
-                lock.release()
-                logger.debug('Released the lock: {0} @ {1}'.format(task_key, owner_id))
+                lock.release(notify_waiter=cls.task_lock_wait == 'queue' and type(lock) is Lock)
+                hold_time = time.monotonic() - acquire_end
+                record_lock_hold(cls.name, hold_time)
+                metrics.observe('lock_hold', hold_time, **metric_labels)
+                logger.debug('Released the lock: %s @ %s', task_key, owner_id)
+                if cls.task_lock_park and type(lock) is Lock:
+                    release_parked_task(get_lock_client(), task_key, released=True)
+
+    def _defer_locked_task(self, exc):
+        if self.request.called_directly or self.request.is_eager:
+            raise exc
+        countdown = get_exponential_backoff_interval(
+            factor=self.task_lock_defer_countdown,
+            retries=self.request.retries,
+            maximum=self.task_lock_defer_countdown_max,
+            full_jitter=self.task_lock_defer_jitter,
+        )
+        metrics.incr('lock_deferred', task=self.name)
+        logger.debug('Deferring task_id = %s for %ss: %s', self.request.id, countdown, exc)
+        raise self.retry(exc=exc, countdown=countdown, max_retries=self.task_lock_defer_max_retries)
+
+    def _check_task_key_rate_limit(self, task_key):
+        task_rate = rate(self.task_key_rate_limit)
+        if task_rate:
+            wait = check_rate_limit(get_lock_client(), task_key, task_rate, self.task_key_rate_limit_burst)
+            if wait:
+                self._defer_rate_limited_task(task_key, wait)
+
+    def _defer_rate_limited_task(self, task_key, wait):
+        metrics.incr('rate_limited', task=self.name, lock=self._get_task_key_plan().key_prefix)
+        msg = 'Rate limit exceeded: {0} (allowed in {1:.3f}s)'.format(task_key, wait)
+        logger.debug(msg)
+        if self.request.called_directly or self.request.is_eager:
+            raise Reject(msg)
+        raise self.retry(exc=Reject(msg), countdown=wait, max_retries=self.task_key_rate_limit_max_retries)
+
+    @classmethod
+    def _can_park_task(cls, options):
+        if not cls.task_lock_park or cls.app.conf.task_always_eager:
+            return False
+        if options.get('countdown') is not None or options.get('eta') is not None:
+            return False
+        if cls.task_key_specs or cls.task_lock_mode != 'exclusive' or cls.task_concurrency_limit:
+            return False
+        return isinstance(cls._get_lock_backend(), RedisLockBackend)
+
+    def _park_task(self, task_key, args, kwargs, task_id, link, link_error, shadow, options, park_at_head):
+        # Park the task if its lock is held. Returns (parked, locked).
+        message = dict(task=self.name, args=args, kwargs=kwargs, task_id=task_id, link=link, link_error=link_error, shadow=shadow, options=options)
+        try:
+            message = json.dumps(message)
+        except TypeError:
+            return False, False
+        parked, locked = park_task(get_lock_client(), task_key, task_id, message, self.task_lock_park_expire, park_at_head)
+        if parked:
+            metrics.incr('task_parked', task=self.name, lock=self._get_task_key_plan().key_prefix)
+            logger.debug('Parked task_id = %s while locked: %s', task_id, task_key)
+        return parked, locked
+
+    def apply_async(self, args=None, kwargs=None, task_id=None, producer=None, link=None, link_error=None, shadow=None, **options):
+        park_at_head = options.pop('_park_at_head', False)
+        can_park_task = self._can_park_task(options)
+        if not self.task_enqueue_dedup and not can_park_task:
+            return super().apply_async(args, kwargs, task_id, producer, link, link_error, shadow, **options)
+        task_key = self._get_task_key(*(args or ()), **(kwargs or {}))
+        task_id = task_id or celery_uuid()
+        if self.task_enqueue_dedup:
+            pending_task_id = set_pending_task(get_lock_client(), task_key, task_id, self.task_enqueue_dedup)
+            # A parked task keeps its pending marker when it's sent again.
+            if pending_task_id and pending_task_id != task_id:
+                metrics.incr('enqueue_deduplicated', task=self.name)
+                logger.debug('Task already pending: %s @ %s', task_key, pending_task_id)
+                return self.AsyncResult(pending_task_id)
+        try:
+            parked, locked = False, False
+            if can_park_task:
+                parked, locked = self._park_task(task_key, args, kwargs, task_id, link, link_error, shadow, options, park_at_head)
+            if not parked:
+                return super().apply_async(args, kwargs, task_id, producer, link, link_error, shadow, **options)
+        except Exception:
+            if self.task_enqueue_dedup:
+                clear_pending_task(get_lock_client(), task_key, task_id)
+            raise
+        # Parked behind tasks parked before the lock was freed some other way
+        # (e.g. it expired), so send the oldest one.
+        if not locked:
+            release_parked_task(get_lock_client(), task_key)
+        return self.AsyncResult(task_id)
 
     def __call__(self, *args, **kwargs):
-        with self._lock_task(self._get_task_key(*args, **kwargs)):
+        task_key = self._get_task_key(*args, **kwargs)
+        if self.task_enqueue_dedup and self.request.id:
+            clear_pending_task(get_lock_client(), task_key, self.request.id)
+        if self.task_key_rate_limit:
+            self._check_task_key_rate_limit(task_key)
+        lock_keys = self._get_task_lock_keys(task_key, args, kwargs)
+        with contextlib.ExitStack() as stack:
+            try:
+                stack.enter_context(self._lock_task(lock_keys))
+            except Reject as e:
+                if not self.task_lock_defer:
+                    raise
+                self._defer_locked_task(e)
             return super().__call__(*args, **kwargs)
 
 
-class DirectResultsTask(Task):
+class CachedTask(KeyedTask):
 
     abstract = True
 
+    # Seconds to cache successful results for, by task key.
+    task_cache_ttl = 60
+    # Maximum number of results to also keep in memory in each process (0 to
+    # only cache results in Redis).
+    task_cache_local_size = 128
+    # Cache results in Redis, shared by all processes? Concurrent calls with
+    # the same task key then wait (up to task_cache_wait seconds) for the
+    # first call to compute the result instead of each computing it.
+    task_cache_redis = True
+    task_cache_wait = 30
+
+    @classmethod
+    def _get_local_result_cache(cls):
+        local_cache = cls.__dict__.get('_local_result_cache')
+        if local_cache is None or local_cache.max_size != cls.task_cache_local_size:
+            local_cache = LocalResultCache(cls.task_cache_local_size)
+            cls._local_result_cache = local_cache
+        return local_cache
+
+    @classmethod
+    def _get_cache_key(cls, task_key):
+        return 'task-cache:{}'.format(task_key)
+
+    def _get_cached_result(self, task_key):
+        # Return the (tier, encoded result) cached for the task key, or None.
+        local_cache = self._get_local_result_cache()
+        value = local_cache.get(task_key)
+        if value is not None:
+            return 'local', value
+        if self.task_cache_redis:
+            with get_lock_client().pipeline() as pipe:
+                pipe.get(self._get_cache_key(task_key))
+                pipe.pttl(self._get_cache_key(task_key))
+                value, ttl = pipe.execute()
+            if value is not None:
+                local_cache.set(task_key, value, max(ttl, 0) / 1000.0)
+                return 'redis', value
+        return None
+
+    def _set_cached_result(self, task_key, result):
+        try:
+            value = self.backend.encode(result)
+        except Exception:
+            logger.warning('Unable to cache the result of %s: %s', self.name, task_key, exc_info=True)
+            return
+        self._get_local_result_cache().set(task_key, value, self.task_cache_ttl)
+        if self.task_cache_redis:
+            get_lock_client().set(self._get_cache_key(task_key), value, ex=self.task_cache_ttl)
+
+    @classmethod
+    def clear_cached_result(cls, *args, **kwargs):
+        """
+        Remove the cached result for the given task arguments.
+        """
+        task_key = cls._get_task_key(*args, **kwargs)
+        cls._get_local_result_cache().delete(task_key)
+        if cls.task_cache_redis:
+            get_lock_client().delete(cls._get_cache_key(task_key))
+
     def __call__(self, *args, **kwargs):
-        task_id = self.request.id or uuid.uuid4()
-        task_result = None
-        task_exc = None
+        task_key = self._get_task_key(*args, **kwargs)
+        cached = self._get_cached_result(task_key)
+        lock = None
+        if cached is None and self.task_cache_redis:
+            # Only one call per task key computes the result at a time; the
+            # others wait for it and then use the cached result.
+            lock = Lock(get_lock_client(), self._get_cache_key(task_key), id=get_owner_id(), auto_renewal=True)
+            lock.metric_labels = dict(task=self.name, lock=self._get_task_key_plan().key_prefix)
+            if not lock.acquire(blocking=False):
+                metrics.incr('cache_wait', task=self.name)
+                if not lock.acquire(timeout=self.task_cache_wait):
+                    lock = None
+                cached = self._get_cached_result(task_key)
+        try:
+            if cached is None:
+                metrics.incr('cache_miss', task=self.name)
+                result = super().__call__(*args, **kwargs)
+                self._set_cached_result(task_key, result)
+                return result
+        finally:
+            if lock is not None:
+                lock.release()
+        tier, value = cached
+        metrics.incr('cache_hit', task=self.name, tier=tier)
+        logger.debug('Using cached result (%s): %s', tier, task_key)
+        return self.backend.decode(value)
+
+
+class DirectResultsTask(Task):
+
+    abstract = True
+
+    # If > 0, only store the started state for eager or direct calls that are
+    # still running after this many seconds. If None, use the
+    # CELERY_TASK_PLUS_DIRECT_RESULTS_STARTED_DELAY setting (default 0).
+    direct_results_started_delay = None
+
+    def _store_direct_result(self, task_id, result, state, request=None, mark_as=None):
+        # Store the result using the backend mark_as_* method (if given) or
+        # store_result. When buffered writes are enabled, the mark_as_* method
+        # only handles chords/errbacks and the result is queued for the writer.
+        store_start = time.monotonic()
+        writer = get_task_result_writer()
+        if writer is None:
+            if mark_as is None:
+                self.backend.store_result(task_id, result, state, request=request)
+            else:
+                mark_as(task_id, result, request=request)
+        else:
+            if mark_as is not None:
+                mark_as(task_id, result, request=request, store_result=False)
+            if state == states.REVOKED:
+                result = TaskRevokedError(result)
+            writer.put(self.backend, task_id, result, state, request=request)
+        metrics.observe('result_store', time.monotonic() - store_start, task=self.name, state=state)
+
+    def _get_direct_results_call(self, args, kwargs):
+        call = dict(task_id=self.request.id or uuid.uuid4())
 
         # Determine if task is called outside of a worker (via apply or
         # __call__).
         task_is_direct = self.request.is_eager or self.request.called_directly
+        call['task_is_direct'] = task_is_direct
 
         # If called directly via __call__, create a placeholder request context
         # used for the result backend.
         if self.request.called_directly:
-            task_request = Context({}, task=self.name, args=args, kwargs=kwargs)
+            call['task_request'] = Context({}, task=self.name, args=args, kwargs=kwargs)
         else:
-            task_request = self.request
+            call['task_request'] = self.request
 
         # Celery already tracks the started state from the worker when:
         #   (track_started and not eager and not ignore_result)
         # Set a flag to store started status for eager or direct calls.
-        store_started = task_is_direct and self.track_started and not self.ignore_result
+        call['store_started'] = task_is_direct and self.track_started and not self.ignore_result
 
         # Celery already stores task results from the worker when:
         #   (not eager and not ignore_result)
         # Set flags to store results, errors and ignored exceptions for eager or
         # direct calls.
-        store_result = task_is_direct and not self.ignore_result
-        store_errors = task_is_direct and (not self.ignore_result or self.store_errors_even_if_ignored)
-        store_ignored = not self.ignore_result or self.store_errors_even_if_ignored
-        store_revoked = not self.ignore_result or self.store_errors_even_if_ignored
+        call['store_result'] = task_is_direct and not self.ignore_result
+        call['store_errors'] = task_is_direct and (not self.ignore_result or self.store_errors_even_if_ignored)
+        call['store_ignored'] = not self.ignore_result or self.store_errors_even_if_ignored
+        call['store_revoked'] = not self.ignore_result or self.store_errors_even_if_ignored
+        return call
+
+    def _get_direct_results_started(self):
+        # Return the started meta and the delay before storing it.
+        meta = dict(pid=os.getpid(), hostname=socket.gethostname())
+        started_delay = self.direct_results_started_delay
+        if started_delay is None:
+            started_delay = getattr(settings, 'CELERY_TASK_PLUS_DIRECT_RESULTS_STARTED_DELAY', 0)
+        return meta, started_delay
+
+    def _get_direct_results_final(self, call, task_result, task_exc):
+        # Return the (result, state, mark_as) to store once the task has
+        # finished, or None.
+        if task_exc:
+            # Store ignored state for any tasks (since worker does not store
+            # this state).
+            if isinstance(task_exc, Ignore):
+                if call['store_ignored']:
+                    # FIXME: Send event!
+                    return str(task_exc), states.IGNORED, None
+            # Store rejected/revoked state for any tasks (since worker does
+            # not store this state as a result of a Reject exception).
+            elif isinstance(task_exc, Reject):
+                if call['store_revoked']:
+                    if not call['task_is_direct']:
+                        self.send_event('task-rejected', requeue=False)
+                    return task_exc, states.REVOKED, self.backend.mark_as_revoked
+            # Store errors for eager or direct tasks.
+            elif call['store_errors']:
+                return task_exc, states.FAILURE, self.backend.mark_as_failure
+        # Store results for eager or direct tasks.
+        elif call['store_result']:
+            return task_result, states.SUCCESS, self.backend.mark_as_done
+        return None
 
-        # Store started state for eager or direct tasks.
-        if store_started:
-            meta = dict(pid=os.getpid(), hostname=socket.gethostname())
-            self.backend.store_result(task_id, meta, states.STARTED, request=task_request)
-            logger.debug('Marked task_id = {} as started'.format(task_id))
+    def __call__(self, *args, **kwargs):
+        call = self._get_direct_results_call(args, kwargs)
+        task_id = call['task_id']
+        task_request = call['task_request']
+        task_result = None
+        task_exc = None
+
+        # Store started state for eager or direct tasks, either now or after a
+        # delay if the task is still running.
+        deferred_started = None
+        if call['store_started']:
+            meta, started_delay = self._get_direct_results_started()
+            if started_delay:
+                deferred_started = DeferredResult(started_delay, self._store_direct_result, task_id, meta, states.STARTED, request=task_request)
+                deferred_started.start()
+            else:
+                self._store_direct_result(task_id, meta, states.STARTED, request=task_request)
+                logger.debug('Marked task_id = %s as started', task_id)
 
         try:
             # Run the actual task.
@@ -174,30 +589,13 @@ class DirectResultsTask(Task):
             task_exc = e
             raise
         finally:
-            if task_exc:
-                # Store ignored state for any tasks (since worker does not store
-                # this state).
-                if isinstance(task_exc, Ignore):
-                    if store_ignored:
-                        self.backend.store_result(task_id, str(task_exc), states.IGNORED, request=task_request)
-                        logger.debug('Marked task_id = {0} as ignored: {1!r}'.format(task_id, task_exc))
-                        # FIXME: Send event!
-                # Store rejected/revoked state for any tasks (since worker does
-                # not store this state as a result of a Reject exception).
-                elif isinstance(task_exc, Reject):
-                    if store_revoked:
-                        if not task_is_direct:
-                            self.send_event('task-rejected', requeue=False)
-                        self.backend.mark_as_revoked(task_id, task_exc, request=task_request)
-                        logger.debug('Marked task_id = {0} as revoked: {1!r}'.format(task_id, task_exc))
-                # Store errors for eager or direct tasks.
-                elif store_errors:
-                    self.backend.mark_as_failure(task_id, task_exc, request=task_request)
-                    logger.debug('Marked task_id = {0} as failure: %{1!r}'.format(task_id, task_exc))
-            # Store results for eager or direct tasks.
-            elif store_result:
-                self.backend.mark_as_done(task_id, task_result, request=task_request)
-                logger.debug('Marked task_id = {0} as done: {1!r}'.format(task_id, task_exc))
+            if deferred_started is not None:
+                deferred_started.cancel()
+            final = self._get_direct_results_final(call, task_result, task_exc)
+            if final is not None:
+                result, state, mark_as = final
+                self._store_direct_result(task_id, result, state, request=task_request, mark_as=mark_as)
+                logger.debug('Marked task_id = %s as %s: %r', task_id, state, result)
 
 
 class LockedDirectResultsTask(DirectResultsTask, LockedTask):
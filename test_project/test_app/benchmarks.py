@@ -0,0 +1,88 @@
+# Python
+import threading
+
+# pytest
+import pytest
+
+# Celery
+from celery import shared_task
+
+# Celery-Task-Plus
+from celery_task_plus.locks import Lock
+from celery_task_plus.tasks import LockedTask
+
+# Test App
+from .tasks import direct_results_task
+
+task_key_args = {
+    'small': ((1, 'abc'), {'q': 3}),
+    'large': (tuple(range(100)) + ('x' * 1000,), {'k{}'.format(i): i for i in range(100)}),
+    'nested': (({'a': [1, 2, {'b': 'c'}]}, [1.5, None]), {'q': {'z': [1, 2, 3]}}),
+}
+
+# Exception arguments by name, so large arguments aren't stored with the
+# benchmark results as parameters.
+exception_args = {
+    'small': ('message',),
+    'large': ('message', list(range(10000))),
+    'unserializable': ('message', object()),
+}
+
+
+def _create_locked_task(name, **options):
+
+    def task_func(*args, **kwargs):
+        pass
+
+    return shared_task(base=LockedTask, name=name, **options)(task_func)
+
+
+@pytest.mark.parametrize('task_key_hash', [False, True], ids=['slug', 'hash'])
+@pytest.mark.parametrize('args_name', ['small', 'large', 'nested'])
+def test_get_task_key(benchmark, args_name, task_key_hash):
+    task_class = _create_locked_task('test_app.benchmark_task_key', task_key_hash=task_key_hash)
+    args, kwargs = task_key_args[args_name]
+    benchmark(task_class._get_task_key, *args, **kwargs)
+
+
+@pytest.mark.parametrize('contention', [0, 1, 4])
+def test_lock_task(benchmark, redis_client, contention):
+    # Other threads (with their own owner ids) repeatedly acquire and release
+    # the same lock while it is acquired and released in the benchmark.
+    task_class = _create_locked_task('test_app.benchmark_lock_task', task_lock_timeout=5)
+    task_key = task_class._get_task_key(1)
+    stopped = threading.Event()
+
+    def contend(owner_id):
+        lock = Lock(redis_client, task_key, id=owner_id, expire=60)
+        while not stopped.is_set():
+            if lock.acquire(blocking=False):
+                lock.release()
+
+    threads = [threading.Thread(target=contend, args=('contender{}'.format(n),)) for n in range(contention)]
+    for thread in threads:
+        thread.start()
+
+    def lock_task():
+        with task_class._lock_task(task_key):
+            pass
+
+    try:
+        benchmark(lock_task)
+    finally:
+        stopped.set()
+        for thread in threads:
+            thread.join()
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('track_started', [False, True], ids=['no-started', 'started'])
+def test_direct_results_task_apply(benchmark, monkeypatch, track_started):
+    monkeypatch.setattr(direct_results_task, 'track_started', track_started)
+    benchmark(direct_results_task.apply)
+
+
+@pytest.mark.parametrize('exc_args_name', ['small', 'large', 'unserializable'])
+def test_encode_result_exception(benchmark, exc_args_name):
+    backend = direct_results_task.backend
+    benchmark(backend.encode_result, ValueError(*exception_args[exc_args_name]), 'FAILURE')
@@ -0,0 +1,46 @@
+# Python
+import os
+
+# pytest
+import pytest
+
+# FakeRedis
+import fakeredis
+
+# Redis
+from redis import StrictRedis
+from redis.asyncio import StrictRedis as AsyncStrictRedis
+
+# Celery-Task-Plus
+from celery_task_plus import aio, clients
+from celery_task_plus.clients import reset_lock_client
+
+
+@pytest.fixture
+def redis_client():
+    # Use a real Redis server for locks when TEST_REDIS_URL is set.
+    redis_url = os.environ.get('TEST_REDIS_URL', None)
+    if redis_url:
+        redis_client = StrictRedis.from_url(redis_url)
+        redis_client.flushdb()
+    else:
+        redis_client = fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())
+    clients._lock_client = (os.getpid(), redis_client)
+    try:
+        yield redis_client
+    finally:
+        reset_lock_client()
+
+
+@pytest.fixture
+def async_redis_client(redis_client, monkeypatch):
+    # Use an asyncio client for the same server as redis_client (created in
+    # each event loop that uses it).
+    redis_url = os.environ.get('TEST_REDIS_URL', None)
+    if redis_url:
+        create_client = lambda: AsyncStrictRedis.from_url(redis_url)  # noqa: E731
+    else:
+        server = redis_client.connection_pool.connection_kwargs['server']
+        create_client = lambda: fakeredis.FakeAsyncRedis(server=server)  # noqa: E731
+    monkeypatch.setattr(aio, 'get_async_lock_client', create_client)
+    return create_client
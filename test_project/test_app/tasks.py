@@ -1,7 +1,11 @@
+# Python
+import asyncio
+
 # Celery
 from celery import shared_task
 
 # Celery-Task-Plus
+from celery_task_plus.aio import AsyncLockedDirectResultsTask
 from celery_task_plus.tasks import LockedTask, DirectResultsTask, LockedDirectResultsTask
 
 
@@ -34,3 +38,12 @@ def direct_results_task():
 )
 def locked_direct_results_task():
     pass
+
+
+@shared_task(
+    name='test_app.async_locked_direct_results_task',
+    base=AsyncLockedDirectResultsTask,
+)
+async def async_locked_direct_results_task(delay=0):
+    await asyncio.sleep(delay)
+    return delay
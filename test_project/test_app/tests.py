@@ -1,11 +1,48 @@
+# Python
+import asyncio
+import datetime
+import io
+import socket
+import threading
+import time
+
 # pytest
 import pytest
 
 # Celery
-from celery import shared_task
+from celery import shared_task, Task
+from celery.exceptions import Reject, Retry
+from kombu.serialization import dumps
+
+# Django
+from django.core.cache import cache
+from django.core.management import call_command
+from django.urls import reverse
+from django.utils import timezone
+
+# Django-Celery-Results
+from django_celery_results.admin import TaskResultAdmin
+from django_celery_results.models import TaskResult
 
 # Celery-Task-Plus
-from celery_task_plus.tasks import LockedTask
+from celery_task_plus import aio, metrics
+from celery_task_plus.aio import AsyncLockedTask, get_async_lock_client
+from celery_task_plus.backends import FileLockBackend, ThreadingLockBackend, get_lock_backend
+from celery_task_plus.caching import LocalResultCache
+from celery_task_plus.clients import get_lock_client, get_owner_id, reset_lock_client
+from celery_task_plus.keys import TaskKeyPlan
+from celery_task_plus.locks import (
+    Lock, LockRenewer, MultiLock, NotAcquired, Semaphore, acquire_lock_in_order, check_rate_limit, force_release_lock,
+    get_lock_heartbeat_interval, get_tuned_lock_expire, iter_held_locks, notify_lock_waiter, reap_stale_locks,
+    record_lock_hold,
+)
+from celery_task_plus.patches import _get_json_size, _truncate
+from celery_task_plus.results import DeferredResult, TaskResultWriter
+from celery_task_plus.retention import purge_task_results
+from celery_task_plus.tasks import CachedTask, DirectResultsTask, LockedTask, release_orphaned_parked_tasks, release_parked_task
+
+# Test App
+from .tasks import async_locked_direct_results_task, direct_results_task
 
 
 @pytest.mark.parametrize('task_key_name,task_key_args,task_key_kwargs,task_name,task_args,task_kwargs,task_key', [
@@ -60,3 +97,1127 @@ def test_get_task_key(task_key_name, task_key_args, task_key_kwargs, task_name,
 
     generated_task_key = task_class._get_task_key(*task_args, **task_kwargs)
     assert generated_task_key == task_key
+
+    assert task_class._get_task_key_plan() is task_class._get_task_key_plan()
+
+
+@pytest.mark.parametrize('task_args,task_kwargs', [
+    ((), {}),
+    ((1, -2, 'abc', 'A_b.C', None, True, False), {'some_kwarg': 'value'}),
+    (('a b', 'a-', '', 'caf\u00e9', 1.5, [1, 2], {'a': 1}), {'q': '"quoted"'}),
+])
+def test_task_key_plan_fast_path_matches_slow_path(task_args, task_kwargs):
+    task_key_plan = TaskKeyPlan('test_app.some_task')
+    key_args, key_kwargs = task_key_plan.select(task_args, task_kwargs)
+    fast_task_key = task_key_plan._build_fast(key_args, key_kwargs)
+    slow_task_key = task_key_plan._build_slow(key_args, key_kwargs)
+    assert fast_task_key in (None, slow_task_key)
+    assert task_key_plan.build(task_args, task_kwargs) == slow_task_key
+
+
+def test_task_key_plan_kwargs_key():
+    assert TaskKeyPlan('test_app.some_task', key_kwargs='tenant').kwargs_keys == ('tenant',)
+    assert TaskKeyPlan('test_app.some_task', key_kwargs=['tenant', 'a']).kwargs_keys == ('a', 'tenant')
+    task_key_plan = TaskKeyPlan('test_app.some_task', key_args=False, key_kwargs='tenant')
+    assert task_key_plan.build((), {'tenant': 'acme', 't': 1}) == 'test-app-some-task-tenantacme'
+
+
+def test_get_task_key_hashed():
+
+    def task_func(*args, **kwargs):
+        pass
+
+    task_class = shared_task(
+        base=LockedTask,
+        name='test_app.hashed_task',
+        task_key_hash=True,
+    )(task_func)
+
+    long_arg = 'x' * 300
+    task_key = task_class._get_task_key(long_arg, 1, a=1, b=2)
+    assert task_key.startswith('test-app-hashed-task:')
+    assert len(task_key) == len('test-app-hashed-task:') + 32
+    assert task_class._get_task_key(long_arg, 1, b=2, a=1) == task_key
+    assert task_class._get_task_key(long_arg, 2, a=1, b=2) != task_key
+    assert task_class._get_task_key_plan().describe((long_arg, 1), {'b': 2, 'a': 1}) == '[["{}",1],{{"a":1,"b":2}}]'.format(long_arg)
+
+    # Dicts with keys of mixed types are ordered by key type and value.
+    task_key = task_class._get_task_key({1: 'a', 'b': 2, 'a': {2: None, 'x': 1}})
+    assert task_class._get_task_key({'a': {'x': 1, 2: None}, 'b': 2, 1: 'a'}) == task_key
+    assert task_class._get_task_key_plan().describe(({'b': 2, 1: 'a'},), {}) == '[[{"1":"a","b":2}],{}]'
+
+
+def test_lock_client_reused_per_process(settings):
+    settings.CELERY_TASK_PLUS_LOCK_REDIS_URL = 'redis://127.0.0.1:6379/3'
+    settings.CELERY_TASK_PLUS_LOCK_REDIS_MAX_CONNECTIONS = 4
+    reset_lock_client()
+    try:
+        redis_client = get_lock_client()
+        assert get_lock_client() is redis_client
+        assert redis_client.connection_pool.max_connections == 4
+        assert redis_client.connection_pool.connection_kwargs['db'] == 3
+        owner_id = get_owner_id()
+        assert get_owner_id() is owner_id
+        assert LockedTask._get_owner_id() is owner_id
+        reset_lock_client()
+        assert get_lock_client() is not redis_client
+    finally:
+        reset_lock_client()
+
+
+@pytest.mark.parametrize('pool_settings,message', [
+    (dict(CELERY_TASK_PLUS_LOCK_REDIS_MAX_CONNECTIONS=4), 'CELERY_TASK_PLUS_LOCK_REDIS_MAX_CONNECTIONS is ignored'),
+    (dict(CELERY_TASK_PLUS_LOCK_REDIS_POOL_TIMEOUT=5), 'CELERY_TASK_PLUS_LOCK_REDIS_POOL_TIMEOUT is ignored'),
+    (
+        dict(CELERY_TASK_PLUS_LOCK_REDIS_MAX_CONNECTIONS=4, CELERY_TASK_PLUS_LOCK_REDIS_POOL_TIMEOUT=5),
+        'CELERY_TASK_PLUS_LOCK_REDIS_MAX_CONNECTIONS and CELERY_TASK_PLUS_LOCK_REDIS_POOL_TIMEOUT are ignored',
+    ),
+])
+def test_lock_client_django_redis_pool_settings(settings, caplog, pool_settings, message):
+    settings.CELERY_TASK_PLUS_LOCK_REDIS_URL = None
+    for name, value in pool_settings.items():
+        setattr(settings, name, value)
+    reset_lock_client()
+    try:
+        assert get_lock_client() is cache.client.get_client()
+    finally:
+        reset_lock_client()
+    assert message in caplog.text
+
+
+def test_lock(redis_client):
+    lock = Lock(redis_client, 'native', id='owner1', expire=60)
+    other_lock = Lock(redis_client, 'native', id='owner2', expire=60)
+    assert lock.acquire(blocking=False)
+    assert not other_lock.acquire(blocking=False)
+    assert other_lock.last_owner_id == b'owner1'
+    assert not other_lock.acquire(timeout=1)
+    with pytest.raises(NotAcquired):
+        other_lock.release()
+    lock.extend(120)
+    assert 60 < redis_client.ttl('lock:native') <= 120
+    redis_client.rpush('lock-queue:native', 'waiter')
+    redis_client.set('lock-waiter-lease:waiter', 1, ex=60)
+    lock.release(notify_waiter=True)
+    assert not lock.locked()
+    assert redis_client.lpop('lock-waiter:waiter') == b'1'
+    assert other_lock.acquire(timeout=1)
+    other_lock.release()
+
+
+def test_lock_renewer(redis_client):
+    renewer = LockRenewer(batch_window=60)
+    locks = [Lock(redis_client, 'renewed{}'.format(n), expire=60) for n in range(3)]
+    for lock in locks:
+        lock.metric_labels = dict(task='test_app.task', lock='renewed')
+        assert lock.acquire(blocking=False)
+    locks[1].metric_labels = {}
+    redis_client.delete('lock:renewed2')
+    with redis_client.pipeline() as pipe:
+        for lock in locks[:2]:
+            pipe.expire(lock._lock_key, 5)
+        pipe.execute()
+    for lock in locks:
+        renewer.add(lock)
+    metrics.reset_metrics()
+    renewer.renew(renewer._get_due_locks())
+    assert redis_client.ttl('lock:renewed0') > 5
+    assert redis_client.ttl('lock:renewed1') > 5
+    assert metrics.get_metrics()['counters'] == {
+        ('lock_renewed', (('lock', 'renewed'), ('task', 'test_app.task'))): 1,
+        ('lock_renewed', ()): 1,
+    }
+    # The lost lock is no longer renewed.
+    assert list(renewer._locks) == locks[:2]
+
+
+def test_tuned_lock_expire():
+    assert get_tuned_lock_expire('tuned', 10, 300) == 300
+    record_lock_hold('tuned', 30)
+    assert get_tuned_lock_expire('tuned', 10, 300) == 60
+    for _ in range(50):
+        record_lock_hold('tuned', 1)
+    assert get_tuned_lock_expire('tuned', 10, 300) == 10
+
+
+def test_acquire_lock_in_order(redis_client):
+    holder = Lock(redis_client, 'fifo', id='holder', expire=60)
+    assert holder.acquire(blocking=False)
+    acquired_order = []
+
+    def wait_for_lock(waiter_id):
+        lock = Lock(redis_client, 'fifo', id=waiter_id, expire=60)
+        if acquire_lock_in_order(lock, redis_client, 'fifo', timeout=10):
+            acquired_order.append(waiter_id)
+            lock.release()
+            notify_lock_waiter(redis_client, 'fifo')
+
+    threads = []
+    for waiter_id in ('waiter1', 'waiter2', 'waiter3'):
+        thread = threading.Thread(target=wait_for_lock, args=(waiter_id,))
+        thread.start()
+        threads.append(thread)
+        while redis_client.llen('lock-queue:fifo') < len(threads):
+            time.sleep(0.01)
+    holder.release()
+    notify_lock_waiter(redis_client, 'fifo')
+    for thread in threads:
+        thread.join(10)
+    assert acquired_order == ['waiter1', 'waiter2', 'waiter3']
+    assert not redis_client.exists('lock-queue:fifo')
+
+
+def test_acquire_lock_in_order_missed_release(redis_client):
+    holder = Lock(redis_client, 'fifo-race', id='holder', expire=60)
+    assert holder.acquire(blocking=False)
+
+    class RacingLock(Lock):
+
+        def acquire(self, blocking=True, timeout=None):
+            acquired = super().acquire(blocking=blocking, timeout=timeout)
+            # Release the lock before the waiter is queued.
+            if not acquired and holder.acquired_at is not None:
+                holder.release(notify_waiter=True)
+                holder.acquired_at = None
+            return acquired
+
+    lock = RacingLock(redis_client, 'fifo-race', id='waiter', expire=60)
+    start = time.monotonic()
+    assert acquire_lock_in_order(lock, redis_client, 'fifo-race', timeout=5)
+    assert time.monotonic() - start < 1
+    lock.release()
+
+
+def test_acquire_lock_in_order_skips_gone_waiters(redis_client):
+    holder = Lock(redis_client, 'fifo-gone', id='holder', expire=60)
+    assert holder.acquire(blocking=False)
+    # A waiter that died while queued, without a lease.
+    redis_client.rpush('lock-queue:fifo-gone', 'gone')
+    acquired = []
+
+    def wait_for_lock():
+        lock = Lock(redis_client, 'fifo-gone', id='waiter', expire=60)
+        acquired.append(acquire_lock_in_order(lock, redis_client, 'fifo-gone', timeout=10))
+        acquired.append(time.monotonic())
+        lock.release()
+
+    thread = threading.Thread(target=wait_for_lock)
+    thread.start()
+    while redis_client.llen('lock-queue:fifo-gone') < 2:
+        time.sleep(0.01)
+    released_at = time.monotonic()
+    holder.release(notify_waiter=True)
+    thread.join(10)
+    assert acquired[0]
+    assert acquired[1] - released_at < 1
+    assert not redis_client.exists('lock-queue:fifo-gone')
+
+
+def test_locked_task_defer(redis_client, monkeypatch):
+
+    def task_func(*args, **kwargs):
+        pass
+
+    task_class = shared_task(
+        base=LockedTask,
+        name='test_app.deferred_task',
+        task_lock_defer=True,
+        task_lock_defer_countdown=2,
+        task_lock_defer_jitter=False,
+    )(task_func)
+
+    holder = Lock(redis_client, task_class._get_task_key(1), id='holder', expire=60)
+    assert holder.acquire(blocking=False)
+
+    # Directly called tasks are rejected.
+    with pytest.raises(Reject):
+        task_class(1)
+
+    retry_kwargs = {}
+
+    def retry(**kwargs):
+        retry_kwargs.update(kwargs)
+        return Retry()
+
+    monkeypatch.setattr(task_class, 'retry', retry)
+    task_class.push_request(id='deferred', retries=3, called_directly=False, is_eager=False)
+    try:
+        with pytest.raises(Retry):
+            task_class(1)
+    finally:
+        task_class.pop_request()
+    assert retry_kwargs['countdown'] == 16
+    assert retry_kwargs['max_retries'] == task_class.task_lock_defer_max_retries
+    assert isinstance(retry_kwargs['exc'], Reject)
+
+    # Task runs normally once the lock is free.
+    holder.release()
+    task_class(1)
+
+
+def test_locked_task_enqueue_dedup(redis_client, monkeypatch):
+
+    def task_func(*args, **kwargs):
+        pass
+
+    task_class = shared_task(
+        base=LockedTask,
+        name='test_app.dedup_task',
+        task_enqueue_dedup=60,
+    )(task_func)
+
+    sent_task_ids = []
+
+    def apply_async(self, args=None, kwargs=None, task_id=None, *args_, **options):
+        sent_task_ids.append(task_id)
+        return self.AsyncResult(task_id)
+
+    monkeypatch.setattr(Task, 'apply_async', apply_async)
+
+    result1 = task_class.delay(1)
+    result2 = task_class.apply_async((1,))
+    result3 = task_class.delay(2)
+    assert result2.id == result1.id
+    assert sent_task_ids == [result1.id, result3.id]
+
+    # Starting the pending task allows it to be queued again.
+    task_class.push_request(id=result1.id, called_directly=False)
+    try:
+        task_class(1)
+    finally:
+        task_class.pop_request()
+    result4 = task_class.delay(1)
+    assert result4.id != result1.id
+    assert sent_task_ids == [result1.id, result3.id, result4.id]
+
+
+def test_locked_task_park(redis_client, monkeypatch):
+
+    def task_func(*args, **kwargs):
+        pass
+
+    task_class = shared_task(
+        base=LockedTask,
+        name='test_app.park_task',
+        task_enqueue_dedup=60,
+        task_lock_park=True,
+    )(task_func)
+
+    sent_task_ids = []
+
+    def apply_async(self, args=None, kwargs=None, task_id=None, *args_, **options):
+        sent_task_ids.append(task_id)
+        return self.AsyncResult(task_id)
+
+    monkeypatch.setattr(Task, 'apply_async', apply_async)
+
+    task_key = task_class._get_task_key(1)
+    holder = Lock(redis_client, task_key, id='holder', expire=60)
+    assert holder.acquire(blocking=False)
+    result1 = task_class.delay(1)
+    result2 = task_class.delay(2)
+    # Duplicates of a parked task are still deduplicated.
+    assert task_class.delay(1).id == result1.id
+    # Tasks with a countdown are never parked.
+    other_holder = Lock(redis_client, task_class._get_task_key(3), id='holder', expire=60)
+    assert other_holder.acquire(blocking=False)
+    result3 = task_class.apply_async((3,), countdown=10)
+    assert sent_task_ids == [result2.id, result3.id]
+    assert redis_client.llen('lock-parked:{}'.format(task_key)) == 1
+
+    # The parked task is sent once a task releases the lock.
+    holder.release()
+    task_class(1)
+    assert sent_task_ids == [result2.id, result3.id, result1.id]
+    assert not redis_client.exists('lock-parked:{}'.format(task_key))
+
+
+def test_locked_task_park_release_order(redis_client, monkeypatch):
+
+    def task_func(*args, **kwargs):
+        pass
+
+    task_class = shared_task(base=LockedTask, name='test_app.park_order_task', task_lock_park=True)(task_func)
+
+    sent_task_ids = []
+
+    def apply_async(self, args=None, kwargs=None, task_id=None, *args_, **options):
+        sent_task_ids.append(task_id)
+        return self.AsyncResult(task_id)
+
+    monkeypatch.setattr(Task, 'apply_async', apply_async)
+
+    task_key = task_class._get_task_key(1)
+    parked_key = 'lock-parked:{}'.format(task_key)
+
+    def parked_task_ids():
+        return [message.decode('utf-8').partition(' ')[0] for message in redis_client.lrange(parked_key, 0, -1)]
+
+    holder = Lock(redis_client, task_key, id='holder', expire=60)
+    assert holder.acquire(blocking=False)
+    task_ids = [task_class.delay(1).id for n in range(4)]
+    assert sent_task_ids == []
+
+    # One parked task is sent per release, and tasks published until it has
+    # run are parked behind the others.
+    holder.release()
+    assert release_parked_task(redis_client, task_key, released=True)
+    assert sent_task_ids == task_ids[:1]
+    assert not release_parked_task(redis_client, task_key)
+    assert task_class.delay(1).id not in sent_task_ids
+    assert parked_task_ids()[:3] == task_ids[1:]
+
+    # A task parked again because the lock was taken goes back to the head.
+    assert holder.acquire(blocking=False)
+    assert release_parked_task(redis_client, task_key, released=True)
+    assert sent_task_ids == task_ids[:1]
+    assert parked_task_ids()[:3] == task_ids[1:]
+
+    # Force released locks send the next parked task.
+    assert force_release_lock(redis_client, 'lock:{}'.format(task_key), 'holder')
+    assert sent_task_ids == task_ids[:2]
+
+    # So does the reaper once the lock expired and the sent task is gone.
+    assert release_orphaned_parked_tasks(redis_client) == 0
+    redis_client.delete('lock-parked-sent:{}'.format(task_key))
+    assert release_orphaned_parked_tasks(redis_client) == 1
+    assert sent_task_ids == task_ids[:3]
+
+
+@pytest.mark.django_db
+def test_direct_results_buffered(monkeypatch):
+    writer = TaskResultWriter(flush_interval=3600)
+    monkeypatch.setattr('celery_task_plus.tasks.get_task_result_writer', lambda: writer)
+
+    direct_results_task.push_request(id='buffered1', is_eager=True, called_directly=False, task=direct_results_task.name, args=[], kwargs={})
+    try:
+        direct_results_task()
+    finally:
+        direct_results_task.pop_request()
+    assert writer._queue.qsize() == 2
+    assert not TaskResult.objects.filter(task_id='buffered1').exists()
+
+    writer.flush()
+    task_result = TaskResult.objects.get(task_id='buffered1')
+    assert task_result.status == 'SUCCESS'
+    assert task_result.task_name == direct_results_task.name
+    assert direct_results_task.AsyncResult('buffered1').get() is None
+
+    # Results for existing rows are updated in bulk.
+    writer.put(direct_results_task.backend, 'buffered1', {'pid': 1}, 'STARTED')
+    writer.flush()
+    assert TaskResult.objects.get(task_id='buffered1').status == 'STARTED'
+
+    writer.stop()
+
+
+def test_deferred_result():
+    stored = []
+
+    deferred_result = DeferredResult(0.5, stored.append, 'fast')
+    deferred_result.start()
+    deferred_result.cancel()
+
+    deferred_result = DeferredResult(0.01, stored.append, 'slow')
+    deferred_result.start()
+    assert deferred_result.join(5)
+    deferred_result.cancel()
+
+    assert stored == ['slow']
+
+
+def test_direct_results_started_delay(monkeypatch):
+
+    def task_func(delay):
+        time.sleep(delay)
+
+    task_class = shared_task(
+        base=DirectResultsTask,
+        name='test_app.started_delay_task',
+        direct_results_started_delay=0.1,
+    )(task_func)
+
+    stored = []
+    monkeypatch.setattr(task_class, '_store_direct_result', lambda task_id, result, state, **kwargs: stored.append((task_id, state)))
+    for task_id, delay in [('fast', 0), ('slow', 0.5)]:
+        task_class.push_request(id=task_id, is_eager=True, called_directly=False, task=task_class.name, args=[delay], kwargs={})
+        try:
+            task_class(delay)
+        finally:
+            task_class.pop_request()
+
+    # Only the slow call stored its started state.
+    assert stored == [('fast', 'SUCCESS'), ('slow', 'STARTED'), ('slow', 'SUCCESS')]
+
+
+@pytest.mark.parametrize('exc_message,encoded_exc_message', [
+    ('message', 'message'),
+    (('message', 1, None, [1.5, {'a': True}]), ('message', 1, None, [1.5, {'a': True}])),
+    (('message', object), ['message', str(object)]),
+    ('x' * 200, 'x' * 84 + '...(truncated)'),
+    (('x' * 200, 'y' * 10, 1), ['x' * 61 + '...(truncated)', 'y' * 10, '1']),
+    (('x' * 200, 'z' * 200), ['x' * 31 + '...(truncated)', 'z' * 31 + '...(truncated)']),
+    ('\x00' * 50, '\x00' * 14 + '...(truncated)'),
+    ('\U0001f600' * 50, '\U0001f600' * 7 + '...(truncated)'),
+])
+def test_encode_exc_message(settings, exc_message, encoded_exc_message):
+    settings.CELERY_TASK_PLUS_RESULT_EXCEPTION_MAX_LENGTH = 100
+    assert direct_results_task.backend.encode_exc_message(exc_message) == encoded_exc_message
+
+
+@pytest.mark.parametrize('exc_message', [
+    ['\x00' * 30] * 3,
+    ['x' * 10] * 100,
+    list(range(1000)),
+    ['\u00e9' * 100, 'x', '\U0001f600' * 5],
+])
+@pytest.mark.parametrize('max_length', [20, 100, 1000])
+def test_encode_exc_message_max_length(settings, exc_message, max_length):
+    settings.CELERY_TASK_PLUS_RESULT_EXCEPTION_MAX_LENGTH = max_length
+    encoded_exc_message = direct_results_task.backend.encode_exc_message(exc_message)
+    assert len(dumps(encoded_exc_message, serializer='json')[2]) <= max_length
+
+
+@pytest.mark.parametrize('value', [
+    'message',
+    'quote " and backslash \\',
+    '\x00\n\t' * 20,
+    '\u00e9\u4e2d\U0001f600' * 20,
+    ['\x00' * 10, '\u00e9' * 10],
+    {'\x00': ['\u00e9', -2 ** 100, 0.1, float('-inf'), None, False]},
+    list(range(-1000, 1000, 7)),
+])
+def test_get_json_size(value):
+    assert _get_json_size(value, 10000) >= len(dumps(value, serializer='json')[2])
+
+
+@pytest.mark.parametrize('keep_end,max_length,expected', [
+    (True, 20, '...(truncated)\n' + 'y' * 5),
+    (False, 20, 'x' * 6 + '...(truncated)'),
+    (True, 5, 'y' * 5),
+    (False, 5, 'x' * 5),
+    (True, 0, ''),
+    (True, 100, 'x' * 50 + 'y' * 50),
+])
+def test_truncate(keep_end, max_length, expected):
+    assert _truncate('x' * 50 + 'y' * 50, max_length, keep_end) == expected
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('compression,spill_threshold,stored_prefix', [
+    ('zlib', None, 'ctp:zlib:'),
+    ('lzma', None, 'ctp:lzma:'),
+    ('zlib', 10, 'ctp:file:'),
+    (None, 10, 'ctp:file:'),
+])
+def test_result_compression(settings, tmp_path, compression, spill_threshold, stored_prefix):
+    settings.CELERY_TASK_PLUS_RESULT_COMPRESSION = compression
+    settings.CELERY_TASK_PLUS_RESULT_COMPRESSION_THRESHOLD = 100
+    settings.CELERY_TASK_PLUS_RESULT_SPILL_THRESHOLD = spill_threshold
+    settings.CELERY_TASK_PLUS_RESULT_SPILL_STORAGE = 'django.core.files.storage.FileSystemStorage'
+    settings.MEDIA_ROOT = str(tmp_path)
+    task_id = 'compressed-{}-{}'.format(compression, spill_threshold)
+    result = {'data': 'x' * 1000}
+    direct_results_task.backend.store_result(task_id, result, 'SUCCESS', traceback='y' * 1000)
+    task_result = TaskResult.objects.get(task_id=task_id)
+    assert task_result.result.startswith(stored_prefix)
+    assert task_result.traceback.startswith(stored_prefix)
+    async_result = direct_results_task.AsyncResult(task_id)
+    assert async_result.get() == result
+    assert async_result.traceback == 'y' * 1000
+
+
+@pytest.mark.django_db
+def test_result_spill_cleanup(settings, tmp_path):
+    settings.CELERY_TASK_PLUS_RESULT_COMPRESSION = None
+    settings.CELERY_TASK_PLUS_RESULT_SPILL_THRESHOLD = 100
+    settings.CELERY_TASK_PLUS_RESULT_SPILL_STORAGE = 'django.core.files.storage.FileSystemStorage'
+    settings.MEDIA_ROOT = str(tmp_path)
+    backend = direct_results_task.backend
+    spill_dir = tmp_path / 'celery_task_plus' / 'results' / 'spilled'
+    backend.store_result('spilled', 'x' * 1000, 'FAILURE', traceback='y' * 1000)
+    assert sorted(p.name for p in spill_dir.iterdir()) == ['result', 'traceback']
+
+    # Files are deleted when overwritten by content that isn't spilled.
+    backend.store_result('spilled', 'x', 'SUCCESS')
+    assert list(spill_dir.iterdir()) == []
+    assert direct_results_task.AsyncResult('spilled').get() == 'x'
+
+    # Files are deleted with expired task results.
+    backend.store_result('spilled', 'x' * 1000, 'SUCCESS')
+    assert [p.name for p in spill_dir.iterdir()] == ['result']
+    TaskResult.objects.filter(task_id='spilled').update(date_done=timezone.now() - datetime.timedelta(days=30))
+    backend.cleanup()
+    assert not TaskResult.objects.filter(task_id='spilled').exists()
+    assert list(spill_dir.iterdir()) == []
+
+
+def test_locked_task_metrics(redis_client):
+
+    def task_func(*args, **kwargs):
+        pass
+
+    task_class = shared_task(
+        base=LockedTask,
+        name='test_app.metrics_task',
+        task_key_name='metrics_key',
+    )(task_func)
+
+    metrics.reset_metrics()
+    task_class(1)
+    holder = Lock(redis_client, task_class._get_task_key(1), id='holder', expire=60)
+    assert holder.acquire(blocking=False)
+    with pytest.raises(Reject):
+        task_class(1)
+    holder.release()
+
+    labels = (('lock', 'metrics-key'), ('task', 'test_app.metrics_task'))
+    recorded_metrics = metrics.get_metrics()
+    assert recorded_metrics['counters'][('lock_acquired', labels)] == 1
+    assert recorded_metrics['counters'][('lock_contended', labels)] == 1
+    assert recorded_metrics['timings'][('lock_acquire', labels)]['count'] == 2
+    assert recorded_metrics['timings'][('lock_hold', labels)]['count'] == 1
+
+
+@pytest.mark.parametrize('tags,expected_data', [
+    (False, [b'ctp.lock_acquired.metrics-key.test_app_task:1|c', b'ctp.lock_hold.metrics-key.test_app_task:250.0|ms']),
+    (True, [b'ctp.lock_acquired:1|c|#lock:metrics-key,task:test_app.task', b'ctp.lock_hold:250.0|ms|#lock:metrics-key,task:test_app.task']),
+])
+def test_statsd_metrics_backend(settings, tags, expected_data):
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    server.settimeout(5)
+    settings.CELERY_TASK_PLUS_STATSD_HOST = '127.0.0.1'
+    settings.CELERY_TASK_PLUS_STATSD_PORT = server.getsockname()[1]
+    settings.CELERY_TASK_PLUS_STATSD_PREFIX = 'ctp.'
+    settings.CELERY_TASK_PLUS_STATSD_TAGS = tags
+    try:
+        backend = metrics.StatsdMetricsBackend()
+        backend.incr('lock_acquired', 1, dict(task='test_app.task', lock='metrics-key'))
+        backend.observe('lock_hold', 0.25, dict(task='test_app.task', lock='metrics-key'))
+        assert [server.recv(1024), server.recv(1024)] == expected_data
+    finally:
+        server.close()
+
+
+def test_prometheus_metrics_backend(monkeypatch, caplog):
+    prometheus_client = pytest.importorskip('prometheus_client')
+    backend = metrics.PrometheusMetricsBackend()
+    backend.incr('test_counter', 2, dict(task='test_app.task'))
+    backend.observe('test_timing', 0.5, dict(task='test_app.task'))
+    registry = prometheus_client.REGISTRY
+    assert registry.get_sample_value('celery_task_plus_test_counter_total', dict(task='test_app.task')) == 2
+    assert registry.get_sample_value('celery_task_plus_test_timing_seconds_count', dict(task='test_app.task')) == 1
+    assert registry.get_sample_value('celery_task_plus_test_timing_seconds_bucket', dict(task='test_app.task', le='0.0001')) == 0
+    assert registry.get_sample_value('celery_task_plus_test_timing_seconds_bucket', dict(task='test_app.task', le='3600.0')) == 1
+
+    # Uses with other label names are rejected, and only logged when recorded.
+    with pytest.raises(ValueError):
+        backend.incr('test_counter', 1, {})
+    monkeypatch.setattr(metrics, 'get_metrics_backends', lambda: [backend])
+    with caplog.at_level('ERROR', logger='celery_task_plus.metrics'):
+        metrics.incr('test_counter', task='test_app.task', lock='other')
+    assert 'Error recording metric test_counter' in caplog.text
+    assert registry.get_sample_value('celery_task_plus_test_counter_total', dict(task='test_app.task')) == 2
+
+
+def test_prometheus_server(settings, monkeypatch, tmp_path):
+    prometheus_client = pytest.importorskip('prometheus_client')
+    started = []
+    monkeypatch.setattr(prometheus_client, 'start_http_server', lambda port, registry: started.append((port, registry)))
+    monkeypatch.setattr(metrics, '_prometheus_server', (None, None))
+    monkeypatch.setattr(metrics, '_prometheus_worker', False)
+    monkeypatch.delenv('PROMETHEUS_MULTIPROC_DIR', raising=False)
+    settings.CELERY_TASK_PLUS_METRICS_BACKENDS = ['celery_task_plus.metrics.PrometheusMetricsBackend']
+    settings.CELERY_TASK_PLUS_PROMETHEUS_PORT = 9100
+
+    # The main worker process serves its metrics once.
+    metrics.start_worker_prometheus_server()
+    metrics.start_worker_prometheus_server()
+    assert started == [(9100, prometheus_client.REGISTRY)]
+    assert metrics._prometheus_worker
+
+    # Pool processes serve their own metrics on the following ports.
+    monkeypatch.setattr(metrics, '_prometheus_server', (None, None))
+    metrics.start_worker_process_prometheus_server()
+    assert started[-1] == (9101, prometheus_client.REGISTRY)
+
+    # In multiprocess mode, only the main process serves the metrics of all
+    # processes.
+    monkeypatch.setenv('PROMETHEUS_MULTIPROC_DIR', str(tmp_path))
+    monkeypatch.setattr(metrics, '_prometheus_server', (None, None))
+    metrics.start_worker_process_prometheus_server()
+    assert len(started) == 2
+    metrics.start_worker_prometheus_server()
+    assert started[-1][0] == 9100
+    assert started[-1][1] is not prometheus_client.REGISTRY
+
+
+def test_async_locked_task(redis_client, async_redis_client):
+
+    async def task_func(delay, **kwargs):
+        await asyncio.sleep(delay)
+        return delay
+
+    task_class = shared_task(base=AsyncLockedTask, name='test_app.async_locked_task')(task_func)
+
+    async def call_tasks():
+        return await asyncio.gather(task_class(0.2), task_class(0.2), task_class(0.1, x=1), return_exceptions=True)
+
+    results = asyncio.run(call_tasks())
+    assert results[0] == 0.2
+    assert isinstance(results[1], Reject)
+    assert results[2] == 0.1
+    assert not redis_client.exists('lock:{}'.format(task_class._get_task_key(0.2)))
+
+    # Locks held by sync tasks are respected.
+    holder = Lock(redis_client, task_class._get_task_key(0), id='holder', expire=60)
+    assert holder.acquire(blocking=False)
+    with pytest.raises(Reject):
+        asyncio.run(task_class(0))
+    holder.release()
+    assert asyncio.run(task_class(0)) == 0
+
+
+def test_async_task_event_loop_reused(async_redis_client, monkeypatch):
+
+    async def task_func(delay):
+        await asyncio.sleep(delay)
+        return asyncio.get_running_loop()
+
+    task_class = shared_task(base=AsyncLockedTask, name='test_app.async_loop_task')(task_func)
+
+    created_clients = []
+
+    def create_client():
+        created_clients.append(async_redis_client())
+        return created_clients[-1]
+
+    monkeypatch.setattr(aio, 'get_async_lock_client', get_async_lock_client)
+    monkeypatch.setattr(aio, '_create_async_lock_client', create_client)
+
+    # Tasks run in a worker thread share its event loop and lock client.
+    loop = task_class.apply((0,)).get()
+    assert task_class.apply((0.01,)).get() is loop
+    assert not loop.is_closed()
+    assert len(created_clients) == 1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_direct_results_task(redis_client, async_redis_client):
+    assert asyncio.run(async_locked_direct_results_task(0.01)) == 0.01
+    task_result = TaskResult.objects.get(task_name=async_locked_direct_results_task.name)
+    assert task_result.status == 'SUCCESS'
+    assert task_result.result == '0.01'
+
+
+def test_multi_lock(redis_client):
+    lock = MultiLock(redis_client, ['b', 'a'], id='owner1', expire=60)
+    assert lock.names == ['a', 'b']
+    assert lock.acquire(blocking=False)
+    # All or none of the locks are acquired.
+    other_lock = MultiLock(redis_client, ['b', 'c'], id='owner2', expire=60)
+    assert not other_lock.acquire(blocking=False)
+    assert other_lock.last_owner_id == b'owner1'
+    assert not redis_client.exists('lock:c')
+    lock.extend()
+    lock.release()
+    assert other_lock.acquire(blocking=False)
+    other_lock.release()
+
+
+def test_shared_lock(redis_client):
+    readers = [MultiLock(redis_client, ['shared'], id='reader', expire=60, shared=True) for _ in range(2)]
+    for reader in readers:
+        assert reader.acquire(blocking=False)
+    writer = Lock(redis_client, 'shared', id='writer', expire=60)
+    assert not writer.acquire(blocking=False)
+    assert writer.last_owner_id.startswith(b'reader#')
+    readers[0].release()
+    assert not writer.acquire(blocking=False)
+    readers[1].extend()
+    readers[1].release()
+    assert writer.acquire(blocking=False)
+    assert not readers[0].acquire(blocking=False)
+    writer.release()
+
+
+def test_locked_task_key_specs(redis_client):
+
+    def task_func(account, tenant=None):
+        pass
+
+    task_class = shared_task(
+        base=LockedTask,
+        name='test_app.multi_key_task',
+        task_key_specs=[
+            dict(task_key_name='account', task_key_kwargs=False),
+            dict(task_key_name='tenant', task_key_args=False),
+        ],
+    )(task_func)
+    assert task_class._get_task_lock_keys(None, (1,), {'tenant': 2}) == ['account-1', 'tenant-tenant2']
+
+    holder = Lock(redis_client, 'tenant-tenant2', id='holder', expire=60)
+    assert holder.acquire(blocking=False)
+    with pytest.raises(Reject):
+        task_class(1, tenant=2)
+    assert not redis_client.exists('lock:account-1')
+    task_class(1, tenant=3)
+    holder.release()
+    task_class(1, tenant=2)
+
+
+def test_semaphore(redis_client):
+    semaphores = [Semaphore(redis_client, 'limited', 2, id='owner', expire=60) for _ in range(3)]
+    assert semaphores[0].acquire(blocking=False)
+    assert semaphores[1].acquire(blocking=False)
+    assert semaphores[1].slots_used == 2
+    assert not semaphores[2].acquire(timeout=1)
+    semaphores[0].extend()
+    semaphores[0].release()
+    assert semaphores[2].acquire(blocking=False)
+    with pytest.raises(NotAcquired):
+        semaphores[0].release()
+
+    # Expired leases (of lost workers) are removed on the next acquire.
+    redis_client.zadd('semaphore:limited', {'lost': 0})
+    semaphores[1].release()
+    assert semaphores[0].acquire(blocking=False)
+    assert semaphores[0].stale_released == 1
+    assert semaphores[0].slots_used == 2
+
+
+def test_locked_task_concurrency_limit(redis_client):
+
+    def task_func(*args, **kwargs):
+        pass
+
+    task_class = shared_task(
+        base=LockedTask,
+        name='test_app.concurrency_limit_task',
+        task_concurrency_limit=2,
+    )(task_func)
+
+    metrics.reset_metrics()
+    task_key = task_class._get_task_key(1)
+    holder = Semaphore(redis_client, task_key, 2, id='holder', expire=60)
+    assert holder.acquire(blocking=False)
+    task_class(1)
+    assert redis_client.zcard('semaphore:{}'.format(task_key)) == 1
+    other_holder = Semaphore(redis_client, task_key, 2, id='holder', expire=60)
+    assert other_holder.acquire(blocking=False)
+    with pytest.raises(Reject, match='Concurrency limit reached'):
+        task_class(1)
+
+    labels = (('lock', 'test-app-concurrency-limit-task'), ('task', 'test_app.concurrency_limit_task'))
+    assert metrics.get_metrics()['gauges'][('semaphore_slots_used', labels)] == 2
+
+
+@pytest.mark.parametrize('backend_class', [ThreadingLockBackend, FileLockBackend])
+def test_local_lock_backends(settings, tmp_path, backend_class):
+    settings.CELERY_TASK_PLUS_LOCK_FILE_DIR = str(tmp_path)
+    backend = backend_class()
+    lock = backend.get_lock('local', 'owner1')
+    other_lock = backend.get_lock('local', 'owner2')
+    assert lock.acquire(blocking=False)
+    assert not other_lock.acquire(blocking=False)
+    assert other_lock.last_owner_id in ('owner1', b'owner1')
+    assert not other_lock.acquire(timeout=0.1)
+    with pytest.raises(NotAcquired):
+        other_lock.release()
+    lock.release()
+    assert other_lock.acquire(timeout=1)
+    other_lock.release()
+    with pytest.raises(ValueError):
+        backend.get_lock(['a', 'b'], 'owner1')
+
+
+def test_locked_task_lock_backend(settings):
+    settings.CELERY_TASK_PLUS_LOCK_BACKEND = 'celery_task_plus.backends.ThreadingLockBackend'
+    calls = []
+
+    def task_func(*args, **kwargs):
+        calls.append(args)
+
+    task_class = shared_task(base=LockedTask, name='test_app.threading_lock_task')(task_func)
+
+    backend = get_lock_backend()
+    assert isinstance(backend, ThreadingLockBackend)
+    assert task_class._get_lock_backend() is backend
+    holder = backend.get_lock(task_class._get_task_key(1), 'holder')
+    assert holder.acquire(blocking=False)
+    with pytest.raises(Reject, match='Lock held by another process'):
+        task_class(1)
+    holder.release()
+    task_class(1)
+    assert calls == [(1,)]
+
+
+def test_check_rate_limit(redis_client):
+    assert check_rate_limit(redis_client, 'limited', 2) == 0
+    assert 0 < check_rate_limit(redis_client, 'limited', 2) <= 0.5
+    assert check_rate_limit(redis_client, 'burst', 2, burst=3) == 0
+    assert check_rate_limit(redis_client, 'burst', 2, burst=3) == 0
+    assert check_rate_limit(redis_client, 'burst', 2, burst=3) == 0
+    assert check_rate_limit(redis_client, 'burst', 2, burst=3) > 0
+
+
+def test_locked_task_rate_limit(redis_client, monkeypatch):
+
+    def task_func(*args, **kwargs):
+        pass
+
+    task_class = shared_task(base=LockedTask, name='test_app.rate_limited_task', task_key_rate_limit='1/m')(task_func)
+    task_class(1)
+    task_class(2)
+    with pytest.raises(Reject, match='Rate limit exceeded'):
+        task_class(1)
+
+    retry_kwargs = {}
+
+    def retry(**kwargs):
+        retry_kwargs.update(kwargs)
+        return Retry()
+
+    monkeypatch.setattr(task_class, 'retry', retry)
+    task_class.push_request(id='rate_limited', retries=0, called_directly=False, is_eager=False)
+    try:
+        with pytest.raises(Retry):
+            task_class(2)
+    finally:
+        task_class.pop_request()
+    assert 55 < retry_kwargs['countdown'] <= 60
+
+
+def test_cached_task(redis_client):
+    calls = []
+
+    def task_func(x, delay=0):
+        calls.append(x)
+        time.sleep(delay)
+        return {'x': x}
+
+    task_class = shared_task(base=CachedTask, name='test_app.cached_task', task_key_kwargs=False)(task_func)
+    task_class._get_local_result_cache().clear()
+
+    assert task_class(1) == {'x': 1}
+    assert task_class(1) == {'x': 1}
+    assert calls == [1]
+    task_class._get_local_result_cache().clear()
+    assert task_class(1) == {'x': 1}
+    assert calls == [1]
+    task_class.clear_cached_result(1)
+    assert task_class(1) == {'x': 1}
+    assert calls == [1, 1]
+
+    # Concurrent calls for the same key compute the result once.
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(task_class(2, delay=0.2))) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert results == [{'x': 2}] * 3
+    assert calls == [1, 1, 2]
+
+
+def test_cached_task_serializer_round_trip(redis_client):
+    calls = []
+
+    def task_func(x):
+        calls.append(x)
+        return (x, object()) if x else (x,)
+
+    task_class = shared_task(base=CachedTask, name='test_app.cached_round_trip_task', task_key_kwargs=False)(task_func)
+    task_class._get_local_result_cache().clear()
+
+    # Cache hits return the serialized result.
+    assert task_class(0) == (0,)
+    assert task_class(0) == [0]
+    # Results that can't be serialized are returned without being cached.
+    assert task_class(1)[0] == 1
+    assert task_class(1)[0] == 1
+    assert calls == [0, 1, 1]
+
+
+def test_local_result_cache():
+    local_cache = LocalResultCache(max_size=2)
+    local_cache.set('a', 1, 60)
+    local_cache.set('b', 2, 60)
+    assert local_cache.get('a') == 1
+    local_cache.set('c', 3, 60)
+    assert local_cache.get('b') is None
+    assert local_cache.get('a') == 1
+    local_cache.set('c', 4, 0)
+    assert local_cache.get('c') is None
+
+
+@pytest.mark.django_db
+def test_purge_task_results(settings, tmp_path):
+    settings.CELERY_TASK_PLUS_RESULT_RETENTION = [
+        dict(max_age=3600),
+        dict(task_name='test_app.kept', max_age=86400 * 7),
+        dict(task_name='test_app.failed', states=['FAILURE'], max_age=60),
+    ]
+    settings.CELERY_TASK_PLUS_RESULT_SPILL_THRESHOLD = 100
+    settings.CELERY_TASK_PLUS_RESULT_SPILL_STORAGE = 'django.core.files.storage.FileSystemStorage'
+    settings.MEDIA_ROOT = str(tmp_path)
+    now = timezone.now()
+    rows = [
+        ('old1', 'test_app.other', 'SUCCESS', 7200),
+        ('old2', None, 'SUCCESS', 7200),
+        ('new1', 'test_app.other', 'SUCCESS', 60),
+        ('kept1', 'test_app.kept', 'SUCCESS', 7200),
+        ('kept2', 'test_app.failed', 'SUCCESS', 7200),
+        ('old3', 'test_app.failed', 'FAILURE', 120),
+    ]
+    for task_id, task_name, status, age in rows:
+        TaskResult.objects.store_result('application/json', 'utf-8', task_id, '"{}"'.format('x' * 200), status, task_name=task_name)
+        TaskResult.objects.filter(task_id=task_id).update(date_done=now - datetime.timedelta(seconds=age))
+    spilled_name = TaskResult.objects.get(task_id='old1').result[len('ctp:file:'):]
+    assert (tmp_path / spilled_name).exists()
+
+    metrics.reset_metrics()
+    out = io.StringIO()
+    call_command('purge_task_results', '--dry-run', stdout=out)
+    assert 'Would purge 2 task results: *' in out.getvalue()
+    assert TaskResult.objects.count() == 6
+
+    progress = []
+    purged = purge_task_results(batch_size=1, sleep=0, progress=lambda policy, count: progress.append((policy.label, count)))
+    assert purged == {'*': 2, 'test_app.kept': 0, 'test_app.failed': 1}
+    assert progress == [('*', 1), ('*', 2), ('test_app.failed', 1)]
+    assert set(TaskResult.objects.values_list('task_id', flat=True)) == {'new1', 'kept1', 'kept2'}
+    assert not (tmp_path / spilled_name).exists()
+    assert metrics.get_metrics()['counters'][('results_purged', (('task', '*'),))] == 2
+
+
+@pytest.mark.django_db
+def test_task_result_admin_keyset_pagination(admin_client, monkeypatch):
+    monkeypatch.setattr(TaskResultAdmin, 'list_per_page', 2)
+    for n in range(5):
+        status = 'FAILURE' if n == 4 else 'SUCCESS'
+        TaskResult.objects.store_result('application/json', 'utf-8', 'admin{}'.format(n), '"{}"'.format(n), status, task_name='test_app.admin')
+    url = reverse('admin:django_celery_results_taskresult_changelist')
+    task_ids = []
+    while url:
+        response = admin_client.get(url)
+        assert response.status_code == 200
+        cl = response.context['cl']
+        assert cl.keyset_pagination
+        assert 'result' in cl.result_list[0].get_deferred_fields()
+        task_ids.extend(result.task_id for result in cl.result_list)
+        url = cl.next_page_url and reverse('admin:django_celery_results_taskresult_changelist') + cl.next_page_url
+    assert sorted(task_ids) == ['admin{}'.format(n) for n in range(5)]
+
+    response = admin_client.get(reverse('admin:django_celery_results_taskresult_changelist'), {'status': 'FAILURE'})
+    assert [result.task_id for result in response.context['cl'].result_list] == ['admin4']
+    assert response.context['cl'].result_count == 1
+    response = admin_client.get(reverse('admin:django_celery_results_taskresult_changelist'), {'cursor': 'invalid'})
+    assert response.status_code == 302
+
+
+def test_reap_stale_locks(redis_client):
+    assert b'&nonce=' in get_owner_id()
+    renewer = LockRenewer(batch_window=60)
+    dead_lock = Lock(redis_client, 'reaped', id='dead', expire=60)
+    dead_semaphore = Semaphore(redis_client, 'reaped', 2, id='dead', expire=60)
+    alive_lock = Lock(redis_client, 'alive', id='alive', expire=60)
+    for lock in (dead_lock, dead_semaphore, alive_lock):
+        assert lock.acquire(blocking=False)
+        renewer.add(lock)
+    renewer.heartbeat()
+    assert redis_client.hget('lock-owner:dead', 'lock:reaped').endswith(b'|dead')
+    assert reap_stale_locks(redis_client, timeout=10) == {}
+
+    # Owners without a recent heartbeat are dead.
+    redis_client.zadd('lock-owners', {'dead': 0})
+    assert reap_stale_locks(redis_client, timeout=10) == {'dead': 2}
+    assert not dead_lock.locked()
+    assert redis_client.zcard('semaphore:reaped') == 0
+    assert redis_client.lpop('lock-signal:reaped') == b'1'
+    assert alive_lock.locked()
+    assert not redis_client.exists('lock-owner:dead')
+    assert redis_client.zscore('lock-owners', 'dead') is None
+
+    # Owners that released all their locks are recorded without keys.
+    for lock in (dead_lock, dead_semaphore):
+        renewer.remove(lock)
+    alive_lock.release()
+    renewer.remove(alive_lock)
+    renewer.heartbeat()
+    assert not redis_client.exists('lock-owner:alive')
+    redis_client.zadd('lock-owners', {'alive': 0})
+    assert reap_stale_locks(redis_client, timeout=10) == {'alive': 0}
+
+
+def test_lock_heartbeat_interval(settings, redis_client):
+    # Heartbeats are off unless configured or needed by the lock reaper.
+    assert get_lock_heartbeat_interval() is None
+    settings.CELERY_TASK_PLUS_LOCK_REAPER = True
+    assert get_lock_heartbeat_interval() == 2
+    settings.CELERY_TASK_PLUS_LOCK_HEARTBEAT_INTERVAL = 5
+    assert get_lock_heartbeat_interval() == 5
+
+    # Adding locks doesn't record a heartbeat before the interval is over.
+    renewer = LockRenewer(batch_window=1, heartbeat_interval=60)
+    lock = Lock(redis_client, 'heartbeat', id='owner', expire=60)
+    assert lock.acquire(blocking=False)
+    renewer._locks[lock] = time.monotonic() + 40
+    assert renewer._is_heartbeat_due(time.monotonic())
+    redis_client.zadd('lock-owners', {'ancient': 0})
+    renewer.heartbeat()
+    assert not renewer._is_heartbeat_due(time.monotonic())
+    other_lock = Lock(redis_client, 'heartbeat-2', id='owner', expire=60)
+    renewer.add(other_lock)
+    assert not renewer._is_heartbeat_due(time.monotonic())
+    renewer.remove(other_lock)
+
+    # Owners without a heartbeat for longer than their keys are kept are removed.
+    assert redis_client.zscore('lock-owners', 'ancient') is None
+    assert redis_client.zscore('lock-owners', 'owner') is not None
+
+
+@pytest.mark.django_db
+def test_task_locks_inspection(redis_client, admin_client):
+    renewer = LockRenewer(batch_window=60)
+    lock = Lock(redis_client, 'inspected-1', id='owner1', expire=60)
+    shared_lock = MultiLock(redis_client, ['inspected-2'], id='owner2', expire=60, shared=True)
+    semaphore = Semaphore(redis_client, 'inspected-3', 2, id='owner3', expire=60)
+    other_lock = Lock(redis_client, 'other', id='owner1', expire=60)
+    for held in (lock, shared_lock, semaphore, other_lock):
+        assert held.acquire(blocking=False)
+    renewer.add(lock)
+    renewer.heartbeat()
+    redis_client.rpush('lock-queue:inspected-1', 'waiter')
+
+    held_locks = sorted(iter_held_locks(redis_client, 'inspected-*', count=1), key=lambda held_lock: held_lock['name'])
+    assert [(h['name'], h['kind'], h['owner_id']) for h in held_locks] == [
+        ('inspected-1', 'exclusive', 'owner1'),
+        ('inspected-2', 'shared', 'owner2'),
+        ('inspected-3', 'semaphore', 'owner3'),
+    ]
+    assert 0 < held_locks[0]['ttl'] <= 60
+    assert held_locks[0]['age'] is not None
+    assert held_locks[1]['age'] is None
+    assert held_locks[0]['waiters'] == 1
+
+    out = io.StringIO()
+    call_command('task_locks', 'inspected-1', stdout=out)
+    assert 'exclusive\tinspected-1\towner1' in out.getvalue()
+    call_command('task_locks', 'inspected-1', '--release', '--noinput', stdout=out)
+    assert not lock.locked()
+    assert redis_client.lpop('lock-signal:inspected-1') == b'1'
+
+    url = reverse('admin:django_celery_results_taskresult_locks')
+    response = admin_client.get(url, {'pattern': 'inspected-*'})
+    assert response.status_code == 200
+    assert [h['name'] for h in response.context['held_locks']] == ['inspected-2', 'inspected-3']
+    value = response.context['held_locks'][0]['value']
+    response = admin_client.post(url + '?pattern=inspected-*', {'lock': [value]})
+    assert response.status_code == 302
+    assert not redis_client.zcard('lock-shared:inspected-2')
+    response = admin_client.post(url + '?pattern=inspected-*', {'release_matching': '1'})
+    assert not redis_client.zcard('semaphore:inspected-3')
+    assert other_lock.locked()
+    renewer.remove(lock)